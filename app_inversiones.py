@@ -10,6 +10,17 @@ import plotly.graph_objects as go
 import io
 import os
 
+from libro_transacciones import LibroTransacciones
+from motor_fifo import ESCALA_CANTIDAD, EstadoFIFO
+from historico_precios import almacen_precios
+from importacion import importar_por_bloques
+from divisas import precios_en_base
+from precios import refresco_precios
+from registros import (
+    DiarioRegistro, eliminar_registro, exportar_excel, guardar_registro, listar_registros, mapear_registro,
+    tabla_a_libro
+)
+
 if not os.path.exists("registros_guardados"):
     os.makedirs("registros_guardados")
 
@@ -17,42 +28,6 @@ if not os.path.exists("registros_guardados"):
 
 
 
-# --- Función FIFO para calcular ganancias por activo ---
-def calcular_ganancias_fifo(transacciones):
-    """
-    transacciones: DataFrame con columnas ['tipo', 'cantidad', 'precio_unitario', 'fecha']
-    tipo = 'compra' o 'venta'
-    Retorna DataFrame con filas de ventas y ganancia/pérdida por fila.
-    """
-    lotes_compra = []
-    resultados = []
-
-    for i, fila in transacciones.iterrows():
-        tipo = fila['tipo']
-        cant = fila['cantidad']
-        precio = fila['precio_unitario']
-        fecha = fila['fecha']
-
-        if tipo == 'compra':
-            lotes_compra.append({'cantidad': cant, 'precio': precio})
-        elif tipo == 'venta':
-            cant_venta = cant
-            ganancia = 0
-            while cant_venta > 0 and lotes_compra:
-                lote = lotes_compra[0]
-                if lote['cantidad'] <= cant_venta:
-                    cantidad_vendida = lote['cantidad']
-                    ganancia += cantidad_vendida * (precio - lote['precio'])
-                    cant_venta -= cantidad_vendida
-                    lotes_compra.pop(0)
-                else:
-                    cantidad_vendida = cant_venta
-                    ganancia += cantidad_vendida * (precio - lote['precio'])
-                    lote['cantidad'] -= cantidad_vendida
-                    cant_venta = 0
-            resultados.append({'fecha': fecha, 'cantidad_vendida': cant, 'precio_venta': precio, 'ganancia': ganancia})
-    return pd.DataFrame(resultados)
-
 # --- Inicializar dataframe en sesión ---
 if 'df_transacciones' not in st.session_state:
     st.session_state.df_transacciones = pd.DataFrame(columns=[
@@ -63,84 +38,17 @@ else:
         if col not in st.session_state.df_transacciones.columns:
             st.session_state.df_transacciones[col] = pd.NA
 
-st.title("Portafolio de Inversiones")
-
-
-# Función para calcular posición actual y precio medio FIFO de posición abierta
-def calcular_posicion_y_precio_medio_fifo(transacciones):
-    lotes_compra = []
-
-    for _, fila in transacciones.iterrows():
-        tipo = fila['tipo']
-        cant = fila['cantidad']
-        precio = fila['precio_unitario']
-
-        if tipo == 'compra':
-            lotes_compra.append({'cantidad': cant, 'precio': precio})
-        elif tipo == 'venta':
-            cant_venta = cant
-            while cant_venta > 0 and lotes_compra:
-                lote = lotes_compra[0]
-                if lote['cantidad'] <= cant_venta:
-                    cant_venta -= lote['cantidad']
-                    lotes_compra.pop(0)
-                else:
-                    lote['cantidad'] -= cant_venta
-                    cant_venta = 0
-
-    posicion = sum(l['cantidad'] for l in lotes_compra)
-
-    if posicion > 0:
-        precio_medio = sum(l['cantidad'] * l['precio'] for l in lotes_compra) / posicion
-    else:
-        precio_medio = 0
-
-    return posicion, precio_medio
-
-
-### OBTENER PRECIO ACTUAL
-
-def obtener_precio_actual(ticker):
-    import yfinance as yf
-    try:
-        # Intentar directo
-        datos = yf.Ticker(ticker)
-        hist = datos.history(period="1d")
-        if not hist.empty:
-            return hist['Close'][-1]
-        
-        # Si no hay datos, probar con sufijo USD (para cripto)
-        datos = yf.Ticker(ticker + '-USD')
-        hist = datos.history(period="1d")
-        if not hist.empty:
-            return hist['Close'][-1]
-        
-        return None
-    except Exception as e:
-        st.error(f"Error obteniendo precio para {ticker}: {e}")
-        return None
-
-
-equivalencias_yf = {
-    'PHAG': 'PHAG.AS',       # WisdomTree Physical Silver - Amsterdam (EUR)
-    'IGLN': 'IGLN.L',        # iShares Physical Gold ETC - Amsterdam (EUR)
-    'BTC': 'BTC-EUR',        # Bitcoin en EUR
-    'ETH': 'ETH-EUR',        # Ethereum en EUR
-    'SOL': 'SOL-EUR',        # Solana en EUR
-    'ADA': 'ADA-EUR',        # Cardano en EUR
-    'XRP': 'XRP-EUR',        # Ripple en EUR
-    'DOT': 'DOT-EUR',        # Polkadot en EUR
-    'VET': 'VET-EUR',        # VeChain en EUR
-    'LINK': 'LINK-EUR',      # Chainlink en EUR
-    'SHIB': 'SHIB-EUR',      # Shiba Inu en EUR
-    'COTI': 'COTI-EUR',      # COTI en EUR
-    'BNB': 'BNB-EUR',        # Binance Coin en EUR
-    'LTC': 'LTC-EUR',        # Litecoin en EUR
-}
-
-
+# --- Estado FIFO incremental por activo ---
+if 'estado_fifo' not in st.session_state:
+    st.session_state.estado_fifo = EstadoFIFO.desde_libro(
+        st.session_state.df_transacciones, escala=ESCALA_CANTIDAD
+    )
 
+# --- Libro en SQLite para las consultas por activo, tipo de activo y año ---
+if 'libro_sqlite' not in st.session_state:
+    st.session_state.libro_sqlite = LibroTransacciones.desde_libro(st.session_state.df_transacciones)
 
+st.title("Portafolio de Inversiones")
 
 
 # Crear tabs
@@ -169,6 +77,10 @@ with tab1:
     if 'registro_actual' not in st.session_state:
         st.session_state.registro_actual = None
 
+    # Diario de altas y bajas del registro cargado: cada cambio se guarda al momento
+    if 'diario' not in st.session_state:
+        st.session_state.diario = None
+
     # === Formulario manual ===
     st.markdown("### Añadir transacción manualmente")
     with st.form('form_transaccion', clear_on_submit=True):
@@ -209,6 +121,10 @@ with tab1:
                     [st.session_state.df_transacciones, pd.DataFrame([nueva_fila])],
                     ignore_index=True
                 )
+                st.session_state.estado_fifo.añadir(len(st.session_state.df_transacciones) - 1, nueva_fila)
+                st.session_state.libro_sqlite.añadir_libro(st.session_state.df_transacciones.iloc[-1:])
+                if st.session_state.diario is not None:
+                    st.session_state.diario.anotar_altas(st.session_state.df_transacciones.iloc[-1:])
                 st.success('Transacción añadida correctamente.')
     
     st.divider()
@@ -225,51 +141,36 @@ with tab1:
         st.session_state.archivo_procesado = False
     
     if uploaded_file is not None and not st.session_state.archivo_procesado:
+        # Lectura por bloques: cada bloque se convierte y se añade al estado FIFO, al libro SQLite
+        # y al diario según llega, y se concatena al DataFrame de la sesión sin guardar los bloques
+        num_previas = len(st.session_state.df_transacciones)
+        num_importadas = 0
+        progreso = st.progress(0.0, text="Importando transacciones...")
         try:
-            if uploaded_file.name.endswith('.csv'):
-                df_cargado = pd.read_csv(uploaded_file)
-            else:
-                df_cargado = pd.read_excel(uploaded_file)
-
-            # Normalización de columnas
             columnas_necesarias = ['activo', 'tipo', 'cantidad', 'precio_unitario', 'fecha', 'tipo_activo']
-            columnas_actuales = df_cargado.columns.str.lower().tolist()
-
-            mapping_columnas = {}
-            for col in columnas_necesarias:
-                for c in columnas_actuales:
-                    if col in c:
-                        mapping_columnas[c] = col
-            df_cargado.rename(columns=mapping_columnas, inplace=True)
-
-            faltantes = [c for c in columnas_necesarias if c not in df_cargado.columns]
-            if faltantes:
-                st.error(f"Faltan columnas necesarias: {faltantes}")
-            else:
-                # Conversión y limpieza
-                df_cargado['cantidad'] = pd.to_numeric(df_cargado['cantidad'], errors='coerce')
-                df_cargado['precio_unitario'] = pd.to_numeric(df_cargado['precio_unitario'], errors='coerce')
-                df_cargado['fecha'] = pd.to_datetime(df_cargado['fecha'], errors='coerce')
-                df_cargado['activo'] = df_cargado['activo'].astype(str)
-                df_cargado['tipo_activo'] = df_cargado['tipo_activo'].astype(str)
-                df_cargado['tipo'] = df_cargado['tipo'].str.lower().replace({'buy': 'compra', 'sell': 'venta'})
-
-                if 'tipo_activo' not in df_cargado.columns:
-                    df_cargado['tipo_activo'] = 'Otro'
-
-                df_cargado.dropna(subset=columnas_necesarias, inplace=True)
-
-                # Insertar en sesión
+            for bloque, leido in importar_por_bloques(uploaded_file, columnas_necesarias):
+                inicio = num_previas + num_importadas
+                bloque.index = pd.RangeIndex(inicio, inicio + len(bloque))
+                st.session_state.estado_fifo.añadir_libro(bloque)
+                st.session_state.libro_sqlite.añadir_libro(bloque)
+                if st.session_state.diario is not None:
+                    st.session_state.diario.anotar_altas(bloque)
                 st.session_state.df_transacciones = pd.concat(
-                    [st.session_state.df_transacciones, df_cargado],
-                    ignore_index=True
+                    [st.session_state.df_transacciones, bloque], ignore_index=True
                 )
+                num_importadas += len(bloque)
+                progreso.progress(leido, text=f"{num_importadas} transacciones importadas...")
 
-                st.session_state.archivo_procesado = True  # Marcar como procesado
-                st.success(f"{len(df_cargado)} transacciones importadas correctamente.")
+            st.session_state.archivo_procesado = True  # Marcar como procesado
+            st.success(f"{num_importadas} transacciones importadas correctamente.")
 
         except Exception as e:
             st.error(f"Error al procesar el archivo: {e}")
+        finally:
+            # Lo importado antes de un error se queda: ya está en el libro, el estado FIFO y el diario
+            if num_importadas:
+                st.session_state.archivo_procesado = True  # Marcar como procesado
+            progreso.empty()
     
     st.divider()
     
@@ -280,8 +181,8 @@ with tab1:
     if not os.path.exists("registros_guardados"):
         os.makedirs("registros_guardados")
 
-    # Listar registros guardados (archivos .xlsx)
-    archivos_registros = [f for f in os.listdir("registros_guardados") if f.endswith(".xlsx")]
+    # Listar registros guardados (Parquet; los .xlsx antiguos se convierten al cargarlos)
+    archivos_registros = listar_registros()
 
     # --- 1. Cargar registros guardados ---
     registro_seleccionado = st.selectbox(
@@ -294,10 +195,13 @@ with tab1:
     if registro_seleccionado:
         if 'registro_actual' not in st.session_state or st.session_state.registro_actual != registro_seleccionado:
             try:
-                df_cargado = pd.read_excel(f"registros_guardados/{registro_seleccionado}")
-                df_cargado['fecha'] = pd.to_datetime(df_cargado['fecha'], errors='coerce')
-                df_cargado = df_cargado.dropna(subset=['fecha']).reset_index(drop=True)
+                # El FIFO se calcula sobre el libro mapeado; el DataFrame es solo para las vistas editables
+                tabla = mapear_registro(registro_seleccionado)
+                df_cargado = tabla_a_libro(tabla)
                 st.session_state.df_transacciones = df_cargado
+                st.session_state.estado_fifo = EstadoFIFO.desde_libro(tabla, escala=ESCALA_CANTIDAD)
+                st.session_state.libro_sqlite = LibroTransacciones.desde_libro(df_cargado)
+                st.session_state.diario = DiarioRegistro(registro_seleccionado)
                 st.session_state.registro_actual = registro_seleccionado
                 st.success(f"Registro {registro_seleccionado} cargado correctamente.")
             except Exception as e:
@@ -305,7 +209,7 @@ with tab1:
 
     st.divider()
 
-    # --- 2. Guardar registro actual como Excel ---
+    # --- 2. Guardar registro actual (Parquet) o exportarlo a Excel ---
     st.markdown("#### Guardar Portafolio")
 
     nombre_guardado = st.text_input("Nombre del archivo de registro (sin extensión)", value="Registro1")
@@ -314,15 +218,30 @@ with tab1:
         if not nombre_guardado.strip():
             st.error("Introduce un nombre de archivo válido para guardar el registro.")
         else:
-            ruta_guardado = f"registros_guardados/{nombre_guardado.strip()}.xlsx"
             try:
-                st.session_state.df_transacciones.to_excel(ruta_guardado, index=False)
-                st.success(f"Registro guardado correctamente en {ruta_guardado}.")
+                if st.session_state.diario is not None and nombre_guardado.strip() == st.session_state.registro_actual:
+                    # Los cambios ya están en el diario: el Parquet solo se reescribe al compactarlo
+                    st.session_state.diario.compactar_si_toca(st.session_state.df_transacciones)
+                    st.success(f"Registro {nombre_guardado.strip()} guardado correctamente.")
+                else:
+                    ruta_guardado = guardar_registro(st.session_state.df_transacciones, nombre_guardado.strip())
+                    if nombre_guardado.strip() == st.session_state.registro_actual:
+                        st.session_state.diario = DiarioRegistro(nombre_guardado.strip())
+                    st.success(f"Registro guardado correctamente en {ruta_guardado}.")
                 # Actualizar lista de archivos luego de guardar
-                archivos_registros = [f for f in os.listdir("registros_guardados") if f.endswith(".xlsx")]
+                archivos_registros = listar_registros()
             except Exception as e:
                 st.error(f"Error al guardar el registro: {e}")
 
+    # El Excel solo se genera cuando se pide: con libros grandes es lo más lento de guardar
+    if st.button("Exportar a Excel"):
+        st.download_button(
+            "Descargar Excel",
+            data=exportar_excel(st.session_state.df_transacciones),
+            file_name=f"{nombre_guardado.strip() or 'Registro'}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
+
     st.divider()
 
     # --- 3. Eliminar registros guardados ---
@@ -337,9 +256,10 @@ with tab1:
             if registros_a_eliminar:
                 errores = []
                 for archivo in registros_a_eliminar:
-                    ruta = os.path.join("registros_guardados", archivo)
                     try:
-                        os.remove(ruta)
+                        eliminar_registro(archivo)
+                        if archivo == st.session_state.registro_actual:
+                            st.session_state.diario = None
                     except Exception as e:
                         errores.append(f"{archivo}: {e}")
                 if errores:
@@ -347,7 +267,7 @@ with tab1:
                 else:
                     st.success(f"Eliminados {len(registros_a_eliminar)} registros correctamente.")
                 # Actualizar lista tras eliminación
-                archivos_registros = [f for f in os.listdir("registros_guardados") if f.endswith(".xlsx")]
+                archivos_registros = listar_registros()
             else:
                 st.warning("Selecciona al menos un registro para eliminar.")
     else:
@@ -376,10 +296,22 @@ with tab1:
         
         if st.button("Eliminar transacciones seleccionadas"):
             if filas_a_eliminar:
-                st.session_state.df_transacciones = st.session_state.df_transacciones.drop(
-                    index=[int(i) for i in filas_a_eliminar]
-                ).reset_index(drop=True)
-                st.success(f"Eliminadas {len(filas_a_eliminar)} transacciones.")
+                ids_eliminar = [int(i) for i in filas_a_eliminar]
+                try:
+                    # Primero el diario: si otra sesión ha cambiado el registro la baja se rechaza sin tocar nada
+                    if st.session_state.diario is not None:
+                        st.session_state.diario.anotar_bajas(ids_eliminar)
+                except ValueError as e:
+                    st.error(str(e))
+                else:
+                    st.session_state.estado_fifo.eliminar(
+                        ids_eliminar, st.session_state.df_transacciones.loc[ids_eliminar, 'activo'].unique()
+                    )
+                    st.session_state.libro_sqlite.eliminar(ids_eliminar)
+                    st.session_state.df_transacciones = st.session_state.df_transacciones.drop(
+                        index=ids_eliminar
+                    ).reset_index(drop=True)
+                    st.success(f"Eliminadas {len(filas_a_eliminar)} transacciones.")
             else:
                 st.warning("Selecciona al menos una transacción para eliminar.")
     else:
@@ -394,6 +326,32 @@ with tab1:
 
 
 
+# --- Estado FIFO compartido por todas las ventanas ---
+# Solo se rehacen los activos con filas retrasadas o eliminadas desde la última ejecución
+st.session_state.estado_fifo.sincronizar(st.session_state.df_transacciones)
+resultado_fifo = st.session_state.estado_fifo.resultado()
+if len(st.session_state.libro_sqlite) != len(st.session_state.df_transacciones):
+    st.session_state.libro_sqlite = LibroTransacciones.desde_libro(st.session_state.df_transacciones)
+libro_sqlite = st.session_state.libro_sqlite
+# El diario del registro cargado se vuelca al Parquet cuando acumula demasiadas operaciones
+if st.session_state.get('diario') is not None:
+    st.session_state.diario.compactar_si_toca(st.session_state.df_transacciones)
+
+
+# --- Precios actuales: instantánea del hilo de refresco en segundo plano ---
+# Ninguna ventana espera a la red: se leen los últimos precios publicados y su hora
+if not st.session_state.df_transacciones.empty:
+    refresco_precios.seguir(st.session_state.df_transacciones['activo'].dropna().unique())
+precios_actuales, precios_fallidos, precios_actualizados = refresco_precios.instantanea()
+# Cotizaciones en otras divisas (IGLN.L en USD, bolsa de Londres en peniques...) al tipo actual
+precios_actuales = precios_en_base(precios_actuales)
+
+# Modo en vivo: los paneles de precios se re-ejecutan solos cada pocos segundos como fragmentos,
+# sin repetir el resto del script (lectura de datos y FIFO)
+en_vivo = st.session_state.get('precios_en_vivo', False)
+segundos_en_vivo = st.session_state.get('segundos_en_vivo', 15) if en_vivo else None
+
+
 # --- Segunda ventana: Precios actuales ---
 
 with tab2:
@@ -402,26 +360,36 @@ with tab2:
     if not st.session_state.df_transacciones.empty:
         activos_unicos = st.session_state.df_transacciones['activo'].dropna().unique()
 
-        precios = []
-        precios_dict = {}
-
-        for activo in activos_unicos:
-            ticker_yf = equivalencias_yf.get(activo.upper(), activo)
-            precio_actual = obtener_precio_actual(ticker_yf)
-
-            precios.append({
-                'Activo': activo,
-                'Precio actual (€)': precio_actual if precio_actual is not None else "No disponible"
-            })
-
-            if precio_actual is not None:
-                precios_dict[activo] = precio_actual
-
-        # Guardamos en sesión para reutilizar
-        st.session_state.precios_actuales = precios_dict
+        col_vivo, col_segundos = st.columns(2)
+        col_vivo.toggle("Modo en vivo", key='precios_en_vivo')
+        col_segundos.number_input("Actualizar cada (segundos)", min_value=5, value=15, step=5,
+                                  key='segundos_en_vivo', disabled=not en_vivo)
+        if not en_vivo and st.button("🔄 Actualizar precios"):
+            refresco_precios.refrescar_ahora()
+
+        @st.fragment(run_every=segundos_en_vivo)
+        def panel_precios():
+            precios, fallidos, actualizados = refresco_precios.instantanea()
+            precios = precios_en_base(precios)
+            if en_vivo:
+                # La caché evita pedir a la red lo que aún está vigente
+                refresco_precios.refrescar_ahora()
+            st.dataframe(pd.DataFrame({
+                'Activo': activos_unicos,
+                'Precio actual (€)': [
+                    precios[a] if a in precios
+                    else f"No disponible ({fallidos[a]})" if a in fallidos
+                    else "Cargando..."
+                    for a in activos_unicos
+                ]
+            }))
+            if actualizados is not None:
+                st.caption(f"Precios de las {actualizados:%H:%M:%S}; se actualizan cada "
+                           f"{segundos_en_vivo or refresco_precios.intervalo} s en segundo plano.")
+            else:
+                st.caption("Cargando precios en segundo plano...")
 
-        df_precios = pd.DataFrame(precios)
-        st.dataframe(df_precios)
+        panel_precios()
 
     else:
         st.info("No tienes activos registrados para consultar precios actuales.")
@@ -436,110 +404,47 @@ with tab3:
     if st.session_state.df_transacciones.empty:
         st.info("No tienes transacciones registradas.")
     else:
-        if "precios_actuales" not in st.session_state:
-            st.warning("Primero accede a la ventana 'Precios actuales' para cargar los precios en tiempo real.")
-        else:
-            import plotly.express as px
-
-            activos = st.session_state.df_transacciones['activo'].dropna().unique()
-            resumen = []
-
-            for activo in activos:
-                df_activo = st.session_state.df_transacciones[
-                    st.session_state.df_transacciones['activo'] == activo
-                ].sort_values('fecha')
-
-                # FIFO para lotes abiertos
-                lotes_abiertos = []
-                for _, fila in df_activo.iterrows():
-                    tipo = fila['tipo']
-                    cantidad = fila['cantidad']
-                    precio = fila['precio_unitario']
-                    if tipo == 'compra':
-                        lotes_abiertos.append({'cantidad': cantidad, 'precio': precio})
-                    elif tipo == 'venta':
-                        cantidad_vender = cantidad
-                        while cantidad_vender > 0 and lotes_abiertos:
-                            lote = lotes_abiertos[0]
-                            if lote['cantidad'] <= cantidad_vender:
-                                cantidad_vender -= lote['cantidad']
-                                lotes_abiertos.pop(0)
-                            else:
-                                lote['cantidad'] -= cantidad_vender
-                                cantidad_vender = 0
-
-                posicion_abierta = sum(l['cantidad'] for l in lotes_abiertos)
-                precio_medio_compra = (
-                    sum(l['cantidad'] * l['precio'] for l in lotes_abiertos) / posicion_abierta
-                    if posicion_abierta > 0 else 0
-                )
-                valor_compra = posicion_abierta * precio_medio_compra
-
-                # Ganancias realizadas FIFO
-                lotes_fifo = []
-                ganancia_realizada = 0
-                total_vendido = 0
-                suma_precio_venta_pesada = 0
-
-                for _, fila in df_activo.iterrows():
-                    tipo = fila['tipo']
-                    cantidad = fila['cantidad']
-                    precio = fila['precio_unitario']
-                    if tipo == 'compra':
-                        lotes_fifo.append({'cantidad': cantidad, 'precio': precio})
-                    elif tipo == 'venta':
-                        cantidad_vender = cantidad
-                        total_vendido += cantidad
-                        suma_precio_venta_pesada += cantidad * precio
-                        while cantidad_vender > 0 and lotes_fifo:
-                            lote = lotes_fifo[0]
-                            cantidad_usada = min(lote['cantidad'], cantidad_vender)
-                            ganancia_realizada += cantidad_usada * (precio - lote['precio'])
-                            lote['cantidad'] -= cantidad_usada
-                            cantidad_vender -= cantidad_usada
-                            if lote['cantidad'] == 0:
-                                lotes_fifo.pop(0)
-
-                precio_actual = st.session_state.precios_actuales.get(activo, None)
-                valor_actual = precio_actual * posicion_abierta if precio_actual is not None else None
-                pnl_no_realizado = (precio_actual - precio_medio_compra) * posicion_abierta if precio_actual else None
-
-                # Inversión en ventas
-                compras_fifo = []
-                for _, r in df_activo[df_activo['tipo'] == 'compra'].sort_values('fecha').iterrows():
-                    compras_fifo.append({'cantidad': r['cantidad'], 'precio': r['precio_unitario']})
-
-                cantidad_a_calcular = total_vendido
-                inversion_ventas = 0
-                while cantidad_a_calcular > 0 and compras_fifo:
-                    lote = compras_fifo[0]
-                    usar = min(lote['cantidad'], cantidad_a_calcular)
-                    inversion_ventas += usar * lote['precio']
-                    lote['cantidad'] -= usar
-                    cantidad_a_calcular -= usar
-                    if lote['cantidad'] == 0:
-                        compras_fifo.pop(0)
-
-                balance = ganancia_realizada + (pnl_no_realizado if pnl_no_realizado is not None else 0)
-
-                resumen.append({
-                    "Activo": activo,
-                    "Posición Abierta": round(posicion_abierta, 8),
-                    "Precio Medio Compra (€)": precio_medio_compra,
-                    "Valor Compra (€)": valor_compra,
-                    "Valor Actual (€)": valor_actual if valor_actual is not None else 0,
-                    "PNL No Realizado (€)": pnl_no_realizado if pnl_no_realizado is not None else 0,
-                    "Unidades Vendidas": round(total_vendido, 8),
-                    "Inversión en Ventas (€)": inversion_ventas,
-                    "Ingreso por Ventas (€)": suma_precio_venta_pesada,
-                    "Ganancia/Pérdida Realizada (€)": ganancia_realizada,
-                    "Balance (€)": balance,
-                })
-
-            df_resumen = pd.DataFrame(resumen)
-
-            st.markdown("### Resumen de Posición")
-            st.dataframe(df_resumen.style.format({
+        if precios_actualizados is None:
+            st.info("Cargando precios en segundo plano: el valor actual de cada activo aparecerá en cuanto llegue su precio.")
+        import plotly.express as px
+
+        resumen_fifo = resultado_fifo.resumen
+
+        posicion_abierta = resumen_fifo['posicion']
+        precio_medio_compra = resumen_fifo['precio_medio']
+
+        def valorar(precios):
+            """Valor Actual y PNL No Realizado: lo único que cambia cuando llegan precios nuevos."""
+            precio_actual = resumen_fifo['activo'].map(precios)
+            valor_actual = (precio_actual * posicion_abierta).fillna(0)
+            pnl_no_realizado = ((precio_actual - precio_medio_compra) * posicion_abierta).fillna(0)
+            return valor_actual, pnl_no_realizado
+
+        valor_actual, pnl_no_realizado = valorar(precios_actuales)
+
+        df_resumen = pd.DataFrame({
+            "Activo": resumen_fifo['activo'],
+            "Posición Abierta": posicion_abierta.round(8),
+            "Precio Medio Compra (€)": precio_medio_compra,
+            "Valor Compra (€)": posicion_abierta * precio_medio_compra,
+            "Valor Actual (€)": valor_actual,
+            "PNL No Realizado (€)": pnl_no_realizado,
+            "Unidades Vendidas": resumen_fifo['unidades_vendidas'].round(8),
+            "Inversión en Ventas (€)": resumen_fifo['inversion_ventas'],
+            "Ingreso por Ventas (€)": resumen_fifo['ingreso_ventas'],
+            "Ganancia/Pérdida Realizada (€)": resumen_fifo['ganancia_realizada'],
+            "Balance (€)": resumen_fifo['ganancia_realizada'] + pnl_no_realizado,
+        })
+
+        @st.fragment(run_every=segundos_en_vivo)
+        def tabla_resumen_posicion():
+            df = df_resumen
+            if en_vivo:
+                # Solo se recalculan las columnas de valoración con la última instantánea de precios
+                df = df_resumen.copy()
+                df["Valor Actual (€)"], df["PNL No Realizado (€)"] = valorar(precios_en_base(refresco_precios.instantanea()[0]))
+                df["Balance (€)"] = df["Ganancia/Pérdida Realizada (€)"] + df["PNL No Realizado (€)"]
+            st.dataframe(df.style.format({
                 "Precio Medio Compra (€)": "€{:.2f}",
                 "Valor Compra (€)": "€{:.2f}",
                 "Valor Actual (€)": "€{:.2f}",
@@ -550,247 +455,250 @@ with tab3:
                 "Balance (€)": "€{:.2f}"
             }), use_container_width=True)
 
-            st.divider()
-            
-            
+        st.markdown("### Resumen de Posición")
+        tabla_resumen_posicion()
 
-            # --- Resumen Global ---
-            st.markdown("### Visualización de tu cartera")
-            
-            # --- Tabla Resumen Avanzada: Posiciones Abiertas, Cerradas y Global por Activo ---
-            
-            st.markdown("### 📊 Resumen de Posiciones Abiertas, Cerradas y Global")
-            
-            # --- Crear dataframe resumen avanzado ---
-            tabla_resumen = []
-            
-            for idx, row in df_resumen.iterrows():
-                activo = row["Activo"]
-            
-                # Posición Abierta
-                pa = row["PNL No Realizado (€)"] if row["Posición Abierta"] > 0 else 0
-            
-                # Posición Cerrada
-                pc = row["Ganancia/Pérdida Realizada (€)"]
-            
-                # Posición Global
-                pg = pa + pc
-            
-                tabla_resumen.append({
-                    "Activo": activo,
-                    "Posiciones abiertas (€)": pa,
-                    "Posiciones cerradas (€)": pc,
-                    "Posición global (€)": pg
-                })
-            
-            df_tabla_resumen = pd.DataFrame(tabla_resumen)
-            
-            # Añadir fila Total
-            fila_total = {
-                "Activo": "TOTAL",
-                "Posiciones abiertas (€)": df_tabla_resumen["Posiciones abiertas (€)"].sum(),
-                "Posiciones cerradas (€)": df_tabla_resumen["Posiciones cerradas (€)"].sum(),
-                "Posición global (€)": df_tabla_resumen["Posición global (€)"].sum(),
-            }
-            df_tabla_resumen = pd.concat([df_tabla_resumen, pd.DataFrame([fila_total])], ignore_index=True)
-            
-            
-            # Mostrar tabla numérica limpia y coloreada
-            st.dataframe(
-                df_tabla_resumen.style
-                .format({"Posiciones abiertas (€)": "€{:.2f}",
-                         "Posiciones cerradas (€)": "€{:.2f}",
-                         "Posición global (€)": "€{:.2f}"})
-                .applymap(lambda v: 'background-color: #d4f7d4' if v > 0 else ('background-color: #f7d4d4' if v < 0 else ''),
-                          subset=["Posiciones abiertas (€)", "Posiciones cerradas (€)", "Posición global (€)"]),
-                use_container_width=True
-            )
+        st.divider()
+        
+        
 
-            st.write("")
-            st.write("")
-            st.write("")
-            st.write("")
-            
-            # --- Gráfico de barras agrupadas ---
-            
-            # Lista de todos los activos disponibles
-            activos_todos = df_tabla_resumen["Activo"].tolist()
-            
-            # Multiselect para que el usuario elija activos a mostrar
-            activos_seleccionados = st.multiselect(
-                "Selecciona los activos para mostrar en el gráfico",
-                options=activos_todos,
-                default=activos_todos[:5]  # Mostrar por defecto los primeros 5 activos (puedes cambiar este número)
-            )
-            
-            # Filtrar solo los activos seleccionados
-            df_filtrado = df_tabla_resumen[df_tabla_resumen["Activo"].isin(activos_seleccionados)]
-            
-            # Extraer listas para el gráfico
-            activos = df_filtrado["Activo"].tolist()
-            abiertas = df_filtrado["Posiciones abiertas (€)"].tolist()
-            cerradas = df_filtrado["Posiciones cerradas (€)"].tolist()
-            globales = df_filtrado["Posición global (€)"].tolist()
-            
-            # Crear gráfico
-            fig_barras = go.Figure()
-            
-            fig_barras.add_trace(go.Bar(
-                x=activos,
-                y=abiertas,
-                name="Posiciones abiertas",
-                marker_color="#4A90E2"  # azul claro
-            ))
-            
-            fig_barras.add_trace(go.Bar(
-                x=activos,
-                y=cerradas,
-                name="Posiciones cerradas",
-                marker_color="#F5A623"  # naranja
-            ))
-            
-            fig_barras.add_trace(go.Bar(
-                x=activos,
-                y=globales,
-                name="Posición global",
-                marker_color="#A3C686"
-            ))
-            
-            fig_barras.update_layout(
-                title="📊 Resumen de Resultados por Activo",
-                xaxis_title="Activo",
-                yaxis_title="Saldo (€)",
-                barmode='group',
-                plot_bgcolor="rgba(0,0,0,0)",
-                paper_bgcolor="rgba(0,0,0,0)",
-                legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="center", x=0.5)
-            )
-            
-            st.plotly_chart(fig_barras, use_container_width=True)
-            
-            
-            # --- Nueva tabla solo con ROI ---
-            roi_tabla = []
-            
-            for idx, row in df_resumen.iterrows():
-                activo = row["Activo"]
-                pa = row["PNL No Realizado (€)"] if row["Posición Abierta"] > 0 else 0
-                pc = row["Ganancia/Pérdida Realizada (€)"]
-                pg = pa + pc
-            
-                valor_compra = row["Valor Compra (€)"]
-                inversion_ventas = row["Inversión en Ventas (€)"]
-                inversion_total = valor_compra + inversion_ventas
-            
-                roi_abierto = (pa / valor_compra * 100) if valor_compra != 0 else 0
-                roi_cerrado = (pc / inversion_ventas * 100) if inversion_ventas != 0 else 0
-                roi_global = (pg / inversion_total * 100) if inversion_total != 0 else 0
-            
-                roi_tabla.append({
-                    "Activo": activo,
-                    "ROI abierto (%)": roi_abierto,
-                    "ROI cerrado (%)": roi_cerrado,
-                    "ROI global (%)": roi_global
-                })
-            
-            df_roi = pd.DataFrame(roi_tabla)
-            
-            # Fila total
-            fila_total = {
-                "Activo": "TOTAL",
-                "ROI abierto (%)": (df_tabla_resumen["Posiciones abiertas (€)"].sum() /
-                                    df_resumen["Valor Compra (€)"].sum() * 100) if df_resumen["Valor Compra (€)"].sum() != 0 else 0,
-                "ROI cerrado (%)": (df_tabla_resumen["Posiciones cerradas (€)"].sum() /
-                                     df_resumen["Inversión en Ventas (€)"].sum() * 100) if df_resumen["Inversión en Ventas (€)"].sum() != 0 else 0,
-                "ROI global (%)": (df_tabla_resumen["Posición global (€)"].sum() /
-                                    (df_resumen["Valor Compra (€)"].sum() + df_resumen["Inversión en Ventas (€)"].sum()) * 100) if (df_resumen["Valor Compra (€)"].sum() + df_resumen["Inversión en Ventas (€)"].sum()) != 0 else 0,
-            }
-            df_roi = pd.concat([df_roi, pd.DataFrame([fila_total])], ignore_index=True)
-            
-            # Mostrar tabla
-            st.markdown("### 📈 Tabla de ROI por Activo")
-            
-            st.dataframe(
-                df_roi.style
-                .format({
-                    "ROI abierto (%)": "{:.2f}%",
-                    "ROI cerrado (%)": "{:.2f}%",
-                    "ROI global (%)": "{:.2f}%"
-                })
-                .set_table_styles([
-                    {"selector": "th", "props": [("text-align", "center"), ("font-size", "12px")]},
-                    {"selector": "td", "props": [("text-align", "center"), ("font-size", "12px"), ("padding", "6px")]}
-                ])
-                .applymap(lambda v: 'background-color: #d4f7d4' if isinstance(v, (int, float)) and v > 0 else
-                                     ('background-color: #f7d4d4' if isinstance(v, (int, float)) and v < 0 else ''),
-                           subset=["ROI abierto (%)", "ROI cerrado (%)", "ROI global (%)"]),
-                use_container_width=True
-            )
+        # --- Resumen Global ---
+        st.markdown("### Visualización de tu cartera")
+        
+        # --- Tabla Resumen Avanzada: Posiciones Abiertas, Cerradas y Global por Activo ---
+        
+        st.markdown("### 📊 Resumen de Posiciones Abiertas, Cerradas y Global")
+        
+        # --- Crear dataframe resumen avanzado ---
+        tabla_resumen = []
+        
+        for idx, row in df_resumen.iterrows():
+            activo = row["Activo"]
+        
+            # Posición Abierta
+            pa = row["PNL No Realizado (€)"] if row["Posición Abierta"] > 0 else 0
+        
+            # Posición Cerrada
+            pc = row["Ganancia/Pérdida Realizada (€)"]
+        
+            # Posición Global
+            pg = pa + pc
+        
+            tabla_resumen.append({
+                "Activo": activo,
+                "Posiciones abiertas (€)": pa,
+                "Posiciones cerradas (€)": pc,
+                "Posición global (€)": pg
+            })
+        
+        df_tabla_resumen = pd.DataFrame(tabla_resumen)
+        
+        # Añadir fila Total
+        fila_total = {
+            "Activo": "TOTAL",
+            "Posiciones abiertas (€)": df_tabla_resumen["Posiciones abiertas (€)"].sum(),
+            "Posiciones cerradas (€)": df_tabla_resumen["Posiciones cerradas (€)"].sum(),
+            "Posición global (€)": df_tabla_resumen["Posición global (€)"].sum(),
+        }
+        df_tabla_resumen = pd.concat([df_tabla_resumen, pd.DataFrame([fila_total])], ignore_index=True)
+        
+        
+        # Mostrar tabla numérica limpia y coloreada
+        st.dataframe(
+            df_tabla_resumen.style
+            .format({"Posiciones abiertas (€)": "€{:.2f}",
+                     "Posiciones cerradas (€)": "€{:.2f}",
+                     "Posición global (€)": "€{:.2f}"})
+            .applymap(lambda v: 'background-color: #d4f7d4' if v > 0 else ('background-color: #f7d4d4' if v < 0 else ''),
+                      subset=["Posiciones abiertas (€)", "Posiciones cerradas (€)", "Posición global (€)"]),
+            use_container_width=True
+        )
 
+        st.write("")
+        st.write("")
+        st.write("")
+        st.write("")
+        
+        # --- Gráfico de barras agrupadas ---
+        
+        # Lista de todos los activos disponibles
+        activos_todos = df_tabla_resumen["Activo"].tolist()
+        
+        # Multiselect para que el usuario elija activos a mostrar
+        activos_seleccionados = st.multiselect(
+            "Selecciona los activos para mostrar en el gráfico",
+            options=activos_todos,
+            default=activos_todos[:5]  # Mostrar por defecto los primeros 5 activos (puedes cambiar este número)
+        )
+        
+        # Filtrar solo los activos seleccionados
+        df_filtrado = df_tabla_resumen[df_tabla_resumen["Activo"].isin(activos_seleccionados)]
+        
+        # Extraer listas para el gráfico
+        activos = df_filtrado["Activo"].tolist()
+        abiertas = df_filtrado["Posiciones abiertas (€)"].tolist()
+        cerradas = df_filtrado["Posiciones cerradas (€)"].tolist()
+        globales = df_filtrado["Posición global (€)"].tolist()
+        
+        # Crear gráfico
+        fig_barras = go.Figure()
+        
+        fig_barras.add_trace(go.Bar(
+            x=activos,
+            y=abiertas,
+            name="Posiciones abiertas",
+            marker_color="#4A90E2"  # azul claro
+        ))
+        
+        fig_barras.add_trace(go.Bar(
+            x=activos,
+            y=cerradas,
+            name="Posiciones cerradas",
+            marker_color="#F5A623"  # naranja
+        ))
+        
+        fig_barras.add_trace(go.Bar(
+            x=activos,
+            y=globales,
+            name="Posición global",
+            marker_color="#A3C686"
+        ))
+        
+        fig_barras.update_layout(
+            title="📊 Resumen de Resultados por Activo",
+            xaxis_title="Activo",
+            yaxis_title="Saldo (€)",
+            barmode='group',
+            plot_bgcolor="rgba(0,0,0,0)",
+            paper_bgcolor="rgba(0,0,0,0)",
+            legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="center", x=0.5)
+        )
+        
+        st.plotly_chart(fig_barras, use_container_width=True)
+        
+        
+        # --- Nueva tabla solo con ROI ---
+        roi_tabla = []
+        
+        for idx, row in df_resumen.iterrows():
+            activo = row["Activo"]
+            pa = row["PNL No Realizado (€)"] if row["Posición Abierta"] > 0 else 0
+            pc = row["Ganancia/Pérdida Realizada (€)"]
+            pg = pa + pc
+        
+            valor_compra = row["Valor Compra (€)"]
+            inversion_ventas = row["Inversión en Ventas (€)"]
+            inversion_total = valor_compra + inversion_ventas
+        
+            roi_abierto = (pa / valor_compra * 100) if valor_compra != 0 else 0
+            roi_cerrado = (pc / inversion_ventas * 100) if inversion_ventas != 0 else 0
+            roi_global = (pg / inversion_total * 100) if inversion_total != 0 else 0
+        
+            roi_tabla.append({
+                "Activo": activo,
+                "ROI abierto (%)": roi_abierto,
+                "ROI cerrado (%)": roi_cerrado,
+                "ROI global (%)": roi_global
+            })
+        
+        df_roi = pd.DataFrame(roi_tabla)
+        
+        # Fila total
+        fila_total = {
+            "Activo": "TOTAL",
+            "ROI abierto (%)": (df_tabla_resumen["Posiciones abiertas (€)"].sum() /
+                                df_resumen["Valor Compra (€)"].sum() * 100) if df_resumen["Valor Compra (€)"].sum() != 0 else 0,
+            "ROI cerrado (%)": (df_tabla_resumen["Posiciones cerradas (€)"].sum() /
+                                 df_resumen["Inversión en Ventas (€)"].sum() * 100) if df_resumen["Inversión en Ventas (€)"].sum() != 0 else 0,
+            "ROI global (%)": (df_tabla_resumen["Posición global (€)"].sum() /
+                                (df_resumen["Valor Compra (€)"].sum() + df_resumen["Inversión en Ventas (€)"].sum()) * 100) if (df_resumen["Valor Compra (€)"].sum() + df_resumen["Inversión en Ventas (€)"].sum()) != 0 else 0,
+        }
+        df_roi = pd.concat([df_roi, pd.DataFrame([fila_total])], ignore_index=True)
+        
+        # Mostrar tabla
+        st.markdown("### 📈 Tabla de ROI por Activo")
+        
+        st.dataframe(
+            df_roi.style
+            .format({
+                "ROI abierto (%)": "{:.2f}%",
+                "ROI cerrado (%)": "{:.2f}%",
+                "ROI global (%)": "{:.2f}%"
+            })
+            .set_table_styles([
+                {"selector": "th", "props": [("text-align", "center"), ("font-size", "12px")]},
+                {"selector": "td", "props": [("text-align", "center"), ("font-size", "12px"), ("padding", "6px")]}
+            ])
+            .applymap(lambda v: 'background-color: #d4f7d4' if isinstance(v, (int, float)) and v > 0 else
+                                 ('background-color: #f7d4d4' if isinstance(v, (int, float)) and v < 0 else ''),
+                       subset=["ROI abierto (%)", "ROI cerrado (%)", "ROI global (%)"]),
+            use_container_width=True
+        )
 
-            # --- Tabla resumen final con totales acumulados ---
 
-                        # --- Tabla resumen final con formato personalizado ---
-            
-            total_invertido_abiertas = df_resumen["Valor Compra (€)"].sum()
-            valor_actual_abiertas = df_resumen["Valor Actual (€)"].sum()
-            total_invertido_vendidas = df_resumen["Inversión en Ventas (€)"].sum()
-            total_recibido_ventas = df_resumen["Ingreso por Ventas (€)"].sum()
-            
-            saldo_neto_actual = total_recibido_ventas + valor_actual_abiertas
-            inversion_total = total_invertido_abiertas + total_invertido_vendidas
-            ganancia_perdida_neta = saldo_neto_actual - inversion_total
-            
-            tabla_final = [
-                {
-                    "Concepto": "**Total invertido en posiciones abiertas**",
-                    "Importe (€)": total_invertido_abiertas,
-                    "Descripción": "Dinero total gastado en activos que aún tienes en cartera (valor de compra)."
-                },
-                {
-                    "Concepto": "**Valor actual de posiciones abiertas**",
-                    "Importe (€)": valor_actual_abiertas,
-                    "Descripción": "Valor actual de mercado de los activos que tienes (usando precios actuales)."
-                },
-                {
-                    "Concepto": "**Total invertido en activos vendidos**",
-                    "Importe (€)": total_invertido_vendidas,
-                    "Descripción": "Dinero total gastado en los activos que ya vendiste (FIFO)."
-                },
-                {
-                    "Concepto": "**Total recibido por ventas**",
-                    "Importe (€)": total_recibido_ventas,
-                    "Descripción": "Dinero total que obtuviste por las ventas realizadas."
-                },
-                {
-                    "Concepto": "**Saldo neto actual**",
-                    "Importe (€)": saldo_neto_actual,
-                    "Descripción": "Total recibido por ventas + valor actual de posiciones abiertas."
-                },
-                {
-                    "Concepto": "**Inversión total realizada**",
-                    "Importe (€)": inversion_total,
-                    "Descripción": "Total invertido en posiciones abiertas + invertido en activos vendidos."
-                },
-                {
-                    "Concepto": "**Ganancia/pérdida neta**",
-                    "Importe (€)": ganancia_perdida_neta,
-                    "Descripción": "Saldo neto actual - inversión total realizada."
-                },
-            ]
-            
-            df_tabla_final = pd.DataFrame(tabla_final)
-            
-            # Mostrar la tabla con formato en Streamlit
-            st.markdown("### 📋 Resumen General de la Cartera")
-            
-            st.dataframe(
-                df_tabla_final.style.format({"Importe (€)": "€{:.2f}"}), 
-                use_container_width=True
-            )
+        # --- Tabla resumen final con totales acumulados ---
+
+                    # --- Tabla resumen final con formato personalizado ---
+        
+        total_invertido_abiertas = df_resumen["Valor Compra (€)"].sum()
+        valor_actual_abiertas = df_resumen["Valor Actual (€)"].sum()
+        total_invertido_vendidas = df_resumen["Inversión en Ventas (€)"].sum()
+        total_recibido_ventas = df_resumen["Ingreso por Ventas (€)"].sum()
+        
+        saldo_neto_actual = total_recibido_ventas + valor_actual_abiertas
+        inversion_total = total_invertido_abiertas + total_invertido_vendidas
+        ganancia_perdida_neta = saldo_neto_actual - inversion_total
+        
+        tabla_final = [
+            {
+                "Concepto": "**Total invertido en posiciones abiertas**",
+                "Importe (€)": total_invertido_abiertas,
+                "Descripción": "Dinero total gastado en activos que aún tienes en cartera (valor de compra)."
+            },
+            {
+                "Concepto": "**Valor actual de posiciones abiertas**",
+                "Importe (€)": valor_actual_abiertas,
+                "Descripción": "Valor actual de mercado de los activos que tienes (usando precios actuales)."
+            },
+            {
+                "Concepto": "**Total invertido en activos vendidos**",
+                "Importe (€)": total_invertido_vendidas,
+                "Descripción": "Dinero total gastado en los activos que ya vendiste (FIFO)."
+            },
+            {
+                "Concepto": "**Total recibido por ventas**",
+                "Importe (€)": total_recibido_ventas,
+                "Descripción": "Dinero total que obtuviste por las ventas realizadas."
+            },
+            {
+                "Concepto": "**Saldo neto actual**",
+                "Importe (€)": saldo_neto_actual,
+                "Descripción": "Total recibido por ventas + valor actual de posiciones abiertas."
+            },
+            {
+                "Concepto": "**Inversión total realizada**",
+                "Importe (€)": inversion_total,
+                "Descripción": "Total invertido en posiciones abiertas + invertido en activos vendidos."
+            },
+            {
+                "Concepto": "**Ganancia/pérdida neta**",
+                "Importe (€)": ganancia_perdida_neta,
+                "Descripción": "Saldo neto actual - inversión total realizada."
+            },
+        ]
+        
+        df_tabla_final = pd.DataFrame(tabla_final)
+        
+        # Mostrar la tabla con formato en Streamlit
+        st.markdown("### 📋 Resumen General de la Cartera")
+        
+        st.dataframe(
+            df_tabla_final.style.format({"Importe (€)": "€{:.2f}"}), 
+            use_container_width=True
+        )
 
 
-            
+        
 # --- Cuarta ventana: Posiciones abiertas ---         
 with tab4:
         st.subheader("Posiciones abiertas de la cartera")
@@ -798,23 +706,13 @@ with tab4:
         if st.session_state.df_transacciones.empty:
             st.info("No hay transacciones registradas.")
         else:
-            df = st.session_state.df_transacciones.copy()
-    
-            filas_resumen = []
-            grupos = df.groupby(['activo', 'tipo_activo'])
-    
-            for (activo, tipo_activo), grupo in grupos:
-                posicion, precio_medio = calcular_posicion_y_precio_medio_fifo(grupo)
-                num_trans = len(grupo)
-                filas_resumen.append({
-                    'Activo': activo,
-                    'Tipo de Activo': tipo_activo,
-                    'Posición': posicion,
-                    'Precio medio de compra (€)': round(precio_medio, 2),
-                    'Nº de transacciones': num_trans
-                })
-    
-            resumen = pd.DataFrame(filas_resumen)
+            resumen = pd.DataFrame({
+                'Activo': resultado_fifo.resumen['activo'],
+                'Tipo de Activo': resultado_fifo.resumen['tipo_activo'],
+                'Posición': resultado_fifo.resumen['posicion'],
+                'Precio medio de compra (€)': resultado_fifo.resumen['precio_medio'].round(2),
+                'Nº de transacciones': resultado_fifo.resumen['num_transacciones']
+            })
     
             st.dataframe(resumen)    
 
@@ -878,59 +776,21 @@ with tab4:
 # --- Quinta ventana: Ganancias FIFO ---       
 with tab5:
     # Selección del activo para cálculo FIFO
-    if not st.session_state.df_transacciones.empty:
-        activos_disponibles = [''] + st.session_state.df_transacciones['activo'].dropna().unique().tolist()
-    else:
-        activos_disponibles = ['']
+    activos_disponibles = [''] + libro_sqlite.activos()
 
     activo_seleccionado = st.selectbox("Selecciona el activo para calcular ganancias FIFO", options=activos_disponibles)
 
     if activo_seleccionado and activo_seleccionado != '':
-        # Filtrar transacciones solo del activo seleccionado
-        transacciones_activo = st.session_state.df_transacciones[
-            st.session_state.df_transacciones['activo'] == activo_seleccionado
-        ].sort_values('fecha')
-
-        # Función FIFO con columna de precio FIFO de compra
-        def calcular_ganancias_fifo(transacciones):
-            compras = []
-            resultados = []
-
-            for _, row in transacciones.iterrows():
-                tipo = row['tipo']
-                cantidad = row['cantidad']
-                precio = row['precio_unitario']
-                fecha = row['fecha']
-
-                if tipo == 'compra':
-                    compras.append({'cantidad': cantidad, 'precio': precio})
-                elif tipo == 'venta':
-                    cantidad_a_vender = cantidad
-                    while cantidad_a_vender > 0 and compras:
-                        lote = compras[0]
-                        cantidad_disponible = lote['cantidad']
-                        cantidad_usada = min(cantidad_disponible, cantidad_a_vender)
-
-                        precio_fifo = lote['precio']
-                        ganancia = cantidad_usada * (precio - precio_fifo)
-
-                        resultados.append({
-                            'Fecha de Venta': fecha,
-                            'Cantidad Vendida': cantidad_usada,
-                            'Precio de Venta (€)': precio,
-                            'Precio FIFO Compra (€)': precio_fifo,
-                            'Ganancia (€)': ganancia
-                        })
-
-                        lote['cantidad'] -= cantidad_usada
-                        cantidad_a_vender -= cantidad_usada
-
-                        if lote['cantidad'] == 0:
-                            compras.pop(0)
-
-            return pd.DataFrame(resultados)
-
-        df_ganancias = calcular_ganancias_fifo(transacciones_activo)
+        # Tramos FIFO del activo seleccionado con su precio FIFO de compra
+        tramos_activo = resultado_fifo.tramos_activo(activo_seleccionado)
+        df_ganancias = pd.DataFrame({
+            'Fecha de Venta': tramos_activo['fecha_venta'],
+            'Cantidad Vendida': tramos_activo['cantidad'],
+            'Precio de Venta (€)': tramos_activo['precio_venta'],
+            'Precio FIFO Compra (€)': tramos_activo['precio_compra'],
+            'Ganancia (€)': tramos_activo['ganancia']
+        }).reset_index(drop=True)
+        resumen_activo = resultado_fifo.resumen.set_index('activo').loc[activo_seleccionado]
 
         st.subheader(f"Ganancias por ventas FIFO de {activo_seleccionado}")
         if not df_ganancias.empty:
@@ -949,26 +809,29 @@ with tab5:
             st.write("No hay ventas registradas para este activo.")
 
         # Posición actual (cantidad neta)
-        def calcular_posicion_actual(transacciones):
-            compras = transacciones[transacciones['tipo'] == 'compra']['cantidad'].sum()
-            ventas = transacciones[transacciones['tipo'] == 'venta']['cantidad'].sum()
-            return compras - ventas
-
-        posicion_actual = calcular_posicion_actual(transacciones_activo)
+        posicion_actual = resumen_activo['unidades_compradas'] - resumen_activo['unidades_vendidas']
         st.markdown(f"**Posición actual:** {posicion_actual} unidades")
 
         # ROI básico (ganancia / inversión total)
-        def calcular_inversion_total(transacciones):
-            compras = transacciones[transacciones['tipo'] == 'compra']
-            return (compras['cantidad'] * compras['precio_unitario']).sum()
-
-        inversion_total = calcular_inversion_total(transacciones_activo)
+        inversion_total = resumen_activo['inversion_compras']
 
         if inversion_total > 0 and not df_ganancias.empty and 'Ganancia (€)' in df_ganancias.columns:
             roi = (df_ganancias['Ganancia (€)'].sum() / inversion_total) * 100
             st.markdown(f"**ROI acumulado:** {roi:.2f}%")
         else:
             st.markdown("**ROI acumulado:** No disponible (sin compras o sin ganancias)")
+
+        # Evolución del precio desde la primera transacción, servida desde el histórico local;
+        # lo que aún no está guardado lo descarga el hilo de refresco y aparece en el siguiente rerun
+        historico = almacen_precios.cierres_activos(
+            [activo_seleccionado], desde=libro_sqlite.primera_fecha(activo_seleccionado), actualizar=False
+        )
+        if not historico.empty and historico[activo_seleccionado].notna().any():
+            fig_historico = go.Figure(go.Scatter(
+                x=historico.index, y=historico[activo_seleccionado], mode='lines', name='Cierre'
+            ))
+            fig_historico.update_layout(title=f"Cotización de {activo_seleccionado}", xaxis_title="Fecha", yaxis_title="Precio")
+            st.plotly_chart(fig_historico, use_container_width=True)
     else:
         st.info("Por favor, selecciona un activo para calcular ganancias.")
 
@@ -983,61 +846,22 @@ with tab6:
     if st.session_state.df_transacciones.empty:
         st.info("No hay transacciones registradas para generar el informe.")
     else:
-        df = st.session_state.df_transacciones.copy()
-        df["importe_total"] = df["precio_unitario"].astype(float) * df["cantidad"].astype(float)
-        df["fecha"] = pd.to_datetime(df["fecha"])
-        df["año"] = df["fecha"].dt.year
-
         # ------------------------------------
-        # Generar detalle FIFO por cada tramo de venta
-        detalle_fifo = []
-
-        activos = df['activo'].unique()
-        for activo in activos:
-            grupo_activo = df[df['activo'] == activo].sort_values('fecha').copy()
-            inventario = []
-
-            for _, fila in grupo_activo.iterrows():
-                tipo = fila['tipo']
-                cantidad = fila['cantidad']
-                precio_unitario = fila['precio_unitario']
-                fecha = fila['fecha']
-
-                if tipo == 'compra':
-                    inventario.append({'cantidad': cantidad, 'precio_unitario': precio_unitario})
-                elif tipo == 'venta':
-                    cantidad_a_vender = cantidad
-
-                    while cantidad_a_vender > 0 and inventario:
-                        lote = inventario[0]
-                        if lote['cantidad'] <= cantidad_a_vender:
-                            cantidad_vendida = lote['cantidad']
-                            coste_compra = cantidad_vendida * lote['precio_unitario']
-                            inventario.pop(0)
-                        else:
-                            cantidad_vendida = cantidad_a_vender
-                            coste_compra = cantidad_vendida * lote['precio_unitario']
-                            lote['cantidad'] -= cantidad_vendida
-
-                        cantidad_a_vender -= cantidad_vendida
-                        precio_medio_compra = coste_compra / cantidad_vendida
-                        balance = (precio_unitario - precio_medio_compra) * cantidad_vendida
-
-                        detalle_fifo.append({
-                            "Activo": activo,
-                            "Tipo Activo": fila.get('tipo_activo', 'Desconocido'),
-                            "Fecha venta": fecha,
-                            "Año": fecha.year,
-                            "Cantidad vendida": cantidad_vendida,
-                            "Precio medio compra (€)": precio_medio_compra,
-                            "Precio venta (€)": precio_unitario,
-                            "Balance (€)": balance
-                        })
-
-        df_detalle_fifo = pd.DataFrame(detalle_fifo)
+        # Detalle FIFO por cada tramo de venta
+        tramos = resultado_fifo.tramos
+        df_detalle_fifo = pd.DataFrame({
+            "Activo": tramos['activo'],
+            "Tipo Activo": tramos['tipo_activo'],
+            "Fecha venta": tramos['fecha_venta'],
+            "Año": tramos['fecha_venta'].dt.year,
+            "Cantidad vendida": tramos['cantidad'],
+            "Precio medio compra (€)": tramos['precio_compra'],
+            "Precio venta (€)": tramos['precio_venta'],
+            "Balance (€)": tramos['ganancia']
+        })
 
         # Filtro por tipo_activo
-        tipo_activos_disponibles = df_detalle_fifo['Tipo Activo'].dropna().unique()
+        tipo_activos_disponibles = libro_sqlite.tipos_activo()
         tipo_activo_seleccionado = st.multiselect(
             "Filtrar por tipo de activo",
             options=sorted(tipo_activos_disponibles),
@@ -1047,7 +871,7 @@ with tab6:
         df_detalle_fifo_filtrado_tipo = df_detalle_fifo[df_detalle_fifo['Tipo Activo'].isin(tipo_activo_seleccionado)]
 
         # --- FILTRO AÑO PARA EL RESUMEN ---
-        años_disponibles_resumen = df_detalle_fifo_filtrado_tipo['Año'].unique()
+        años_disponibles_resumen = libro_sqlite.años(tipo='venta', tipos_activo=tipo_activo_seleccionado)
         año_seleccionado_resumen = st.selectbox(
             "Filtrar resumen por año fiscal",
             options=sorted(años_disponibles_resumen)
@@ -1099,7 +923,7 @@ with tab6:
         st.subheader(f"Detalle FIFO de cada tramo de venta ({año_seleccionado_resumen})")
 
         # FILTRO AÑO PARA EL DETALLE FIFO (DEBAJO DEL TÍTULO)
-        años_disponibles_detalle = df_detalle_fifo['Año'].unique()
+        años_disponibles_detalle = libro_sqlite.años(tipo='venta')
         año_seleccionado_detalle = st.selectbox(
             "Filtrar detalle FIFO por año fiscal",
             options=sorted(años_disponibles_detalle),
@@ -1108,7 +932,7 @@ with tab6:
         )
         
         # FILTRO TIPO_ACTIVO PARA EL DETALLE FIFO (DEBAJO DEL TÍTULO)
-        tipo_activos_disponibles_detalle = df_detalle_fifo['Tipo Activo'].dropna().unique()
+        tipo_activos_disponibles_detalle = libro_sqlite.tipos_activo()
         tipo_activo_seleccionado_detalle = st.multiselect(
             "Filtrar detalle FIFO por tipo de activo",
             options=sorted(tipo_activos_disponibles_detalle),
@@ -1152,3 +976,46 @@ with tab6:
             file_name=f"detalle_fifo_ventas_{año_seleccionado_detalle}.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
+
+        st.markdown("---")
+        # Posiciones abiertas a 31 de diciembre (Impuesto sobre el Patrimonio, modelo 720)
+        st.subheader("Posiciones a 31 de diciembre")
+
+        años_posiciones = libro_sqlite.años()
+        # El índice solo se monta con la sección abierta: cada cambio del libro obliga a rehacerlo
+        if años_posiciones and st.toggle("Calcular posiciones a 31 de diciembre", key='ver_posiciones'):
+            año_posiciones = st.selectbox(
+                "Año fiscal",
+                options=años_posiciones,
+                index=len(años_posiciones) - 1,
+                key='filtro_año_posiciones'
+            )
+
+            # El índice guarda por fila las unidades ya consumidas: la cola en una fecha son dos
+            # búsquedas binarias, sin repetir transacciones
+            indice_posiciones = st.session_state.estado_fifo.indice_posiciones(st.session_state.df_transacciones)
+            posiciones = indice_posiciones.posiciones_en(pd.Timestamp(year=año_posiciones, month=12, day=31))
+            df_posiciones = pd.DataFrame({
+                "Activo": posiciones['activo'],
+                "Tipo Activo": posiciones['tipo_activo'],
+                "Posición": posiciones['posicion'],
+                "Precio medio compra (€)": posiciones['precio_medio'],
+                "Coste de adquisición (€)": posiciones['coste_abierto']
+            })
+
+            st.dataframe(
+                df_posiciones.style.format({
+                    "Posición": "{:.8f}",
+                    "Precio medio compra (€)": "€{:.4f}",
+                    "Coste de adquisición (€)": "€{:.2f}"
+                }),
+                use_container_width=True
+            )
+
+            csv_posiciones = df_posiciones.to_csv(index=False).encode('utf-8')
+            st.download_button(
+                label=f"📄 Descargar posiciones a 31/12/{año_posiciones} (CSV)",
+                data=csv_posiciones,
+                file_name=f"posiciones_31_12_{año_posiciones}.csv",
+                mime="text/csv"
+            )
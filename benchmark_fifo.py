@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark del motor FIFO.
+
+Genera un libro sintético con el peor caso para el emparejamiento (compras y ventas
+intercaladas de tamaño aleatorio, de modo que casi cada venta consume varios lotes a medias),
+comprueba que cada modo de motor_fifo da las mismas filas que el detalle FIFO de la ventana
+'Informe hacienda' y los mismos totales que 'Posición Global', y mide filas por segundo.
+
+Uso:
+    python benchmark_fifo.py [--filas 200000] [--activos 20] [--filas-paridad 20000]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from motor_fifo import ESCALA_CANTIDAD, calcular_fifo
+
+MODOS = ['cola', 'vectorizado', 'nucleo']
+
+
+def generar_libro(filas, activos, semilla=0):
+    """Libro con fechas distintas por fila y ventas que cruzan varios lotes parciales."""
+    rng = np.random.default_rng(semilla)
+    tipos = np.where(rng.random(filas) < 0.55, 'compra', 'venta')
+    return pd.DataFrame({
+        'tipo': tipos,
+        'cantidad': np.round(rng.random(filas) * np.where(tipos == 'compra', 1.0, 1.5) + 1e-8, 8),
+        'precio_unitario': np.round(rng.random(filas) * 100 + 1, 2),
+        'fecha': pd.Timestamp('2018-01-01') + pd.to_timedelta(np.arange(filas), unit='min'),
+        'tipo_activo': rng.choice(['ETF', 'Cripto', 'Acción'], filas),
+        'activo': rng.choice([f'ACT{i}' for i in range(activos)], filas),
+    })
+
+
+def libro_degenerado():
+    """
+    Activos sin ninguna venta emparejada: solo compras, solo ventas y venta antes de la primera
+    compra, junto a uno normal. El libro aleatorio nunca los genera.
+    """
+    filas = [
+        ('compra', 1.5, 10.0, 'SOLO_COMPRAS'), ('compra', 2.0, 11.0, 'SOLO_COMPRAS'),
+        ('venta', 1.0, 12.0, 'SOLO_VENTAS'),
+        ('venta', 1.0, 9.0, 'VENTA_ANTES'), ('compra', 3.0, 8.0, 'VENTA_ANTES'),
+        ('compra', 2.0, 5.0, 'NORMAL'), ('venta', 0.5, 7.0, 'NORMAL'),
+    ]
+    return pd.DataFrame({
+        'tipo': [f[0] for f in filas],
+        'cantidad': [f[1] for f in filas],
+        'precio_unitario': [f[2] for f in filas],
+        'fecha': pd.Timestamp('2018-01-01') + pd.to_timedelta(np.arange(len(filas)), unit='D'),
+        'tipo_activo': 'Acción',
+        'activo': [f[3] for f in filas],
+    })
+
+
+def detalle_fifo_referencia(df):
+    """Detalle FIFO por tramo de venta con el mismo bucle que la ventana 'Informe hacienda'."""
+    detalle_fifo = []
+    for activo in df['activo'].unique():
+        grupo_activo = df[df['activo'] == activo].sort_values('fecha', kind='mergesort')
+        inventario = []
+        for fila in grupo_activo.itertuples(index=False):
+            if fila.tipo == 'compra':
+                inventario.append({'cantidad': fila.cantidad, 'precio_unitario': fila.precio_unitario})
+            elif fila.tipo == 'venta':
+                cantidad_a_vender = fila.cantidad
+                while cantidad_a_vender > 0 and inventario:
+                    lote = inventario[0]
+                    if lote['cantidad'] <= cantidad_a_vender:
+                        cantidad_vendida = lote['cantidad']
+                        inventario.pop(0)
+                    else:
+                        cantidad_vendida = cantidad_a_vender
+                        lote['cantidad'] -= cantidad_vendida
+                    cantidad_a_vender -= cantidad_vendida
+                    detalle_fifo.append((
+                        activo, fila.fecha, cantidad_vendida, lote['precio_unitario'], fila.precio_unitario,
+                        (fila.precio_unitario - lote['precio_unitario']) * cantidad_vendida
+                    ))
+    return pd.DataFrame(detalle_fifo, columns=[
+        'activo', 'fecha_venta', 'cantidad', 'precio_compra', 'precio_venta', 'ganancia'
+    ])
+
+
+def totales_referencia(df):
+    """Totales de la ventana 'Posición Global': posición y coste abiertos, ventas y ganancia realizada."""
+    totales = dict.fromkeys(
+        ['posicion', 'coste_abierto', 'unidades_vendidas', 'ingreso_ventas', 'ganancia_realizada'], 0.0
+    )
+    for activo in df['activo'].unique():
+        df_activo = df[df['activo'] == activo].sort_values('fecha', kind='mergesort')
+        lotes = []
+        for fila in df_activo.itertuples(index=False):
+            if fila.tipo == 'compra':
+                lotes.append([fila.cantidad, fila.precio_unitario])
+            elif fila.tipo == 'venta':
+                totales['unidades_vendidas'] += fila.cantidad
+                totales['ingreso_ventas'] += fila.cantidad * fila.precio_unitario
+                cantidad_vender = fila.cantidad
+                while cantidad_vender > 0 and lotes:
+                    lote = lotes[0]
+                    cantidad_usada = min(lote[0], cantidad_vender)
+                    totales['ganancia_realizada'] += cantidad_usada * (fila.precio_unitario - lote[1])
+                    lote[0] -= cantidad_usada
+                    cantidad_vender -= cantidad_usada
+                    if lote[0] == 0:
+                        lotes.pop(0)
+        totales['posicion'] += sum(l[0] for l in lotes)
+        totales['coste_abierto'] += sum(l[0] * l[1] for l in lotes)
+    return totales
+
+
+def comprobar_paridad(df, modo, escala):
+    """Compara un modo del motor con las referencias; retorna lista de discrepancias."""
+    resultado = calcular_fifo(df, modo=modo, escala=escala)
+    errores = []
+
+    detalle = detalle_fifo_referencia(df)
+    tramos = resultado.tramos.set_index('activo').loc[detalle['activo'].unique()].reset_index()
+    if len(tramos) != len(detalle):
+        errores.append(f'{len(tramos)} tramos frente a {len(detalle)} del detalle FIFO')
+    else:
+        if not (tramos['fecha_venta'].to_numpy() == detalle['fecha_venta'].to_numpy()).all():
+            errores.append('fechas de venta distintas')
+        for col in ['cantidad', 'precio_compra', 'precio_venta', 'ganancia']:
+            if not np.allclose(tramos[col], detalle[col], rtol=1e-9, atol=1e-6):
+                errores.append(f'columna {col} distinta')
+
+    for concepto, valor in totales_referencia(df).items():
+        if not np.isclose(resultado.resumen[concepto].sum(), valor, rtol=1e-9, atol=1e-6):
+            errores.append(f'total {concepto}: {resultado.resumen[concepto].sum()} frente a {valor}')
+    return errores
+
+
+def medir(df, modo, escala, repeticiones=3):
+    """Mejor tiempo de calcular_fifo en varias repeticiones."""
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        calcular_fifo(df, modo=modo, escala=escala, procesos=1)
+        tiempos.append(time.perf_counter() - inicio)
+    return min(tiempos)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--filas', type=int, default=200_000)
+    parser.add_argument('--activos', type=int, default=20)
+    parser.add_argument('--filas-paridad', type=int, default=20_000)
+    parser.add_argument('--semilla', type=int, default=0)
+    args = parser.parse_args()
+
+    libro_paridad = generar_libro(args.filas_paridad, args.activos, args.semilla)
+    libro = generar_libro(args.filas, args.activos, args.semilla)
+    print(f'Paridad sobre {len(libro_paridad)} filas, tiempos sobre {len(libro)} filas y {args.activos} activos')
+
+    fallos = 0
+    for escala in (None, ESCALA_CANTIDAD):
+        etiqueta_escala = 'coma flotante' if escala is None else f'punto fijo 1/{escala}'
+        for modo in MODOS:
+            errores = comprobar_paridad(libro_degenerado(), modo, escala)
+            fallos += bool(errores)
+            if errores:
+                print(f'{modo:<12} {etiqueta_escala:<22} libro degenerado ERROR: ' + '; '.join(errores))
+            errores = comprobar_paridad(libro_paridad, modo, escala)
+            fallos += bool(errores)
+            segundos = medir(libro, modo, escala)
+            estado = 'OK' if not errores else 'ERROR: ' + '; '.join(errores)
+            print(f'{modo:<12} {etiqueta_escala:<22} {len(libro) / segundos:>14,.0f} filas/s  {estado}')
+
+    raise SystemExit(1 if fallos else 0)
+
+
+if __name__ == '__main__':
+    main()
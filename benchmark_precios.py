@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark de la valoración a precios actuales.
+
+Valora la cartera de un libro sintético como la ventana 'Posición Global' (posición abierta
+por el último precio de cada activo) sin red: los precios salen de ProveedorFichero, con el
+fichero indicado o con uno sintético en el que algunos activos solo cotizan con sufijo -USD
+y otros no tienen datos, para recorrer la descarga conjunta y la búsqueda individual.
+Mide la primera carga, la carga con la resolución de tickers aprendida y la carga desde caché.
+
+Uso:
+    python benchmark_precios.py [--filas 50000] [--activos 200] [--fixture fichero.json] [--latencia 0.05]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmark_fifo import generar_libro
+from motor_fifo import calcular_fifo
+
+
+def fixture_sintetico(ruta, activos, dias=30, semilla=0):
+    """Cierres diarios de ACT0..ACTn: cada 10º solo como ACTn-USD y cada 25º sin datos."""
+    rng = np.random.default_rng(semilla)
+    fechas = pd.date_range('2024-01-01', periods=dias, freq='D').strftime('%Y-%m-%d')
+    cierres = {}
+    for i in range(activos):
+        if i % 25 == 24:
+            continue
+        simbolo = f'ACT{i}-USD' if i % 10 == 9 else f'ACT{i}'
+        cierres[simbolo] = dict(zip(fechas, np.round(rng.random(dias) * 100 + 1, 2).tolist()))
+    with open(ruta, 'w', encoding='utf-8') as f:
+        json.dump({'cierres': cierres}, f)
+
+
+def valorar(resumen, obtener_precios):
+    """Valor actual y PNL no realizado por activo, como en 'Posición Global'."""
+    precios, fallos = obtener_precios(resumen['activo'].tolist())
+    valoracion = resumen[['activo', 'posicion', 'coste_abierto']].copy()
+    valoracion['precio_actual'] = valoracion['activo'].map(precios)
+    valoracion['valor_actual'] = valoracion['posicion'] * valoracion['precio_actual']
+    valoracion['pnl_no_realizado'] = valoracion['valor_actual'] - valoracion['coste_abierto']
+    return valoracion, fallos
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--filas', type=int, default=50_000)
+    parser.add_argument('--activos', type=int, default=200)
+    parser.add_argument('--fixture', help="Fichero de cotizaciones grabadas (por defecto, uno sintético)")
+    parser.add_argument('--latencia', type=float, default=0.0, help="Segundos de espera por petición al proveedor")
+    parser.add_argument('--semilla', type=int, default=0)
+    args = parser.parse_args()
+
+    temporal = tempfile.mkdtemp(prefix='benchmark_precios_')
+    ruta_fixture = args.fixture or os.path.join(temporal, 'fixture.json')
+    if not args.fixture:
+        fixture_sintetico(ruta_fixture, args.activos, semilla=args.semilla)
+    # Configuración antes de importar precios: proveedor de fichero y resoluciones en un directorio vacío
+    os.environ.update({
+        'PRECIOS_PROVEEDOR': 'fichero', 'PRECIOS_FIXTURE': ruta_fixture,
+        'PRECIOS_FIXTURE_LATENCIA': str(args.latencia), 'PRECIOS_DIRECTORIO': temporal,
+    })
+    from precios import cache_cotizaciones, obtener_precios
+
+    resumen = calcular_fifo(generar_libro(args.filas, args.activos, args.semilla)).resumen
+    print(f'Valoración de {len(resumen)} activos ({args.filas} filas) con cotizaciones de {ruta_fixture}')
+
+    for etapa in ('primera carga', 'resoluciones aprendidas', 'desde caché'):
+        if etapa != 'desde caché':
+            cache_cotizaciones.vaciar()
+        inicio = time.perf_counter()
+        valoracion, fallos = valorar(resumen, obtener_precios)
+        segundos = time.perf_counter() - inicio
+        print(f'{etapa:<24} {segundos * 1000:>10.1f} ms  {len(valoracion) - len(fallos)} con precio, '
+              f'{len(fallos)} sin precio, valor total {valoracion["valor_actual"].sum():,.2f}')
+
+
+if __name__ == '__main__':
+    main()
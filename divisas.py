@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Conversión de importes a la divisa base de la cartera.
+
+Los tipos de cambio son cierres diarios de los pares de Yahoo Finance ('USDEUR=X': euros por
+dólar) guardados en el almacén de historico_precios.py, así que vienen del proveedor
+configurado (también del de fichero, sin red). Con ellos se forma una matriz fecha x divisa que
+convierte columnas enteras de una vez: el coste de cada operación con el tipo de su fecha y la
+valoración con el tipo actual, que el hilo de refresco de precios mantiene como un activo más.
+Nunca se va a la red al convertir: el histórico que falta se encarga al hilo de refresco y, mientras
+no llega, las operaciones afectadas quedan sin convertir (importes NaN y su divisa original).
+"""
+import logging
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from historico_precios import almacen_precios
+from precios import (
+    DIRECTORIO_PRECIOS, ResolucionTickers, proveedor_actual, refresco_precios, resoluciones, ticker_yf
+)
+
+log = logging.getLogger(__name__)
+
+DIVISA_BASE = os.environ.get('DIVISA_BASE', 'EUR')
+
+# Subunidades con las que cotizan algunas bolsas (Londres en peniques): divisa y factor
+SUBUNIDADES = {'GBp': ('GBP', 0.01), 'GBX': ('GBP', 0.01), 'ZAc': ('ZAR', 0.01), 'ILA': ('ILS', 0.01)}
+
+# Días que se leen antes de la primera fecha pedida, para tener el cierre previo a un fin de semana o festivo
+DIAS_MARGEN_TIPOS = 7
+
+# Divisa de cotización de cada ticker, recordada en disco como las resoluciones de tickers
+divisas_cotizacion = ResolucionTickers(os.path.join(DIRECTORIO_PRECIOS, 'divisas_cotizacion.json'))
+
+
+def par_yf(divisa, base=DIVISA_BASE):
+    """Ticker de Yahoo Finance del tipo de cambio de 'divisa' a 'base'."""
+    return f'{divisa}{base}=X'
+
+
+def es_par(ticker):
+    return str(ticker).endswith('=X')
+
+
+def _normalizar(divisa):
+    """(divisa, factor) de una divisa que puede venir en subunidades."""
+    return SUBUNIDADES.get(divisa, (str(divisa).upper(), 1.0))
+
+
+def divisa_de(activo):
+    """Divisa de cotización de un activo ya conocida (sin ir a la red), o None si aún no se sabe."""
+    conocido, divisa = divisas_cotizacion.consultar(ticker_yf(activo))
+    if not conocido:
+        return None
+    return divisa or DIVISA_BASE
+
+
+def pares_necesarios(activos):
+    """
+    Tipos de cambio (tickers de pares) que hacen falta para valorar 'activos', averiguando antes
+    la divisa de cotización de los que aún no la tienen.
+    """
+    pares = set()
+    for activo in activos:
+        ticker = ticker_yf(activo)
+        if es_par(ticker):
+            continue
+        conocido, divisa = divisas_cotizacion.consultar(ticker)
+        if not conocido:
+            conocido_simbolo, simbolo = resoluciones.consultar(ticker)
+            try:
+                divisa = proveedor_actual().divisa(simbolo if conocido_simbolo and simbolo else ticker)
+            except Exception as e:
+                log.warning("No se pudo obtener la divisa de %s: %s", ticker, e)
+                continue
+            divisas_cotizacion.registrar(ticker, divisa)
+        divisa = _normalizar(divisa or DIVISA_BASE)[0]
+        if divisa != DIVISA_BASE:
+            pares.add(par_yf(divisa))
+    return pares
+
+
+def _seguir_pares(activos):
+    """Tarea del hilo de refresco: pone a seguir los tipos de cambio de los activos seguidos."""
+    pares = pares_necesarios(activos)
+    if pares:
+        refresco_precios.seguir(pares)
+
+
+refresco_precios.al_refrescar(_seguir_pares)
+
+
+def precios_en_base(precios):
+    """
+    Convierte {activo: precio en su divisa de cotización} a la divisa base con el último tipo de
+    la instantánea de precios. Los activos cuya divisa o tipo aún no se conocen se omiten (quedan
+    como pendientes hasta el siguiente refresco).
+    """
+    convertidos = {}
+    for activo, precio in precios.items():
+        if es_par(ticker_yf(activo)):
+            continue
+        divisa = divisa_de(activo)
+        if divisa is None:
+            continue
+        divisa, factor = _normalizar(divisa)
+        if divisa == DIVISA_BASE:
+            convertidos[activo] = precio * factor
+        elif par_yf(divisa) in precios:
+            convertidos[activo] = precio * factor * precios[par_yf(divisa)]
+    return convertidos
+
+
+_matrices = {}
+_cerrojo_matrices = threading.Lock()
+
+
+def matriz_tipos(divisas, desde):
+    """
+    Tipos diarios a la divisa base desde 'desde': DataFrame con una fila por día natural desde el
+    primer cierre guardado (los fines de semana repiten el último cierre) y una columna por
+    divisa. Se lee del almacén sin ir a la red; lo que falta se encarga al hilo de refresco. Se
+    guarda una matriz por conjunto de divisas: vale para cualquier 'desde' posterior al suyo
+    hasta que el almacén guarda cierres nuevos o cambia el día, y una fecha anterior la rehace
+    ampliada hacia atrás en vez de guardar otra.
+    """
+    divisas = tuple(sorted({_normalizar(d)[0] for d in divisas} - {DIVISA_BASE}))
+    desde = pd.Timestamp(desde).normalize()
+    hoy = pd.Timestamp.today().normalize()
+    version = almacen_precios.version
+    with _cerrojo_matrices:
+        guardada = _matrices.get(divisas)
+    if guardada is not None:
+        version_guardada, desde_guardado, hoy_guardado, matriz = guardada
+        if version_guardada == version and hoy_guardado == hoy and desde_guardado <= desde:
+            return matriz
+        desde = min(desde, desde_guardado)
+
+    cierres = almacen_precios.cierres_activos(
+        [par_yf(d) for d in divisas], desde=desde - pd.Timedelta(days=DIAS_MARGEN_TIPOS), actualizar=False
+    )
+    cierres.columns = list(divisas)
+    if not cierres.empty:
+        cierres = cierres.reindex(pd.date_range(cierres.index.min(), hoy, freq='D')).ffill()
+    cierres[DIVISA_BASE] = 1.0
+    with _cerrojo_matrices:
+        _matrices[divisas] = (version, desde, hoy, cierres)
+    return cierres
+
+
+def tipos_en_fecha(fechas, divisas, matriz):
+    """
+    Tipo a la divisa base de cada par (fecha, divisa) en una sola pasada: el de la propia fecha o,
+    si no hay, el último anterior. Las fechas previas al primer cierre guardado de su divisa, las
+    fechas vacías y las divisas sin tipos quedan en NaN; la divisa base vale 1.
+    """
+    normalizadas = [_normalizar(d) for d in divisas]
+    codigos = np.array([d for d, _ in normalizadas], dtype=object)
+    factores = np.array([f for _, f in normalizadas], dtype=float)
+    tipos = np.where(codigos == DIVISA_BASE, 1.0, np.nan)
+    if len(matriz.index):
+        fechas = pd.DatetimeIndex(pd.to_datetime(fechas)).normalize()
+        filas = matriz.index.searchsorted(fechas, side='right') - 1
+        columnas = matriz.columns.get_indexer(codigos)
+        valores = matriz.to_numpy(dtype=float)
+        conocidos = (columnas >= 0) & (filas >= 0) & ~fechas.isna()
+        tipos = np.where(conocidos, valores[np.maximum(filas, 0), np.maximum(columnas, 0)], tipos)
+        # La divisa base vale 1 en cualquier fecha, también antes del primer cierre guardado
+        tipos = np.where(codigos == DIVISA_BASE, 1.0, tipos)
+    return tipos * factores
+
+
+def libro_en_base(transacciones):
+    """
+    Libro con 'precio_unitario' pasado de 'divisa_pago' a la divisa base y las comisiones en
+    efectivo de 'divisa_comision' a la divisa base, cada una al tipo de la fecha de la operación.
+    Las comisiones en especie (divisa_comision == activo) no se tocan. Las filas sin tipo para su
+    fecha conservan su divisa original y quedan con precio NaN (ver filas_sin_tipo) en vez de
+    mezclar importes de otra divisa; su histórico se encarga al hilo de refresco.
+    """
+    if 'divisa_pago' not in transacciones.columns or transacciones.empty:
+        return transacciones
+    df = transacciones
+    divisa_pago = df['divisa_pago'].fillna(DIVISA_BASE).astype(str).str.strip()
+    divisa_pago = divisa_pago.mask(divisa_pago == '', DIVISA_BASE)
+    if 'divisa_comision' in df.columns:
+        en_especie = (
+            df['divisa_comision'].astype('string') == df['activo'].astype('string')
+        ).fillna(False).to_numpy(dtype=bool)
+        divisa_comision = df['divisa_comision'].fillna(DIVISA_BASE).astype(str).str.strip()
+        divisa_comision = divisa_comision.mask((divisa_comision == '') | en_especie, DIVISA_BASE)
+    else:
+        en_especie = np.zeros(len(df), dtype=bool)
+        divisa_comision = pd.Series(DIVISA_BASE, index=df.index)
+
+    divisas = set(divisa_pago) | set(divisa_comision)
+    if divisas <= {DIVISA_BASE}:
+        return transacciones
+
+    fechas = pd.to_datetime(df['fecha'], errors='coerce')
+    matriz = matriz_tipos(divisas, fechas.min() if fechas.notna().any() else pd.Timestamp.today())
+    tipo_pago = tipos_en_fecha(fechas, divisa_pago, matriz)
+    tipo_comision = tipos_en_fecha(fechas, divisa_comision, matriz)
+    sin_tipo = sorted(set(divisa_pago[np.isnan(tipo_pago)]) | set(divisa_comision[np.isnan(tipo_comision)]))
+    if sin_tipo:
+        log.warning("Sin tipo de cambio para %s en algunas fechas: esas operaciones quedan sin convertir", sin_tipo)
+
+    # Sin el tipo de la comisión tampoco se conoce el coste de la operación
+    comision = pd.to_numeric(df['comision'], errors='coerce') if 'comision' in df.columns else pd.Series(0.0, index=df.index)
+    sin_comision = np.isnan(tipo_comision) & (comision.fillna(0.0).to_numpy() != 0)
+    precio = pd.to_numeric(df['precio_unitario'], errors='coerce') * tipo_pago
+    cambios = {
+        'precio_unitario': precio.mask(sin_comision),
+        'divisa_pago': divisa_pago.where(np.isnan(tipo_pago), DIVISA_BASE),
+    }
+    if 'comision' in df.columns:
+        cambios['comision'] = comision * tipo_comision
+        cambios['divisa_comision'] = df['divisa_comision'].where(
+            en_especie | np.isnan(tipo_comision), DIVISA_BASE
+        )
+    return df.assign(**cambios)
+
+
+def filas_sin_tipo(libro):
+    """Máscara de las filas de un libro pasado por libro_en_base() que no se pudieron convertir."""
+    def en_otra_divisa(columna):
+        return ~libro[columna].fillna(DIVISA_BASE).astype(str).str.strip().str.upper().isin([DIVISA_BASE, ''])
+
+    sin_tipo = pd.Series(False, index=libro.index)
+    if 'divisa_pago' in libro.columns:
+        sin_tipo |= en_otra_divisa('divisa_pago')
+    if 'divisa_comision' in libro.columns:
+        en_especie = (libro['divisa_comision'].astype('string') == libro['activo'].astype('string')).fillna(False)
+        sin_tipo |= en_otra_divisa('divisa_comision') & ~en_especie
+    return sin_tipo.to_numpy(dtype=bool)
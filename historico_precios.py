@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Almacén local de cierres diarios en SQLite para gráficos y valoraciones históricas.
+
+Se rellena de forma incremental: para cada ticker solo se piden al proveedor los días desde el
+último cierre guardado y, si se pide un rango que empieza antes, los que faltan antes del primero.
+Las consultas por rango se sirven desde disco (también sin red); las ventanas que no pueden esperar
+a la red encargan con pedir() lo que falta y el hilo de refresco de precios lo descarga.
+Los activos se resuelven con equivalencias_yf y la tabla de resoluciones de precios.py.
+El último cierre guardado sirve de precio de partida al hilo de refresco de precios, de modo que
+las ventanas de valoración arrancan sin red tras la instantánea nocturna (snapshot_precios.py).
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+import pandas as pd
+
+from precios import (
+    DIRECTORIO_PRECIOS, TAMANO_LOTE_TICKERS, proveedor_actual, refresco_precios, resoluciones, ticker_yf,
+    ttl_cotizacion
+)
+
+log = logging.getLogger(__name__)
+
+# Primer día que se pide para un ticker sin histórico si no se indica otro
+FECHA_INICIO_HISTORICO = '2015-01-01'
+
+
+class AlmacenPrecios:
+    """Tabla cierres(ticker, fecha, cierre) con clave (ticker, fecha) en un fichero SQLite."""
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._creado = False
+        # Última actualización de cada ticker en este proceso, para no repetirla en cada rerun
+        self._actualizados = {}
+        # Fecha más antigua ya pedida de cada ticker en este proceso, para no repetir el relleno hacia atrás
+        self._inicios_pedidos = {}
+        # Históricos encargados al hilo de refresco: {ticker: fecha desde la que se quieren (o None)}
+        self._encargos = {}
+        self._cerrojo = threading.Lock()
+        # Aumenta con cada guardado, para que quien cachea lecturas sepa cuándo rehacerlas
+        self.version = 0
+
+    def _conectar(self):
+        if not self._creado:
+            os.makedirs(os.path.dirname(self.ruta) or '.', exist_ok=True)
+        con = sqlite3.connect(self.ruta, timeout=30)
+        if not self._creado:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS cierres ("
+                " ticker TEXT NOT NULL, fecha TEXT NOT NULL, cierre REAL NOT NULL,"
+                " PRIMARY KEY (ticker, fecha)) WITHOUT ROWID"
+            )
+            self._creado = True
+        return con
+
+    def rangos_guardados(self, tickers):
+        """{ticker: (primera fecha, última fecha) guardadas} de los tickers que ya tienen histórico."""
+        tickers = list(tickers)
+        if not tickers:
+            return {}
+        with closing(self._conectar()) as con:
+            filas = con.execute(
+                f"SELECT ticker, MIN(fecha), MAX(fecha) FROM cierres WHERE ticker IN ({','.join('?' * len(tickers))})"
+                " GROUP BY ticker", tickers
+            ).fetchall()
+        return {ticker: (pd.Timestamp(primera), pd.Timestamp(ultima)) for ticker, primera, ultima in filas}
+
+    def ultimos_cierres(self, activos):
+        """{activo: último cierre guardado} de los activos con histórico, sin ir a la red."""
+        tickers = {}
+        for activo in activos:
+            tickers.setdefault(ticker_yf(activo), []).append(activo)
+        if not tickers:
+            return {}
+        with closing(self._conectar()) as con:
+            filas = con.execute(
+                "SELECT c.ticker, c.cierre FROM cierres c JOIN ("
+                f" SELECT ticker, MAX(fecha) AS fecha FROM cierres WHERE ticker IN ({','.join('?' * len(tickers))})"
+                " GROUP BY ticker) u ON c.ticker = u.ticker AND c.fecha = u.fecha", list(tickers)
+            ).fetchall()
+        return {activo: cierre for ticker, cierre in filas for activo in tickers[ticker]}
+
+    def guardar(self, ticker, cierres):
+        """Guarda (o sustituye) los cierres de una Series indexada por fecha."""
+        cierres = cierres.dropna()
+        filas = [(ticker, fecha.strftime('%Y-%m-%d'), float(cierre)) for fecha, cierre in cierres.items()]
+        with closing(self._conectar()) as con, con:
+            con.executemany("INSERT OR REPLACE INTO cierres VALUES (?, ?, ?)", filas)
+        if filas:
+            with self._cerrojo:
+                self.version += 1
+        return len(filas)
+
+    def rango(self, ticker, desde=None, hasta=None):
+        """Cierres guardados de 'ticker' entre 'desde' y 'hasta' (incluidos) como Series por fecha."""
+        consulta = "SELECT fecha, cierre FROM cierres WHERE ticker = ?"
+        parametros = [ticker]
+        if desde is not None:
+            consulta += " AND fecha >= ?"
+            parametros.append(pd.Timestamp(desde).strftime('%Y-%m-%d'))
+        if hasta is not None:
+            consulta += " AND fecha <= ?"
+            parametros.append(pd.Timestamp(hasta).strftime('%Y-%m-%d'))
+        with closing(self._conectar()) as con:
+            filas = con.execute(consulta + " ORDER BY fecha", parametros).fetchall()
+        return pd.Series(
+            [cierre for _, cierre in filas],
+            index=pd.DatetimeIndex([fecha for fecha, _ in filas], name='fecha'),
+            name=ticker, dtype=float
+        )
+
+    def actualizar(self, tickers, desde=None):
+        """
+        Descarga lo que falta de cada ticker: desde su último cierre guardado (que se vuelve a pedir
+        por si era una sesión sin cerrar) y, si 'desde' es anterior a su primer cierre guardado, el
+        tramo entre 'desde' y ese primer cierre. Los tickers sin histórico empiezan en 'desde' o en
+        FECHA_INICIO_HISTORICO. Las peticiones con el mismo rango van juntas como multi-ticker.
+        Retorna {ticker: filas guardadas}.
+        """
+        ahora = time.monotonic()
+        desde = None if desde is None or pd.isna(desde) else pd.Timestamp(desde).normalize()
+        with self._cerrojo:
+            adelante = set()
+            for ticker in dict.fromkeys(tickers):
+                if ahora - self._actualizados.get(ticker, -float('inf')) >= ttl_cotizacion(ticker):
+                    self._actualizados[ticker] = ahora
+                    adelante.add(ticker)
+            # El relleno hacia atrás se intenta una vez por fecha: si el proveedor no tiene nada
+            # anterior no se vuelve a pedir en cada llamada
+            atras = {ticker for ticker in dict.fromkeys(tickers)
+                     if desde is not None and desde < self._inicios_pedidos.get(ticker, pd.Timestamp.max)}
+            for ticker in atras:
+                self._inicios_pedidos[ticker] = desde
+        rangos = self.rangos_guardados(adelante | atras)
+
+        # Símbolo a pedir por ticker según la resolución aprendida; los que no tienen datos se saltan
+        fin = (pd.Timestamp.today().normalize() + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+        por_rango = {}
+        for ticker in dict.fromkeys(tickers):
+            if ticker not in adelante and ticker not in atras:
+                continue
+            conocido, simbolo = resoluciones.consultar(ticker)
+            if conocido and simbolo is None:
+                continue
+            simbolo = simbolo if conocido else ticker
+            if ticker not in rangos:
+                inicio = desde if desde is not None else pd.Timestamp(FECHA_INICIO_HISTORICO)
+                with self._cerrojo:
+                    self._inicios_pedidos[ticker] = min(self._inicios_pedidos.get(ticker, inicio), inicio)
+                por_rango.setdefault((inicio.strftime('%Y-%m-%d'), fin), {})[simbolo] = ticker
+                continue
+            primera, ultima = rangos[ticker]
+            if ticker in adelante:
+                por_rango.setdefault((ultima.strftime('%Y-%m-%d'), fin), {})[simbolo] = ticker
+            if ticker in atras and desde < primera:
+                por_rango.setdefault(
+                    (desde.strftime('%Y-%m-%d'), primera.strftime('%Y-%m-%d')), {}
+                )[simbolo] = ticker
+
+        guardadas = {}
+        for (inicio, fin_rango), simbolos in por_rango.items():
+            lista = list(simbolos)
+            for i in range(0, len(lista), TAMANO_LOTE_TICKERS):
+                lote = lista[i:i + TAMANO_LOTE_TICKERS]
+                try:
+                    cierres = proveedor_actual().cierres(lote, inicio=inicio, fin=fin_rango)
+                except Exception as e:
+                    log.warning("Error descargando histórico de %s: %s", lote, e)
+                    continue
+                for simbolo in cierres.columns:
+                    if simbolo in simbolos:
+                        ticker = simbolos[simbolo]
+                        guardadas[ticker] = guardadas.get(ticker, 0) + self.guardar(ticker, cierres[simbolo])
+        return guardadas
+
+    def pedir(self, activos, desde=None):
+        """
+        Encarga al hilo de refresco de precios completar el histórico de 'activos' desde 'desde',
+        sin esperar a la red. Los encargos se quedan: en cada refresco se piden también los cierres nuevos.
+        """
+        desde = None if desde is None or pd.isna(desde) else pd.Timestamp(desde).normalize()
+        nuevos = False
+        with self._cerrojo:
+            for activo in activos:
+                ticker = ticker_yf(activo)
+                if ticker not in self._encargos:
+                    self._encargos[ticker] = desde
+                    nuevos = True
+                elif desde is not None and (self._encargos[ticker] is None or desde < self._encargos[ticker]):
+                    self._encargos[ticker] = desde
+                    nuevos = True
+        if nuevos:
+            refresco_precios.seguir(())
+            refresco_precios.refrescar_ahora()
+
+    def completar_encargos(self, activos=None):
+        """Tarea del hilo de refresco: descarga lo que falta de los históricos encargados con pedir()."""
+        with self._cerrojo:
+            encargos = dict(self._encargos)
+        por_desde = {}
+        for ticker, desde in encargos.items():
+            por_desde.setdefault(desde, []).append(ticker)
+        for desde, tickers in por_desde.items():
+            self.actualizar(tickers, desde=desde)
+
+    def cierres_activos(self, activos, desde=None, hasta=None, actualizar=True):
+        """
+        Cierres diarios de varios activos (columnas) entre dos fechas, leídos del almacén tras
+        completarlo con actualizar() si se pide. Sin actualizar se lee lo que ya hay y lo que falta
+        se encarga con pedir() al hilo de refresco.
+        """
+        desde = None if pd.isna(desde) else desde
+        tickers = {activo: ticker_yf(activo) for activo in activos}
+        if actualizar:
+            try:
+                self.actualizar(tickers.values(), desde=desde)
+            except Exception as e:
+                log.warning("No se pudo actualizar el histórico: %s", e)
+        else:
+            self.pedir(activos, desde)
+        return pd.DataFrame({activo: self.rango(ticker, desde, hasta) for activo, ticker in tickers.items()})
+
+
+almacen_precios = AlmacenPrecios(os.path.join(DIRECTORIO_PRECIOS, 'historico.sqlite'))
+refresco_precios.sembrar_con(almacen_precios.ultimos_cierres)
+refresco_precios.al_refrescar(almacen_precios.completar_encargos)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Importación de transacciones desde los ficheros de los brókers.
+
+Los CSV y los .xlsx se leen por bloques de FILAS_BLOQUE filas (los .xlsx fila a fila con openpyxl
+en modo de solo lectura): el mapeo de columnas se decide una vez con la cabecera y cada bloque se
+convierte y se limpia por separado, así que la memoria de la lectura no crece con el tamaño del
+fichero. Los .xls antiguos no admiten lectura por bloques y se leen enteros.
+"""
+import itertools
+import os
+
+import pandas as pd
+from openpyxl import load_workbook
+
+# Filas por bloque al leer un CSV
+FILAS_BLOQUE = int(os.environ.get('IMPORTACION_FILAS_BLOQUE', 100_000))
+
+
+def mapear_columnas(columnas, necesarias):
+    """
+    {columna del fichero: columna del libro}: para cada columna necesaria, la del fichero que se
+    llama igual o, si no hay, la primera que contiene su nombre (sin distinguir mayúsculas).
+    """
+    mapeo = {}
+    for col in necesarias:
+        candidatas = [c for c in columnas if c not in mapeo and col in str(c).lower()]
+        exactas = [c for c in candidatas if str(c).lower() == col]
+        if candidatas:
+            mapeo[(exactas or candidatas)[0]] = col
+    return mapeo
+
+
+def convertir_bloque(df, necesarias):
+    """Tipos del libro y filas completas: descarta las que no tienen alguna de las columnas necesarias."""
+    df['cantidad'] = pd.to_numeric(df['cantidad'], errors='coerce')
+    df['precio_unitario'] = pd.to_numeric(df['precio_unitario'], errors='coerce')
+    df['fecha'] = pd.to_datetime(df['fecha'], errors='coerce')
+    df['activo'] = df['activo'].astype(str)
+    df['tipo_activo'] = df['tipo_activo'].astype(str)
+    df['tipo'] = df['tipo'].str.lower().replace({'buy': 'compra', 'sell': 'venta'})
+    return df.dropna(subset=necesarias)
+
+
+def bloques_excel(archivo, filas_bloque=FILAS_BLOQUE):
+    """
+    Genera (bloque, fracción de filas leída) de la primera hoja de un .xlsx sin cargarla entera,
+    con la primera fila como cabecera (las celdas vacías se llaman 'Unnamed: <n>', como en
+    pd.read_excel).
+    """
+    libro = load_workbook(archivo, read_only=True, data_only=True)
+    try:
+        hoja = libro.worksheets[0]
+        filas = hoja.iter_rows(values_only=True)
+        cabecera = next(filas, None)
+        if cabecera is None:
+            return
+        columnas = [f"Unnamed: {i}" if c is None else c for i, c in enumerate(cabecera)]
+        # max_row sale de las dimensiones guardadas en el fichero; sin ellas no hay fracción
+        total = (hoja.max_row or 0) - 1
+        leidas = 0
+        while True:
+            lote = list(itertools.islice(filas, filas_bloque))
+            if not lote:
+                break
+            leidas += len(lote)
+            yield pd.DataFrame(lote, columns=columnas), min(leidas / total, 1.0) if total > 0 else 1.0
+    finally:
+        libro.close()
+
+
+def importar_por_bloques(archivo, necesarias, filas_bloque=FILAS_BLOQUE):
+    """
+    Genera (bloque, fracción del fichero leída) con las transacciones de 'archivo' (un CSV o un
+    Excel, por ruta o como fichero subido) ya renombradas y convertidas. Lanza ValueError si
+    tras renombrar faltan columnas necesarias o hay columnas duplicadas.
+    """
+    nombre = getattr(archivo, 'name', str(archivo))
+    if nombre.endswith('.csv'):
+        tamaño = getattr(archivo, 'size', None)
+        # Posición en el fichero que deja el lector tras el bloque (aproximada: lee con búfer)
+        lector = (
+            (bloque, min(archivo.tell() / tamaño, 1.0) if tamaño and hasattr(archivo, 'tell') else 1.0)
+            for bloque in pd.read_csv(archivo, chunksize=filas_bloque)
+        )
+    elif nombre.endswith(('.xlsx', '.xlsm')):
+        lector = bloques_excel(archivo, filas_bloque)
+    else:
+        lector = [(pd.read_excel(archivo), 1.0)]
+
+    mapeo = None
+    for bloque, leido in lector:
+        if mapeo is None:
+            mapeo = mapear_columnas(bloque.columns, necesarias)
+            columnas = bloque.columns.map(lambda c: mapeo.get(c, c))
+            if columnas.duplicated().any():
+                raise ValueError(f"Columnas duplicadas tras renombrar: {columnas[columnas.duplicated()].tolist()}")
+            faltantes = [c for c in necesarias if c not in columnas]
+            if faltantes:
+                raise ValueError(f"Faltan columnas necesarias: {faltantes}")
+        yield convertir_bloque(bloque.rename(columns=mapeo), necesarias), leido
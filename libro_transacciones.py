@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Índice del libro de transacciones de la sesión en SQLite: por cada fila, su posición en el
+DataFrame (id_fila), fecha, activo, tipo_activo y tipo, con el año de la fecha como columna
+generada e indexada.
+
+Se mantiene en paralelo a st.session_state.df_transacciones con los mismos ganchos que el estado
+FIFO (añadir, eliminar, cargar), y las ventanas que solo necesitan una parte del libro (selector
+de activos, primeras fechas, años fiscales) la piden con una consulta en vez de filtrar el
+DataFrame entero en cada rerun. Solo guarda las columnas por las que se consulta: importes y
+comisiones siguen solo en el DataFrame.
+
+Por defecto la base es temporal en disco (ruta ''): SQLite solo tiene en memoria su caché de
+páginas, no una segunda copia del libro por sesión.
+"""
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+from registros import normalizar
+
+COLUMNAS = ['fecha', 'activo', 'tipo_activo', 'tipo']
+
+# Las consultas de valores distintos saltan de un valor al siguiente por estos índices
+INDICES = {
+    'ix_activo_fecha': '(activo, fecha)',
+    'ix_tipo_activo': '(tipo_activo, activo)',
+    'ix_año': '(año)',
+    'ix_tipo_año': '(tipo, año)',
+    'ix_tipo_tipo_activo_año': '(tipo, tipo_activo, año)',
+}
+
+
+class LibroTransacciones:
+    """Tabla transacciones(id_fila, fecha, activo, tipo_activo, tipo, año) en SQLite (temporal por defecto)."""
+
+    def __init__(self, ruta=''):
+        self.ruta = ruta
+        self._con = sqlite3.connect(ruta, check_same_thread=False)
+        self._cerrojo = threading.Lock()
+        if ruta == '':
+            # Base temporal de la sesión: no hace falta sobrevivir a una caída
+            self._con.execute("PRAGMA journal_mode = OFF")
+            self._con.execute("PRAGMA synchronous = OFF")
+        with self._con:
+            self._con.execute(
+                "CREATE TABLE IF NOT EXISTS transacciones (id_fila INTEGER NOT NULL, fecha TEXT, activo TEXT, "
+                "tipo_activo TEXT, tipo TEXT, "
+                "año INTEGER GENERATED ALWAYS AS (CAST(substr(fecha, 1, 4) AS INTEGER)) VIRTUAL)"
+            )
+            self._crear_indices()
+
+    def _crear_indices(self):
+        for nombre, columnas in INDICES.items():
+            self._con.execute(f"CREATE INDEX IF NOT EXISTS {nombre} ON transacciones {columnas}")
+
+    @classmethod
+    def desde_libro(cls, transacciones, ruta=''):
+        libro = cls(ruta)
+        libro.añadir_libro(transacciones)
+        return libro
+
+    def __len__(self):
+        with self._cerrojo:
+            return self._con.execute("SELECT COUNT(*) FROM transacciones").fetchone()[0]
+
+    def añadir_libro(self, transacciones):
+        """
+        Inserta las filas de un DataFrame; su índice es la posición (id_fila) en el libro de la sesión.
+        Un bloque al menos tan grande como la tabla se inserta sin índices y estos se rehacen después,
+        que es mucho más rápido que mantenerlos fila a fila.
+        """
+        df = normalizar(transacciones[[c for c in COLUMNAS if c in transacciones.columns]])
+        n = len(df)
+        columnas = [np.asarray(df.index, dtype=np.int64).tolist()]
+        for col in COLUMNAS:
+            if col == 'fecha' and col in df.columns:
+                fechas = df['fecha'].to_numpy('datetime64[s]')
+                valores = pd.Series(np.datetime_as_string(fechas, unit='s'), index=df.index).where(~np.isnat(fechas))
+            elif col in df.columns:
+                valores = df[col]
+            else:
+                valores = pd.Series([None] * n, dtype=object)
+            # Los vacíos van como NULL; tolist() deja tipos nativos de Python
+            columnas.append(valores.astype(object).where(valores.notna(), None).tolist())
+        with self._cerrojo, self._con:
+            reindexar = n >= self._con.execute("SELECT COUNT(*) FROM transacciones").fetchone()[0]
+            if reindexar:
+                for nombre in INDICES:
+                    self._con.execute(f"DROP INDEX IF EXISTS {nombre}")
+            self._con.executemany(
+                f"INSERT INTO transacciones (id_fila, {', '.join(COLUMNAS)}) "
+                f"VALUES ({', '.join('?' * (len(COLUMNAS) + 1))})", zip(*columnas)
+            )
+            if reindexar:
+                self._crear_indices()
+
+    def eliminar(self, ids):
+        """Borra filas por id_fila y renumera las siguientes como hace reset_index en la sesión."""
+        ids = sorted(int(i) for i in ids)
+        with self._cerrojo, self._con:
+            self._con.execute("CREATE TEMP TABLE IF NOT EXISTS borrados (id_fila INTEGER PRIMARY KEY)")
+            self._con.execute("DELETE FROM borrados")
+            self._con.executemany("INSERT INTO borrados VALUES (?)", [(i,) for i in ids])
+            self._con.execute("DELETE FROM transacciones WHERE id_fila IN (SELECT id_fila FROM borrados)")
+            self._con.execute(
+                "UPDATE transacciones SET id_fila = id_fila - "
+                "(SELECT COUNT(*) FROM borrados b WHERE b.id_fila < transacciones.id_fila)"
+            )
+
+    def _consultar(self, consulta, parametros=()):
+        with self._cerrojo:
+            return self._con.execute(consulta, parametros).fetchall()
+
+    @staticmethod
+    def _filtros(activos=None, tipos_activo=None, tipo=None, desde=None, hasta=None):
+        condiciones, parametros = [], []
+        if activos is not None:
+            activos = list(activos)
+            condiciones.append(f"activo IN ({', '.join('?' * len(activos))})")
+            parametros += activos
+        if tipos_activo is not None:
+            tipos_activo = list(tipos_activo)
+            condiciones.append(f"tipo_activo IN ({', '.join('?' * len(tipos_activo))})")
+            parametros += tipos_activo
+        if tipo is not None:
+            condiciones.append("tipo = ?")
+            parametros.append(tipo)
+        if desde is not None:
+            condiciones.append("fecha >= ?")
+            parametros.append(pd.Timestamp(desde).isoformat())
+        if hasta is not None:
+            condiciones.append("fecha <= ?")
+            parametros.append(pd.Timestamp(hasta).isoformat())
+        return (" WHERE " + " AND ".join(condiciones)) if condiciones else "", parametros
+
+    def _distintos(self, columna, **filtros):
+        """
+        Valores distintos y ordenados de 'columna' entre las filas que cumplen los filtros. Se
+        recorren saltando de un valor al siguiente con MIN(columna) > anterior, una búsqueda en
+        un índice por valor en vez de leer todas las filas como haría SELECT DISTINCT. Con varios
+        tipos de activo se recorre cada uno por separado, que es lo que sabe hacer el índice.
+        """
+        tipos_activo = filtros.get('tipos_activo')
+        if tipos_activo is not None and len(tipos_activo) != 1:
+            return sorted(set().union(*(
+                self._distintos(columna, **{**filtros, 'tipos_activo': [t]}) for t in tipos_activo
+            )))
+        donde, parametros = self._filtros(**filtros)
+        y = " AND" if donde else " WHERE"
+        filas = self._consultar(
+            f"WITH RECURSIVE valores(valor) AS ("
+            f"SELECT MIN({columna}) FROM transacciones{donde} "
+            f"UNION ALL SELECT (SELECT MIN({columna}) FROM transacciones{donde}{y} {columna} > valores.valor) "
+            f"FROM valores WHERE valores.valor IS NOT NULL"
+            f") SELECT valor FROM valores WHERE valor IS NOT NULL",
+            parametros + parametros
+        )
+        return [valor for valor, in filas]
+
+    def activos(self, tipos_activo=None):
+        """Activos distintos, ordenados."""
+        return self._distintos('activo', tipos_activo=tipos_activo)
+
+    def tipos_activo(self):
+        return self._distintos('tipo_activo')
+
+    def años(self, tipo=None, tipos_activo=None):
+        """Años con transacciones (de un tipo y de ciertos tipos de activo, si se indica)."""
+        return self._distintos('año', tipo=tipo, tipos_activo=tipos_activo)
+
+    def primera_fecha(self, activo):
+        """Fecha de la primera transacción de un activo (NaT si no tiene)."""
+        fecha, = self._consultar("SELECT MIN(fecha) FROM transacciones WHERE activo = ?", (activo,))[0]
+        return pd.Timestamp(fecha) if fecha is not None else pd.NaT
+
+    def transacciones(self, activos=None, tipos_activo=None, tipo=None, desde=None, hasta=None):
+        """
+        Columnas indexadas de las filas que cumplen los filtros, ordenadas por activo y fecha, con
+        id_fila como índice (el resto de columnas se toma del DataFrame de la sesión con .loc).
+        """
+        donde, parametros = self._filtros(activos, tipos_activo, tipo, desde, hasta)
+        with self._cerrojo:
+            df = pd.read_sql_query(
+                f"SELECT id_fila, {', '.join(COLUMNAS)} FROM transacciones{donde} ORDER BY activo, fecha, id_fila",
+                self._con,
+                params=parametros, index_col='id_fila'
+            )
+        df.index.name = None
+        return normalizar(df)
@@ -0,0 +1,1117 @@
+# -*- coding: utf-8 -*-
+"""
+Motor FIFO compartido por las ventanas de la app.
+
+Recorre el libro de transacciones una sola vez y devuelve a la vez los
+tramos de venta emparejados, los lotes abiertos y el resumen por activo.
+"""
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+try:
+    from numba import njit  # opcional: compila el núcleo FIFO si está instalado
+except ImportError:
+    njit = None
+
+
+# Libros con al menos estas filas se emparejan repartiendo los activos entre procesos
+UMBRAL_FILAS_PARALELO = int(os.environ.get('FIFO_UMBRAL_PARALELO', 500_000))
+
+# Unidades enteras por unidad de activo en el modo de punto fijo (satoshis para BTC)
+ESCALA_CANTIDAD = 10**8
+
+# Máximo de unidades compradas (o vendidas) acumuladas por activo en punto fijo: los acumulados
+# del emparejador vectorizado y los búferes del núcleo son int64
+LIMITE_UNIDADES = 2**62
+
+# Holgura con la que EstadoFIFO reduce la escala de un activo que no cabe: sus acumulados pueden
+# multiplicarse por este factor con altas nuevas antes de tener que reducirla otra vez
+MARGEN_ESCALA = 100
+
+# Códigos de 'tipo' con los que trabajan los emparejadores
+COMPRA = 1
+VENTA = 2
+
+
+COLUMNAS_TRAMOS = [
+    'activo', 'tipo_activo', 'id_venta', 'fecha_venta', 'cantidad',
+    'precio_compra', 'precio_venta', 'ganancia'
+]
+COLUMNAS_LOTES = ['activo', 'fecha_compra', 'cantidad', 'precio']
+COLUMNAS_RESUMEN = [
+    'activo', 'tipo_activo', 'num_transacciones', 'posicion', 'precio_medio',
+    'coste_abierto', 'unidades_compradas', 'inversion_compras',
+    'unidades_vendidas', 'ingreso_ventas', 'inversion_ventas', 'ganancia_realizada'
+]
+
+
+class DesbordePuntoFijo(ValueError):
+    """Las cantidades acumuladas de algún activo no caben en punto fijo int64 con su escala."""
+
+
+class ResultadoFIFO:
+    """
+    Resultado de una pasada FIFO sobre el libro completo.
+    tramos: una fila por cada par (venta, lote de compra) emparejado.
+    lotes: lotes de compra que siguen abiertos, en orden FIFO.
+    resumen: una fila por activo con posición, precio medio, ventas y ganancias.
+    """
+
+    def __init__(self, tramos, lotes, resumen):
+        self.tramos = tramos
+        self.lotes = lotes
+        self.resumen = resumen
+
+    def tramos_activo(self, activo):
+        return self.tramos[self.tramos['activo'] == activo]
+
+    def lotes_activo(self, activo):
+        return self.lotes[self.lotes['activo'] == activo]
+
+
+class Lote:
+    """Lote de compra abierto: posición de la compra en el libro, fecha, cantidad restante y precio."""
+    __slots__ = ('pos', 'fecha', 'cantidad', 'precio')
+
+    def __init__(self, pos, fecha, cantidad, precio):
+        self.pos = pos
+        self.fecha = fecha
+        self.cantidad = cantidad
+        self.precio = precio
+
+
+class ColaLotes:
+    """
+    Cola FIFO de lotes abiertos sobre un deque (consumo O(1) por delante) que mantiene al día
+    la cantidad y el coste totales, de modo que posición y precio medio son lecturas O(1).
+    """
+    __slots__ = ('_lotes', 'cantidad', 'coste')
+
+    def __init__(self):
+        self._lotes = deque()
+        self.cantidad = 0
+        self.coste = 0.0
+
+    def __len__(self):
+        return len(self._lotes)
+
+    def __iter__(self):
+        return iter(self._lotes)
+
+    @property
+    def posicion(self):
+        return self.cantidad
+
+    @property
+    def precio_medio(self):
+        return self.coste / self.cantidad if self.cantidad > 0 else 0
+
+    def añadir(self, cantidad, precio, pos=None, fecha=None):
+        if not cantidad > 0:
+            return  # una compra sin cantidad (p. ej. toda en comisión) no abre lote
+        self._lotes.append(Lote(pos, fecha, cantidad, precio))
+        self.cantidad += cantidad
+        self.coste += cantidad * precio
+
+    def consumir(self, cantidad_a_vender):
+        """
+        Saca cantidad_a_vender de los lotes más antiguos.
+        Retorna lista de (pos, precio, cantidad_usada) por cada lote tocado; si no hay lotes
+        suficientes, el resto de la venta queda sin emparejar.
+        """
+        lotes = self._lotes
+        tramos = []
+        while cantidad_a_vender > 0 and lotes:
+            lote = lotes[0]
+            if lote.cantidad <= cantidad_a_vender:
+                cantidad_usada = lote.cantidad
+                lotes.popleft()
+            else:
+                cantidad_usada = cantidad_a_vender
+                lote.cantidad -= cantidad_usada
+            cantidad_a_vender -= cantidad_usada
+            self.cantidad -= cantidad_usada
+            self.coste -= cantidad_usada * lote.precio
+            tramos.append((lote.pos, lote.precio, cantidad_usada))
+        if not lotes:
+            # Sin lotes los totales son exactamente cero; evita arrastrar residuos de redondeo
+            self.cantidad = 0
+            self.coste = 0.0
+        return tramos
+
+
+# --- Emparejadores por activo ---
+# Todos reciben las columnas 'tipo' (codificada con COMPRA/VENTA), 'cantidad' y 'precio_unitario'
+# de un único activo ya ordenadas por fecha y devuelven posiciones dentro de esas columnas:
+#   (pos_venta, pos_compra, cantidad) de cada tramo y (pos_compra, cantidad_restante) de cada lote abierto.
+
+def _emparejar_cola(tipos, cantidades, precios):
+    """Emparejamiento secuencial con una ColaLotes."""
+    cola = ColaLotes()
+    pos_venta, pos_compra, cantidad_tramo = [], [], []
+
+    for pos, (tipo, cantidad, precio) in enumerate(zip(tipos.tolist(), cantidades.tolist(), precios.tolist())):
+        if tipo == COMPRA:
+            cola.añadir(cantidad, precio, pos)
+        elif tipo == VENTA:
+            for pos_lote, _, cantidad_usada in cola.consumir(cantidad):
+                pos_venta.append(pos)
+                pos_compra.append(pos_lote)
+                cantidad_tramo.append(cantidad_usada)
+
+    return (pos_venta, pos_compra, cantidad_tramo,
+            [l.pos for l in cola], [l.cantidad for l in cola])
+
+
+def _acumulados(tipos, cantidades):
+    """
+    (cantidades, compras_acum, emparejado_acum) de un activo: unidades compradas y unidades vendidas
+    que encontraron lote acumuladas hasta cada fila. La parte de una venta que supera la posición de
+    ese momento se descarta, igual que en la cola (M_t = min(M_t-1 + venta_t, compras_t)). Las
+    cantidades vacías (NaN) o no positivas no mueven la cola, como en los otros modos, y se devuelven a 0.
+    """
+    cantidades = np.where(cantidades > 0, cantidades, 0)
+    compras_acum = np.cumsum(np.where(tipos == COMPRA, cantidades, 0))
+    ventas_acum = np.cumsum(np.where(tipos == VENTA, cantidades, 0))
+    emparejado_acum = ventas_acum + np.minimum(np.minimum.accumulate(compras_acum - ventas_acum), 0)
+    return cantidades, compras_acum, emparejado_acum
+
+
+def _tolerancia(cantidades, total):
+    """Margen con el que se comparan bordes del eje acumulado: 0 en punto fijo, relativo en coma flotante."""
+    if np.issubdtype(cantidades.dtype, np.integer):
+        return 0
+    return max(abs(total), 1.0) * 1e-12
+
+
+def _emparejar_vectorizado(tipos, cantidades, precios):
+    """
+    Emparejamiento con cantidades acumuladas y searchsorted, sin bucle sobre lotes.
+    Las unidades compradas y las vendidas se colocan cada una sobre su eje acumulado; como FIFO
+    consume las compras en orden, la unidad vendida k-ésima es la unidad comprada k-ésima y cada
+    tramo es un segmento entre bordes consecutivos de ambos ejes.
+    """
+    cantidades, compras_acum, emparejado_acum = _acumulados(tipos, cantidades)
+    es_compra = tipos == COMPRA
+    es_venta = tipos == VENTA
+    total = emparejado_acum[-1] if len(emparejado_acum) else 0
+
+    idx_compras = np.flatnonzero(es_compra & (cantidades > 0))
+    fin_compras = compras_acum[idx_compras]
+    emparejado_venta = np.diff(emparejado_acum, prepend=0)
+    idx_ventas = np.flatnonzero(es_venta & (emparejado_venta > 0))
+    fin_ventas = emparejado_acum[idx_ventas]
+
+    # Bordes de tramo: fin de cada venta y de cada compra hasta el total emparejado.
+    # En punto fijo los bordes son exactos; en coma flotante se funden los casi iguales.
+    # El tramo que empieza en 'inicio' pertenece a la primera venta/compra cuyo fin supera
+    # 'inicio' en al menos 'paso' (una unidad entera o la tolerancia).
+    tolerancia = _tolerancia(cantidades, total)
+    paso = tolerancia or 1
+    bordes = np.union1d(fin_ventas, fin_compras[fin_compras < total - tolerancia])
+    bordes = bordes[bordes > tolerancia]
+    if len(bordes):
+        bordes = bordes[np.diff(bordes, prepend=0) > tolerancia]
+        inicios = np.concatenate((np.zeros(1, dtype=bordes.dtype), bordes[:-1]))
+        pos_venta = idx_ventas[np.searchsorted(fin_ventas, inicios + paso, side='left')]
+        pos_compra = idx_compras[np.searchsorted(fin_compras, inicios + paso, side='left')]
+        cantidad_tramo = bordes - inicios
+    else:
+        # Ninguna venta encontró lote (solo compras, solo ventas o ventas antes de comprar):
+        # no hay tramos y todas las compras siguen abiertas
+        pos_venta = pos_compra = np.empty(0, dtype=np.intp)
+        cantidad_tramo = np.empty(0, dtype=cantidades.dtype)
+
+    abiertas = fin_compras > total + tolerancia
+    pos_lotes = idx_compras[abiertas]
+    inicio_lotes = np.maximum(fin_compras[abiertas] - cantidades[pos_lotes], total)
+    return pos_venta, pos_compra, cantidad_tramo, pos_lotes, fin_compras[abiertas] - inicio_lotes
+
+
+def _nucleo_fifo(limites, tipos, cantidades, lotes_pos, lotes_cant, tramo_venta, tramo_compra, tramo_cant):
+    """
+    Núcleo FIFO al estilo compilado para todos los activos de una vez: solo índices y escalares
+    sobre búferes reservados de antemano, sin objetos por lote ni listas que crecen.
+    Los lotes de cada activo forman una cola lotes_*[cabeza:final] que empieza tras los lotes
+    abiertos de los activos anteriores; al acabar el activo, sus abiertos se compactan a
+    continuación. Cada tramo cierra un lote o termina una venta, así que nunca hay más tramos
+    que filas. Retorna (num_tramos, num_abiertos).
+    """
+    num_tramos = 0
+    num_abiertos = 0
+    for activo in range(len(limites) - 1):
+        cabeza = num_abiertos
+        final = num_abiertos
+        for pos in range(limites[activo], limites[activo + 1]):
+            cantidad = cantidades[pos]
+            if tipos[pos] == COMPRA:
+                if cantidad > 0:
+                    lotes_pos[final] = pos
+                    lotes_cant[final] = cantidad
+                    final += 1
+            elif tipos[pos] == VENTA:
+                resto = cantidad
+                while resto > 0 and cabeza < final:
+                    lote = cabeza
+                    disponible = lotes_cant[lote]
+                    if disponible <= resto:
+                        usada = disponible
+                        cabeza += 1
+                    else:
+                        usada = resto
+                        lotes_cant[lote] = disponible - usada
+                    resto -= usada
+                    tramo_venta[num_tramos] = pos
+                    tramo_compra[num_tramos] = lotes_pos[lote]
+                    tramo_cant[num_tramos] = usada
+                    num_tramos += 1
+        for lote in range(cabeza, final):
+            lotes_pos[num_abiertos] = lotes_pos[lote]
+            lotes_cant[num_abiertos] = lotes_cant[lote]
+            num_abiertos += 1
+    return num_tramos, num_abiertos
+
+
+_nucleo_compilado = njit(cache=True)(_nucleo_fifo) if njit is not None else None
+
+
+def _emparejar_nucleo(limites, tipos, cantidades):
+    """
+    Ejecuta _nucleo_fifo sobre los rangos 'limites'. Con numba trabaja directamente sobre arrays
+    de NumPy; sin él, el mismo código corre en Python sobre listas del tamaño final (indexar
+    listas es bastante más rápido que indexar arrays elemento a elemento) y se pasan a arrays al final.
+    """
+    n = len(tipos)
+    if _nucleo_compilado is not None:
+        buferes = (np.empty(n, dtype=np.intp), np.empty(n, dtype=cantidades.dtype),
+                   np.empty(n, dtype=np.intp), np.empty(n, dtype=np.intp), np.empty(n, dtype=cantidades.dtype))
+        num_tramos, num_abiertos = _nucleo_compilado(limites, tipos, cantidades, *buferes)
+    else:
+        buferes = tuple([0] * n for _ in range(5))
+        num_tramos, num_abiertos = _nucleo_fifo(limites.tolist(), tipos.tolist(), cantidades.tolist(), *buferes)
+    lotes_pos, lotes_cant, tramo_venta, tramo_compra, tramo_cant = buferes
+    return (
+        np.asarray(tramo_venta[:num_tramos], dtype=np.intp),
+        np.asarray(tramo_compra[:num_tramos], dtype=np.intp),
+        np.asarray(tramo_cant[:num_tramos], dtype=cantidades.dtype),
+        np.asarray(lotes_pos[:num_abiertos], dtype=np.intp),
+        np.asarray(lotes_cant[:num_abiertos], dtype=cantidades.dtype),
+    )
+
+
+EMPAREJADORES = {
+    'cola': _emparejar_cola,
+    'vectorizado': _emparejar_vectorizado,
+}
+# El modo 'nucleo' no va activo a activo: _emparejar_rangos le pasa todos los rangos de una vez
+
+
+def _codificar_tipos(tipos):
+    tipos = np.asarray(tipos, dtype=object)
+    return np.select([tipos == 'compra', tipos == 'venta'], [COMPRA, VENTA], 0).astype(np.int8)
+
+
+def _aplicar_comisiones(df):
+    """
+    Ajuste vectorizado de las comisiones (columnas 'comision' y 'divisa_comision') antes de emparejar:
+    - en especie (divisa_comision == activo): se descuentan de la cantidad comprada o, en una venta,
+      de la cantidad entregada (se consumen menos unidades de los lotes);
+    - en efectivo: se suman al coste de la compra y se restan del ingreso de la venta,
+      repartidas en el precio unitario.
+    Sin columna 'comision' el libro se deja tal cual.
+    """
+    if 'comision' not in df.columns:
+        return df
+    comision = pd.to_numeric(df['comision'], errors='coerce').fillna(0.0).to_numpy(dtype=float)
+    if 'divisa_comision' in df.columns:
+        en_especie = (
+            df['divisa_comision'].astype('string') == df['activo'].astype('string')
+        ).fillna(False).to_numpy(dtype=bool)
+    else:
+        en_especie = np.zeros(len(df), dtype=bool)
+    es_compra = (df['tipo'] == 'compra').to_numpy(dtype=bool)
+    es_venta = (df['tipo'] == 'venta').to_numpy(dtype=bool)
+
+    cantidad, precio = _ajustar_comisiones(
+        es_compra, es_venta, en_especie, comision, df['cantidad'].to_numpy(), df['precio_unitario'].to_numpy()
+    )
+    return df.assign(cantidad=cantidad, precio_unitario=precio)
+
+
+def _ajustar_comisiones(es_compra, es_venta, en_especie, comision, cantidad, precio):
+    """Cantidades y precios unitarios con las comisiones aplicadas, sobre columnas numpy."""
+    cantidad = np.where((es_compra | es_venta) & en_especie, np.maximum(cantidad - comision, 0.0), cantidad)
+    gasto = np.where(en_especie, 0.0, comision)
+    por_unidad = np.divide(gasto, cantidad, out=np.zeros(len(cantidad)), where=cantidad > 0)
+    precio = precio + np.select([es_compra, es_venta], [por_unidad, -por_unidad], 0.0)
+    return cantidad, precio
+
+
+def _preparar_libro(transacciones):
+    """
+    Copia con tipos numéricos y fechas coherentes, comisiones aplicadas, sin filas sin activo
+    e índice posicional.
+    """
+    df = transacciones.dropna(subset=['activo'])
+    df = df.assign(
+        cantidad=pd.to_numeric(df['cantidad'], errors='coerce').astype(float),
+        precio_unitario=pd.to_numeric(df['precio_unitario'], errors='coerce').astype(float),
+        fecha=pd.to_datetime(df['fecha'], errors='coerce'),
+        id_fila=df.index,
+    ).reset_index(drop=True)
+    if 'tipo_activo' not in df.columns:
+        df['tipo_activo'] = 'Desconocido'
+    return _aplicar_comisiones(df)
+
+
+def _particionar(transacciones):
+    """LibroParticionado de un DataFrame o de una tabla Arrow ya ordenada por activo y fecha."""
+    if isinstance(transacciones, pd.DataFrame):
+        return LibroParticionado(_preparar_libro(transacciones))
+    return LibroParticionado.desde_tabla(transacciones)
+
+
+class LibroParticionado:
+    """
+    Libro ordenado una sola vez por (activo, fecha) y partido en rangos contiguos por activo.
+    Las columnas ordenadas se copian una vez; cada activo se entrega al emparejador como vistas
+    [inicio:fin] de esas columnas, sin filtrar ni copiar el libro por activo.
+    """
+
+    def __init__(self, df):
+        codigos, activos = pd.factorize(df['activo'], sort=False)
+        # lexsort es estable: las transacciones del mismo día conservan su orden de registro
+        self.orden = np.lexsort((df['fecha'].to_numpy(), codigos))
+        self.activos = np.asarray(activos, dtype=object)
+        self.codigos = codigos[self.orden]
+        self.limites = np.concatenate((
+            [0], np.flatnonzero(np.diff(self.codigos)) + 1, [len(self.orden)]
+        )).astype(np.intp) if len(self.orden) else np.zeros(1, dtype=np.intp)
+
+        self.ids = df['id_fila'].to_numpy()[self.orden]
+        self.tipos = _codificar_tipos(df['tipo'].to_numpy()[self.orden])
+        self.cantidades = df['cantidad'].to_numpy()[self.orden]
+        self.precios = df['precio_unitario'].to_numpy()[self.orden]
+        self.fechas = df['fecha'].to_numpy()[self.orden]
+        self.tipos_activo = df['tipo_activo'].to_numpy()[self.orden]
+
+    @classmethod
+    def desde_tabla(cls, tabla):
+        """
+        Libro particionado sobre una tabla Arrow ya ordenada por (activo, fecha) con las filas sin
+        activo al final, la posición de cada fila en 'id_fila' y los textos codificados con
+        diccionario (ver registros.mapear_registro). No se ordena nada y las columnas numéricas
+        se leen sin copiar de los búferes de la tabla, que pueden estar mapeados en memoria; solo
+        las comisiones, si las hay, generan columnas nuevas de cantidad y precio. Los textos se
+        quedan en códigos (tipo_activo como Categorical) y solo se decodifican las filas que salen
+        en los resultados.
+        """
+        libro = cls.__new__(cls)
+        libro.orden = None  # la tabla ya viene ordenada
+        # Las filas sin activo cuentan en el libro pero no entran en el FIFO, como en _preparar_libro
+        sin_activo = tabla.column('activo').null_count
+        if sin_activo:
+            tabla = tabla.slice(0, tabla.num_rows - sin_activo)
+
+        codigos, activos = _codigos_diccionario(tabla, 'activo')
+        cambios = np.flatnonzero(np.diff(codigos)) + 1
+        libro.limites = np.concatenate(([0], cambios, [len(codigos)])).astype(np.intp)
+        if not len(codigos):
+            libro.limites = np.zeros(1, dtype=np.intp)
+        # Códigos 0..n-1 en el orden de la tabla, como los que salen de factorize en __init__
+        libro.activos = activos.to_numpy(zero_copy_only=False)[codigos[libro.limites[:-1]]]
+        libro.codigos = np.repeat(np.arange(len(libro.activos)), np.diff(libro.limites))
+
+        libro.ids = _columna(tabla, 'id_fila').to_numpy(zero_copy_only=False)
+        codigos_tipo, tipos = _codigos_diccionario(tabla, 'tipo')
+        libro.tipos = np.append(_codificar_tipos(tipos.to_numpy(zero_copy_only=False)), 0).astype(np.int8)[codigos_tipo]
+        libro.cantidades = _columna(tabla, 'cantidad').to_numpy(zero_copy_only=False)
+        libro.precios = _columna(tabla, 'precio_unitario').to_numpy(zero_copy_only=False)
+        libro.fechas = _columna(tabla, 'fecha').to_numpy(zero_copy_only=False)
+        if 'tipo_activo' in tabla.column_names:
+            codigos_tipo_activo, tipos_activo = _codigos_diccionario(tabla, 'tipo_activo')
+            libro.tipos_activo = pd.Categorical.from_codes(
+                np.where(codigos_tipo_activo == len(tipos_activo), -1, codigos_tipo_activo),
+                tipos_activo.to_numpy(zero_copy_only=False)
+            )
+        else:
+            libro.tipos_activo = pd.Categorical.from_codes(np.zeros(len(codigos), dtype=np.int8), ['Desconocido'])
+
+        if 'comision' in tabla.column_names:
+            comision = np.nan_to_num(_columna(tabla, 'comision').to_numpy(zero_copy_only=False))
+            if 'divisa_comision' in tabla.column_names:
+                # Se compara cada divisa de comisión con el activo por código, sin decodificar textos
+                codigos_divisa, divisas = _codigos_diccionario(tabla, 'divisa_comision')
+                divisa_a_activo = np.append(pc.index_in(divisas, value_set=activos).fill_null(-1).to_numpy(), -1)
+                en_especie = divisa_a_activo[codigos_divisa] == codigos
+            else:
+                en_especie = np.zeros(len(codigos), dtype=bool)
+            libro.cantidades, libro.precios = _ajustar_comisiones(
+                libro.tipos == COMPRA, libro.tipos == VENTA, en_especie, comision, libro.cantidades, libro.precios
+            )
+        return libro
+
+    def __len__(self):
+        return len(self.activos)
+
+    def rango(self, i):
+        return self.limites[i], self.limites[i + 1]
+
+    def suma_por_activo(self, valores):
+        """Suma 'valores' (ya en el orden del libro particionado) dentro de cada activo."""
+        if not len(self.activos):
+            return np.zeros(0)
+        return np.add.reduceat(valores, self.limites[:-1])
+
+
+def _columna(tabla, nombre):
+    """Columna de la tabla como un único array (sin copiar si ya es un solo bloque)."""
+    columna = tabla.column(nombre)
+    if columna.num_chunks == 1:
+        return columna.chunk(0)
+    return columna.combine_chunks()
+
+
+def _codigos_diccionario(tabla, nombre):
+    """
+    (códigos, diccionario) de una columna de texto codificada con diccionario (se codifica si no
+    lo está). Los nulos llevan el código len(diccionario).
+    """
+    columna = _columna(tabla, nombre)
+    if not pa.types.is_dictionary(columna.type):
+        columna = pc.dictionary_encode(columna)
+    codigos = pc.fill_null(columna.indices, len(columna.dictionary)).to_numpy(zero_copy_only=False)
+    return codigos, columna.dictionary
+
+
+def _resumir(libro, tramos, lotes):
+    """Agrega por activo las cifras de compras/ventas del libro y del emparejamiento."""
+    importe = libro.cantidades * libro.precios
+    es_compra = libro.tipos == COMPRA
+    es_venta = libro.tipos == VENTA
+
+    agregados = pd.DataFrame({
+        'num_transacciones': np.diff(libro.limites),
+        'unidades_compradas': libro.suma_por_activo(np.where(es_compra, libro.cantidades, 0.0)),
+        'inversion_compras': libro.suma_por_activo(np.where(es_compra, importe, 0.0)),
+        'unidades_vendidas': libro.suma_por_activo(np.where(es_venta, libro.cantidades, 0.0)),
+        'ingreso_ventas': libro.suma_por_activo(np.where(es_venta, importe, 0.0)),
+    }, index=pd.Index(libro.activos, name='activo'))
+    agregados['tipo_activo'] = pd.Series(libro.tipos_activo).groupby(libro.codigos).first().to_numpy()
+
+    abiertos = lotes.assign(coste=lotes['cantidad'] * lotes['precio']).groupby('activo')[['cantidad', 'coste']].sum()
+    agregados['posicion'] = abiertos['cantidad'].reindex(agregados.index, fill_value=0.0)
+    agregados['coste_abierto'] = abiertos['coste'].reindex(agregados.index, fill_value=0.0)
+    agregados['precio_medio'] = np.where(
+        agregados['posicion'] > 0,
+        agregados['coste_abierto'] / agregados['posicion'].where(agregados['posicion'] > 0, 1.0),
+        0.0
+    )
+
+    cerrados = tramos.assign(coste=tramos['cantidad'] * tramos['precio_compra']).groupby('activo')[['coste', 'ganancia']].sum()
+    agregados['inversion_ventas'] = cerrados['coste'].reindex(agregados.index, fill_value=0.0)
+    agregados['ganancia_realizada'] = cerrados['ganancia'].reindex(agregados.index, fill_value=0.0)
+
+    return agregados.reset_index()[COLUMNAS_RESUMEN]
+
+
+def _emparejar_rangos(modo, limites, tipos, cantidades, precios):
+    """
+    Empareja uno tras otro los activos delimitados por 'limites' sobre las columnas dadas.
+    Retorna (pos_venta, pos_compra, cantidad_tramo, pos_lotes, cantidad_lotes) con posiciones
+    relativas a esas columnas. Es también la tarea que ejecuta cada proceso en modo paralelo.
+    """
+    if modo == 'nucleo':
+        return _emparejar_nucleo(limites, tipos, cantidades)
+    emparejar = EMPAREJADORES[modo]
+    partes_tramos = []
+    partes_lotes = []
+    for inicio, fin in zip(limites[:-1].tolist(), limites[1:].tolist()):
+        pos_venta, pos_compra, cantidad_tramo, pos_lotes, cantidad_lotes = emparejar(
+            tipos[inicio:fin], cantidades[inicio:fin], precios[inicio:fin]
+        )
+        partes_tramos.append((
+            np.asarray(pos_venta, dtype=np.intp) + inicio,
+            np.asarray(pos_compra, dtype=np.intp) + inicio,
+            np.asarray(cantidad_tramo, dtype=cantidades.dtype),
+        ))
+        partes_lotes.append((
+            np.asarray(pos_lotes, dtype=np.intp) + inicio,
+            np.asarray(cantidad_lotes, dtype=cantidades.dtype),
+        ))
+    return (*_concatenar(partes_tramos, 3, cantidades.dtype), *_concatenar(partes_lotes, 2, cantidades.dtype))
+
+
+def _bloques_de_activos(limites, num_bloques):
+    """Reparte los activos en bloques contiguos con un número de filas parecido."""
+    objetivo = limites[-1] * np.arange(1, num_bloques) / num_bloques
+    cortes = np.unique(np.concatenate((
+        [0], np.searchsorted(limites, objetivo), [len(limites) - 1]
+    )))
+    return list(zip(cortes[:-1].tolist(), cortes[1:].tolist()))
+
+
+def _escalas_por_fila(libro, escala):
+    """Escala de punto fijo de cada fila del libro: un entero común o un dict {activo: escala}."""
+    if isinstance(escala, dict):
+        por_activo = np.array([escala.get(a, ESCALA_CANTIDAD) for a in libro.activos], dtype=np.int64)
+        return por_activo[libro.codigos]
+    return np.full(len(libro.codigos), escala, dtype=np.int64)
+
+
+def _escala_activo(escala, activo):
+    if isinstance(escala, dict):
+        return escala.get(activo, ESCALA_CANTIDAD)
+    return escala
+
+
+def _a_unidades(cantidad, escala):
+    """Cantidad de una transacción en unidades enteras (sin escala se deja tal cual)."""
+    if not escala:
+        return cantidad
+    return 0 if pd.isna(cantidad) else int(round(cantidad * escala))
+
+
+def _a_cantidad(unidades, escala):
+    return unidades / escala if escala else unidades
+
+
+def _error_punto_fijo(activos, escala):
+    return DesbordePuntoFijo(
+        f"Las cantidades de {', '.join(map(str, activos))} no caben en punto fijo int64 con escala "
+        f"{escala}; usa una escala menor para ese activo (escala={{activo: escala}})."
+    )
+
+
+def _a_punto_fijo(libro, escalas):
+    """
+    Cantidades del libro en unidades enteras int64 (las vacías cuentan como 0). Cada activo se
+    comprueba por separado: sus compras y sus ventas acumuladas deben quedar por debajo de LIMITE_UNIDADES.
+    """
+    unidades = np.rint(np.nan_to_num(libro.cantidades) * escalas)
+    if len(unidades):
+        inicios = libro.limites[:-1]
+        compradas = np.add.reduceat(np.where(libro.tipos == COMPRA, np.abs(unidades), 0.0), inicios)
+        vendidas = np.add.reduceat(np.where(libro.tipos == VENTA, np.abs(unidades), 0.0), inicios)
+        desbordan = np.flatnonzero(np.maximum(compradas, vendidas) >= LIMITE_UNIDADES)
+        if len(desbordan):
+            raise _error_punto_fijo(libro.activos[desbordan], escalas[inicios[desbordan[0]]])
+    return unidades.astype(np.int64)
+
+
+def _acumulados_por_activo(libro):
+    """Mayor de las cantidades compradas y vendidas acumuladas de cada activo, en unidades del activo."""
+    cantidades = np.abs(np.nan_to_num(libro.cantidades))
+    return np.maximum(libro.suma_por_activo(np.where(libro.tipos == COMPRA, cantidades, 0.0)),
+                      libro.suma_por_activo(np.where(libro.tipos == VENTA, cantidades, 0.0)))
+
+
+def _escalas_que_caben(libro, escala):
+    """
+    {activo: escala} de cada activo del libro: la pedida (entero o dict, como en calcular_fifo) o,
+    si sus acumulados no caben con ella bajo LIMITE_UNIDADES, la mayor escala 10, 100... veces
+    menor con la que caben con MARGEN_ESCALA de holgura.
+    """
+    escalas = {}
+    for activo, acumulado in zip(libro.activos.tolist(), _acumulados_por_activo(libro).tolist()):
+        escala_activo = _escala_activo(escala, activo)
+        if acumulado * escala_activo >= LIMITE_UNIDADES:
+            while escala_activo > 1 and acumulado * escala_activo * MARGEN_ESCALA >= LIMITE_UNIDADES:
+                escala_activo //= 10
+        escalas[activo] = escala_activo
+    return escalas
+
+
+def _emparejar_libro(libro, modo, procesos=None, escala=None):
+    """
+    Empareja todos los activos del libro. Por encima de UMBRAL_FILAS_PARALELO filas (o si se
+    pide procesos > 1) los activos se reparten en bloques entre un pool de procesos; los bloques
+    se recogen en su orden original, así que el resultado es idéntico al de la ejecución en serie.
+    Con 'escala' las cantidades se emparejan en punto fijo int64 y se devuelven ya en unidades del activo.
+    """
+    cantidades = libro.cantidades
+    if escala:
+        escalas = _escalas_por_fila(libro, escala)
+        cantidades = _a_punto_fijo(libro, escalas)
+
+    num_filas = int(libro.limites[-1])
+    if procesos is None:
+        procesos = (os.cpu_count() or 1) if num_filas >= UMBRAL_FILAS_PARALELO else 1
+    procesos = min(procesos, len(libro))
+
+    if procesos <= 1:
+        emparejado = _emparejar_rangos(modo, libro.limites, libro.tipos, cantidades, libro.precios)
+    else:
+        bloques = _bloques_de_activos(libro.limites, procesos * 4)
+        with ProcessPoolExecutor(max_workers=procesos) as pool:
+            futuros = []
+            for primero, ultimo in bloques:
+                inicio, fin = libro.limites[primero], libro.limites[ultimo]
+                futuros.append(pool.submit(
+                    _emparejar_rangos, modo, libro.limites[primero:ultimo + 1] - inicio,
+                    libro.tipos[inicio:fin], cantidades[inicio:fin], libro.precios[inicio:fin]
+                ))
+            partes = []
+            for (primero, _), futuro in zip(bloques, futuros):
+                inicio = libro.limites[primero]
+                pos_venta, pos_compra, cantidad_tramo, pos_lotes, cantidad_lotes = futuro.result()
+                partes.append((pos_venta + inicio, pos_compra + inicio, cantidad_tramo,
+                               pos_lotes + inicio, cantidad_lotes))
+        emparejado = _concatenar(partes, 5)
+
+    pos_venta, pos_compra, cantidad_tramo, pos_lotes, cantidad_lotes = emparejado
+    if escala:
+        # Vuelta a unidades del activo solo al final, para mostrar y valorar
+        cantidad_tramo = cantidad_tramo / escalas[pos_venta]
+        cantidad_lotes = cantidad_lotes / escalas[pos_lotes]
+    return pos_venta, pos_compra, cantidad_tramo, pos_lotes, cantidad_lotes
+
+
+def calcular_fifo(transacciones, modo='cola', procesos=None, escala=None):
+    """
+    transacciones: DataFrame con columnas ['tipo', 'cantidad', 'precio_unitario', 'fecha', 'activo']
+    y opcionalmente 'tipo_activo', o la tabla Arrow de un registro mapeado en memoria
+    (registros.mapear_registro). Cada activo se empareja por separado en orden de fecha
+    (las transacciones del mismo día conservan su orden de registro).
+    modo: 'cola' (secuencial), 'vectorizado' (acumulados + searchsorted, sin bucle sobre lotes)
+    o 'nucleo' (bucle sobre búferes reservados, compilado con numba si está disponible).
+    procesos: número de procesos; None decide según UMBRAL_FILAS_PARALELO.
+    escala: si se indica (entero o dict {activo: entero}), las cantidades se emparejan en punto fijo
+    int64 con esa resolución, p. ej. ESCALA_CANTIDAD = 10**8 (satoshis). Así los lotes se agotan
+    exactamente y no quedan restos de redondeo abiertos. Un activo cuyas compras o ventas acumuladas
+    pasan de LIMITE_UNIDADES lanza DesbordePuntoFijo (un ValueError); con el dict se le da una
+    escala menor solo a él. EstadoFIFO elige esa escala menor por sí mismo.
+    Retorna un ResultadoFIFO.
+    """
+    libro = _particionar(transacciones)
+    pos_venta, pos_compra, cantidad_tramo, pos_lotes, cantidad_lotes = _emparejar_libro(
+        libro, modo, procesos, escala
+    )
+
+    df_tramos = _construir_tramos(libro, pos_venta, pos_compra, cantidad_tramo)
+    df_lotes = _construir_lotes(libro, pos_lotes, cantidad_lotes)
+    return ResultadoFIFO(df_tramos, df_lotes, _resumir(libro, df_tramos, df_lotes))
+
+
+def _concatenar(partes, n, dtype=float):
+    if not partes:
+        return [np.empty(0, dtype=np.intp if i < n - 1 else dtype) for i in range(n)]
+    return [np.concatenate([p[i] for p in partes]) for i in range(n)]
+
+
+def _construir_tramos(libro, pos_venta, pos_compra, cantidad):
+    """Columnas de los tramos a partir de posiciones en el libro particionado."""
+    precio_venta = libro.precios[pos_venta]
+    precio_compra = libro.precios[pos_compra]
+    return pd.DataFrame({
+        'activo': libro.activos[libro.codigos[pos_venta]],
+        'tipo_activo': np.asarray(libro.tipos_activo[pos_venta], dtype=object),
+        'id_venta': libro.ids[pos_venta],
+        'fecha_venta': libro.fechas[pos_venta],
+        'cantidad': cantidad,
+        'precio_compra': precio_compra,
+        'precio_venta': precio_venta,
+        'ganancia': cantidad * (precio_venta - precio_compra),
+    }, columns=COLUMNAS_TRAMOS)
+
+
+def _construir_lotes(libro, pos_compra, cantidad):
+    return pd.DataFrame({
+        'activo': libro.activos[libro.codigos[pos_compra]],
+        'fecha_compra': libro.fechas[pos_compra],
+        'cantidad': cantidad,
+        'precio': libro.precios[pos_compra],
+    }, columns=COLUMNAS_LOTES)
+
+
+# --- Estado FIFO incremental ---
+
+def _tramos_de_tuplas(activo, tramos):
+    """DataFrame de tramos a partir de tuplas (id_venta, fecha_venta, tipo_activo, cantidad, precio_compra, precio_venta)."""
+    ids, fechas, tipos_activo, cantidad, precio_compra, precio_venta = (
+        zip(*tramos) if tramos else ([],) * 6
+    )
+    cantidad = np.asarray(cantidad, dtype=float)
+    precio_compra = np.asarray(precio_compra, dtype=float)
+    precio_venta = np.asarray(precio_venta, dtype=float)
+    return pd.DataFrame({
+        'activo': [activo] * len(ids),
+        'tipo_activo': list(tipos_activo),
+        'id_venta': list(ids),
+        'fecha_venta': pd.to_datetime(list(fechas)),
+        'cantidad': cantidad,
+        'precio_compra': precio_compra,
+        'precio_venta': precio_venta,
+        'ganancia': cantidad * (precio_venta - precio_compra),
+    }, columns=COLUMNAS_TRAMOS)
+
+
+class EstadoActivo:
+    """
+    Estado FIFO de un activo: cola de lotes abiertos, tramos realizados y acumulados del resumen.
+    Los tramos se guardan como un DataFrame ya materializado más la lista de los añadidos después.
+    Con 'escala' la cola guarda las cantidades en unidades enteras y solo se pasan a unidades del
+    activo al salir (tramos, lotes y resumen).
+    """
+    __slots__ = (
+        'activo', 'escala', 'tipo_activo', 'cola', 'tramos', 'ultima_fecha', 'num_transacciones',
+        'unidades_compradas', 'inversion_compras', 'unidades_vendidas', 'ingreso_ventas',
+        'inversion_ventas', 'ganancia_realizada', '_df_tramos'
+    )
+
+    def __init__(self, activo, escala=None):
+        self.activo = activo
+        self.escala = escala
+        self.tipo_activo = None
+        self.cola = ColaLotes()
+        self.tramos = []  # tuplas (id_venta, fecha_venta, tipo_activo, cantidad, precio_compra, precio_venta)
+        self.ultima_fecha = None
+        self.num_transacciones = 0
+        self.unidades_compradas = 0.0
+        self.inversion_compras = 0.0
+        self.unidades_vendidas = 0.0
+        self.ingreso_ventas = 0.0
+        self.inversion_ventas = 0.0
+        self.ganancia_realizada = 0.0
+        self._df_tramos = None
+
+    @classmethod
+    def desde_resultado(cls, fila_resumen, tramos, lotes, ultima_fecha, escala=None):
+        """Estado de un activo a partir de su parte de una pasada completa del motor."""
+        estado = cls(fila_resumen.activo, escala)
+        estado.tipo_activo = fila_resumen.tipo_activo
+        estado.ultima_fecha = ultima_fecha
+        for campo in ('num_transacciones', 'unidades_compradas', 'inversion_compras',
+                      'unidades_vendidas', 'ingreso_ventas', 'inversion_ventas', 'ganancia_realizada'):
+            setattr(estado, campo, getattr(fila_resumen, campo))
+        for pos, fecha, cantidad, precio in zip(lotes['id_compra'].tolist(), lotes['fecha_compra'].tolist(),
+                                                lotes['cantidad'].tolist(), lotes['precio'].tolist()):
+            estado.cola.añadir(_a_unidades(cantidad, escala), precio, pos, fecha)
+        estado._df_tramos = tramos
+        return estado
+
+    def en_orden(self, fecha):
+        """True si una transacción con esta fecha va después de todas las ya aplicadas."""
+        if self.ultima_fecha is None or pd.isna(fecha):
+            return True
+        return not pd.isna(self.ultima_fecha) and fecha >= self.ultima_fecha
+
+    def aplicar(self, id_fila, tipo, cantidad, precio, fecha, tipo_activo):
+        """Aplica una transacción posterior a todas las anteriores; tipo es COMPRA o VENTA."""
+        if tipo in (COMPRA, VENTA):
+            self._comprobar_limite(
+                (self.unidades_compradas if tipo == COMPRA else self.unidades_vendidas) + abs(cantidad)
+            )
+        self.num_transacciones += 1
+        self.ultima_fecha = fecha
+        if self.tipo_activo is None and not pd.isna(tipo_activo):
+            self.tipo_activo = tipo_activo
+
+        if tipo == COMPRA:
+            self.cola.añadir(_a_unidades(cantidad, self.escala), precio, id_fila, fecha)
+            self.unidades_compradas += cantidad
+            self.inversion_compras += cantidad * precio
+        elif tipo == VENTA:
+            self.unidades_vendidas += cantidad
+            self.ingreso_ventas += cantidad * precio
+            for _, precio_compra, unidades_usadas in self.cola.consumir(_a_unidades(cantidad, self.escala)):
+                cantidad_usada = _a_cantidad(unidades_usadas, self.escala)
+                self.tramos.append((id_fila, fecha, tipo_activo, cantidad_usada, precio_compra, precio))
+                self.inversion_ventas += cantidad_usada * precio_compra
+                self.ganancia_realizada += cantidad_usada * (precio - precio_compra)
+
+    def _comprobar_limite(self, acumulado):
+        """El mismo límite de punto fijo que en una pasada completa del motor (ver _a_punto_fijo)."""
+        if self.escala and not pd.isna(acumulado) and round(acumulado * self.escala) >= LIMITE_UNIDADES:
+            raise _error_punto_fijo([self.activo], self.escala)
+
+    def desplazar_ids(self, eliminados):
+        """Renumera ids de fila tras borrar las posiciones 'eliminados' (array ordenado) del libro."""
+        df = self.df_tramos()
+        if len(df):
+            ids = df['id_venta'].to_numpy()
+            self._df_tramos = df.assign(id_venta=ids - np.searchsorted(eliminados, ids))
+        for lote in self.cola:
+            lote.pos -= int(np.searchsorted(eliminados, lote.pos))
+
+    def df_tramos(self):
+        if self._df_tramos is None:
+            self._df_tramos = _tramos_de_tuplas(self.activo, self.tramos)
+            self.tramos = []
+        elif self.tramos:
+            self._df_tramos = pd.concat(
+                [self._df_tramos, _tramos_de_tuplas(self.activo, self.tramos)], ignore_index=True
+            )
+            self.tramos = []
+        return self._df_tramos
+
+    def fila_resumen(self):
+        return (
+            self.activo, self.tipo_activo, self.num_transacciones,
+            _a_cantidad(self.cola.posicion, self.escala), self.cola.precio_medio,
+            _a_cantidad(self.cola.coste, self.escala), self.unidades_compradas, self.inversion_compras,
+            self.unidades_vendidas, self.ingreso_ventas, self.inversion_ventas, self.ganancia_realizada
+        )
+
+
+class EstadoFIFO:
+    """
+    Estado FIFO por activo que se actualiza con cada transacción añadida en orden de fecha, sin
+    rehacer el historial. Una transacción anterior a la última fecha del activo o una fila eliminada
+    solo marca ese activo como pendiente; sincronizar() rehace los pendientes desde el libro con
+    una pasada del motor (en paralelo si el libro supera UMBRAL_FILAS_PARALELO).
+    'escala' activa las cantidades en punto fijo, como en calcular_fifo(), pero sin lanzar
+    DesbordePuntoFijo: un activo cuyas cantidades acumuladas no caben con ella (p. ej. SHIB a 10**8)
+    se empareja con una escala menor (ver _escalas_que_caben), que se vuelve a elegir cada vez que
+    se rehace el activo. Un alta que ya no cabe con la escala del activo lo deja pendiente.
+    """
+
+    def __init__(self, modo='cola', escala=None):
+        self.modo = modo
+        self.escala = escala
+        self.escalas = {}  # escala con la que se emparejó cada activo la última vez que se rehizo
+        self.activos = {}
+        self.pendientes = set()
+        self.num_filas = 0
+        self._resultado = None
+        self._indice = None
+
+    @classmethod
+    def desde_libro(cls, transacciones, modo='cola', escala=None):
+        estado = cls(modo, escala)
+        estado._reconstruir(transacciones)
+        return estado
+
+    def añadir(self, id_fila, fila):
+        """Aplica una transacción nueva (dict o Series con las columnas del libro) con id_fila en el libro."""
+        self.añadir_libro(pd.DataFrame([dict(fila)], index=[id_fila]))
+
+    def añadir_libro(self, nuevas):
+        """Aplica un bloque de transacciones nuevas; su índice son los ids de fila en el libro."""
+        self.num_filas += len(nuevas)
+        self._resultado = None
+        self._indice = None
+        libro = LibroParticionado(_preparar_libro(nuevas))
+
+        for i, activo in enumerate(libro.activos):
+            if activo in self.pendientes:
+                continue
+            inicio, fin = libro.rango(i)
+            estado_activo = self.activos.get(activo)
+            if estado_activo is None:
+                estado_activo = self.activos[activo] = EstadoActivo(activo, self._escala(activo))
+            elif not estado_activo.en_orden(pd.Timestamp(libro.fechas[inicio])):
+                self.pendientes.add(activo)
+                continue
+            try:
+                for fila in zip(
+                        libro.ids[inicio:fin].tolist(),
+                        libro.tipos[inicio:fin].tolist(),
+                        libro.cantidades[inicio:fin].tolist(),
+                        libro.precios[inicio:fin].tolist(),
+                        pd.DatetimeIndex(libro.fechas[inicio:fin]).tolist(),
+                        libro.tipos_activo[inicio:fin].tolist()):
+                    estado_activo.aplicar(*fila)
+            except DesbordePuntoFijo:
+                # Ya no cabe con su escala: se rehace desde el libro con una menor
+                self.pendientes.add(activo)
+
+    def eliminar(self, ids, activos):
+        """Registra el borrado de las filas 'ids' (de los activos 'activos') antes de renumerar el libro."""
+        eliminados = np.sort(np.asarray(ids))
+        self.num_filas -= len(eliminados)
+        self._resultado = None
+        self._indice = None
+        self.pendientes.update(a for a in activos if not pd.isna(a))
+        for activo, estado_activo in self.activos.items():
+            if activo not in self.pendientes:
+                estado_activo.desplazar_ids(eliminados)
+
+    def rehacer(self, activos):
+        """Marca 'activos' para rehacerlos desde el libro en el próximo sincronizar() (han cambiado sus importes)."""
+        self.pendientes.update(a for a in activos if not pd.isna(a))
+
+    def sincronizar(self, transacciones):
+        """Pone el estado al día con el libro, rehaciendo solo los activos pendientes."""
+        if len(transacciones) != self.num_filas:
+            self._reconstruir(transacciones)
+        elif self.pendientes:
+            self._reconstruir(transacciones, self.pendientes)
+
+    def indice_posiciones(self, transacciones):
+        """IndicePosiciones del libro actual; se rehace solo cuando el libro ha cambiado."""
+        if self._indice is None:
+            self._indice = IndicePosiciones(transacciones, escala=self.escala)
+        return self._indice
+
+    def _escala(self, activo):
+        """Escala de punto fijo de un activo: la elegida al rehacerlo o la pedida (None en coma flotante)."""
+        return self.escalas.get(activo) or _escala_activo(self.escala, activo)
+
+    def resultado(self):
+        if self._resultado is None:
+            estados = self.activos.values()
+            tramos = [df for df in (e.df_tramos() for e in estados) if len(df)]
+            lotes = [
+                (e.activo, l.fecha, _a_cantidad(l.cantidad, e.escala), l.precio) for e in estados for l in e.cola
+            ]
+            df_lotes = pd.DataFrame.from_records(lotes, columns=COLUMNAS_LOTES)
+            df_lotes['fecha_compra'] = pd.to_datetime(df_lotes['fecha_compra'])
+            self._resultado = ResultadoFIFO(
+                pd.concat(tramos, ignore_index=True) if tramos else _tramos_de_tuplas(None, []),
+                df_lotes,
+                pd.DataFrame.from_records([e.fila_resumen() for e in estados], columns=COLUMNAS_RESUMEN),
+            )
+        return self._resultado
+
+    def _reconstruir(self, transacciones, activos=None):
+        if activos is None:
+            self.activos = {}
+            self.escalas = {}
+            self.num_filas = len(transacciones)
+        elif isinstance(transacciones, pd.DataFrame):
+            transacciones = transacciones[transacciones['activo'].isin(activos)]
+        else:
+            transacciones = transacciones.filter(
+                pc.is_in(transacciones['activo'], value_set=pa.array(list(activos), pa.string()))
+            )
+        self.pendientes = set()
+        self._resultado = None
+        self._indice = None
+
+        libro = _particionar(transacciones)
+        escalas = _escalas_que_caben(libro, self.escala) if self.escala else None
+        if escalas:
+            self.escalas.update(escalas)
+        pos_venta, pos_compra, cantidad_tramo, pos_lotes, cantidad_lotes = _emparejar_libro(
+            libro, self.modo, escala=escalas
+        )
+        tramos = _construir_tramos(libro, pos_venta, pos_compra, cantidad_tramo)
+        lotes = _construir_lotes(libro, pos_lotes, cantidad_lotes).assign(id_compra=libro.ids[pos_lotes])
+        resumen = _resumir(libro, tramos, lotes)
+
+        # Tramos y lotes salen agrupados por activo en el orden del libro particionado
+        limites_tramos = np.searchsorted(libro.codigos[pos_venta], np.arange(len(libro) + 1))
+        limites_lotes = np.searchsorted(libro.codigos[pos_lotes], np.arange(len(libro) + 1))
+        for i, fila in enumerate(resumen.itertuples(index=False)):
+            self.activos[fila.activo] = EstadoActivo.desde_resultado(
+                fila,
+                tramos.iloc[limites_tramos[i]:limites_tramos[i + 1]].reset_index(drop=True),
+                lotes.iloc[limites_lotes[i]:limites_lotes[i + 1]],
+                pd.Timestamp(libro.fechas[libro.limites[i + 1] - 1]),
+                self._escala(fila.activo),
+            )
+
+        # Activos pendientes que ya no tienen ninguna fila en el libro
+        for activo in set(activos or ()) - set(libro.activos):
+            self.activos.pop(activo, None)
+            self.escalas.pop(activo, None)
+
+
+# --- Posiciones en una fecha ---
+
+COLUMNAS_POSICIONES = ['activo', 'tipo_activo', 'posicion', 'precio_medio', 'coste_abierto']
+
+
+class IndicePosiciones:
+    """
+    Posición y coste FIFO de los lotes abiertos de cada activo en cualquier fecha (p. ej. a 31 de
+    diciembre para el informe de Hacienda o el Impuesto sobre el Patrimonio). Se monta con una
+    pasada vectorizada por activo, sin repetir el libro fila a fila ni copiar colas: como FIFO
+    consume las compras en orden, la cola tras cualquier fila queda fijada por las unidades vendidas
+    que han encontrado lote hasta ella (los acumulados de _emparejar_vectorizado). Ese acumulado es
+    el único punto de control que se guarda por fila; los lotes abiertos son las compras anteriores
+    cuyo final sobre el eje de compras lo supera, y la primera de ellas está consumida en parte.
+    Una consulta son dos búsquedas binarias, por fecha y por el eje de compras.
+    'escala' activa el punto fijo como en EstadoFIFO (con la escala reducida si no cabe).
+    """
+
+    def __init__(self, transacciones, escala=None):
+        self.libro = libro = _particionar(transacciones)
+        self.escalas = _escalas_que_caben(libro, escala) if escala else None
+        self.indices = {activo: i for i, activo in enumerate(libro.activos)}
+        self.tipos_activo = pd.Series(libro.tipos_activo).groupby(libro.codigos).first().to_numpy()
+
+        cantidades = libro.cantidades
+        if self.escalas:
+            cantidades = _a_punto_fijo(libro, _escalas_por_fila(libro, self.escalas))
+        # Por fila: unidades emparejadas hasta ella. Por compra (agrupadas por activo): su fila y
+        # las unidades compradas acumuladas al final de cada una
+        partes_filas, partes_compras = [], []
+        for i in range(len(libro)):
+            inicio, fin = libro.rango(i)
+            cantidades_activo, compras_acum, emparejado_acum = _acumulados(
+                libro.tipos[inicio:fin], cantidades[inicio:fin]
+            )
+            compras = np.flatnonzero((libro.tipos[inicio:fin] == COMPRA) & (cantidades_activo > 0))
+            partes_filas.append((emparejado_acum, cantidades_activo))
+            partes_compras.append((compras + inicio, compras_acum[compras]))
+        self.emparejado, self.cantidades = _concatenar(partes_filas, 2, cantidades.dtype)
+        self.pos_compras, self.fin_compras = _concatenar(partes_compras, 2, cantidades.dtype)
+        self.limites_compras = np.concatenate(
+            ([0], np.cumsum([len(p[0]) for p in partes_compras]))
+        ).astype(np.intp)
+        # Las fechas vacías quedan al final de su activo y no caen en ninguna fecha
+        self.con_fecha = libro.suma_por_activo(~pd.isna(libro.fechas)).astype(np.intp)
+
+    def _escala(self, activo):
+        return self.escalas[activo] if self.escalas else None
+
+    def _lotes(self, i, fecha):
+        """(posiciones de compra, cantidades en unidades) de los lotes abiertos del activo i al cierre de 'fecha'."""
+        inicio = self.libro.limites[i]
+        hasta = np.datetime64(pd.Timestamp(fecha).normalize() + pd.Timedelta(days=1))
+        aplicadas = np.searchsorted(self.libro.fechas[inicio:inicio + self.con_fecha[i]], hasta, side='left')
+        if not aplicadas:
+            return np.empty(0, dtype=np.intp), self.cantidades[:0]
+        ultima = inicio + aplicadas - 1
+        emparejado = self.emparejado[ultima]
+
+        primera_compra, fin_compras = self.limites_compras[i], self.limites_compras[i + 1]
+        compras = slice(primera_compra, primera_compra + np.searchsorted(
+            self.pos_compras[primera_compra:fin_compras], ultima, side='right'
+        ))
+        fin = self.fin_compras[compras]
+        abiertas = np.searchsorted(fin, emparejado + _tolerancia(fin, emparejado), side='right')
+        pos = self.pos_compras[compras][abiertas:]
+        fin = fin[abiertas:]
+        return pos, fin - np.maximum(fin - self.cantidades[pos], emparejado)
+
+    def posicion_en(self, activo, fecha):
+        """(posición, precio medio, coste abierto) del activo al cierre del día 'fecha'."""
+        i = self.indices.get(activo)
+        if i is None:
+            return 0, 0, 0.0
+        pos, unidades = self._lotes(i, fecha)
+        escala_activo = self._escala(activo)
+        posicion = _a_cantidad(unidades.sum(), escala_activo)
+        coste = _a_cantidad(float(np.dot(unidades, self.libro.precios[pos])), escala_activo)
+        return posicion, coste / posicion if posicion > 0 else 0, coste
+
+    def lotes_en(self, activo, fecha):
+        """Lotes abiertos del activo al cierre del día 'fecha'."""
+        i = self.indices.get(activo)
+        pos, unidades = self._lotes(i, fecha) if i is not None else (np.empty(0, dtype=np.intp), np.empty(0))
+        return pd.DataFrame({
+            'activo': [activo] * len(pos),
+            'fecha_compra': pd.to_datetime(self.libro.fechas[pos]),
+            'cantidad': _a_cantidad(np.asarray(unidades, dtype=float), self._escala(activo)),
+            'precio': self.libro.precios[pos],
+        }, columns=COLUMNAS_LOTES)
+
+    def posiciones_en(self, fecha):
+        """Activos con posición abierta al cierre del día 'fecha'."""
+        filas = []
+        for i, activo in enumerate(self.libro.activos):
+            posicion, precio_medio, coste = self.posicion_en(activo, fecha)
+            if posicion > 0:
+                filas.append((activo, self.tipos_activo[i], posicion, precio_medio, coste))
+        return pd.DataFrame.from_records(filas, columns=COLUMNAS_POSICIONES).astype(
+            {'posicion': float, 'precio_medio': float, 'coste_abierto': float}
+        )
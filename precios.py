@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+"""
+Cotizaciones compartidas por las apps.
+
+Cada activo se resuelve a su ticker de Yahoo Finance con equivalencias_yf y los precios de
+todos los tickers se descargan en peticiones multi-ticker; solo los que falten en la descarga
+se buscan uno a uno, en paralelo, con tiempo máximo y reintentos. Las cotizaciones obtenidas
+se guardan en una caché en memoria del proceso, común a todas las sesiones de Streamlit, y
+la variante de ticker que funcionó (o que ninguna funcionó) se recuerda en disco.
+Los datos vienen del proveedor configurado en proveedores_precios.py (yfinance por defecto).
+
+Las apps no piden precios durante el rerun: un hilo en segundo plano (refresco_precios) los
+mantiene al día y la interfaz solo lee la última instantánea y su hora.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+from datetime import datetime
+
+from proveedores_precios import crear_proveedor
+
+log = logging.getLogger(__name__)
+
+# Tickers por petición multi-ticker al proveedor
+TAMANO_LOTE_TICKERS = 50
+
+# Búsquedas individuales: hilos simultáneos, segundos por petición, reintentos tras un error
+# (con espera exponencial desde ESPERA_REINTENTO) y plazo total para todas ellas
+MAX_HILOS_PRECIOS = 8
+TIMEOUT_PRECIO = 10
+REINTENTOS_PRECIO = 2
+ESPERA_REINTENTO = 0.5
+PLAZO_PRECIOS = 30
+
+# Segundos que vale una cotización en caché (las cripto cotizan sin parar) y cotizaciones
+# que se guardan como máximo antes de descartar las menos usadas
+TTL_CRIPTO = int(os.environ.get('PRECIOS_TTL_CRIPTO', 60))
+TTL_GENERAL = int(os.environ.get('PRECIOS_TTL_GENERAL', 15 * 60))
+MAX_COTIZACIONES_CACHE = 1024
+
+# Ficheros locales de precios (resolución de tickers)
+DIRECTORIO_PRECIOS = os.environ.get('PRECIOS_DIRECTORIO', 'datos_precios')
+
+# Segundos entre refrescos del hilo de precios en segundo plano
+INTERVALO_REFRESCO = int(os.environ.get('PRECIOS_INTERVALO_REFRESCO', 60))
+
+# Segundos que vale una resolución aprendida: la variante que funcionó dura más que un ticker
+# sin datos, que puede deberse a un corte pasajero
+TTL_RESOLUCION_VALIDA = 30 * 86400
+TTL_RESOLUCION_SIN_DATOS = 6 * 3600
+
+
+def ttl_cotizacion(ticker):
+    """TTL de la cotización de un ticker: corto para pares cripto (BTC-EUR, XRP-USD...)."""
+    return TTL_CRIPTO if str(ticker).upper().endswith(('-EUR', '-USD')) else TTL_GENERAL
+
+
+class CacheCotizaciones:
+    """
+    Caché LRU de cotizaciones por ticker resuelto con caducidad por entrada. Vive a nivel de
+    módulo, así que la comparten todas las sesiones y reejecuciones del proceso de Streamlit;
+    un cerrojo la protege de los hilos de búsqueda y de las sesiones concurrentes.
+    """
+
+    def __init__(self, max_entradas=MAX_COTIZACIONES_CACHE, ttl=ttl_cotizacion):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self._entradas = OrderedDict()  # ticker -> (precio, caduca)
+        self._cerrojo = threading.Lock()
+
+    def obtener(self, ticker):
+        """Precio en caché del ticker, o None si no está o ha caducado."""
+        with self._cerrojo:
+            entrada = self._entradas.get(ticker)
+            if entrada is None:
+                return None
+            precio, caduca = entrada
+            if time.monotonic() >= caduca:
+                del self._entradas[ticker]
+                return None
+            self._entradas.move_to_end(ticker)
+            return precio
+
+    def guardar(self, ticker, precio):
+        with self._cerrojo:
+            self._entradas[ticker] = (precio, time.monotonic() + self.ttl(ticker))
+            self._entradas.move_to_end(ticker)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def vaciar(self):
+        with self._cerrojo:
+            self._entradas.clear()
+
+
+cache_cotizaciones = CacheCotizaciones()
+
+
+class ResolucionTickers:
+    """
+    Tabla persistida en JSON de la variante que funcionó para cada ticker ('ticker' o
+    'ticker-USD'), o de que ninguna tiene datos, con fecha de caducidad. Se carga la primera
+    vez que se usa y se reescribe entera (vía fichero temporal) con cada cambio.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._tabla = None
+        self._cerrojo = threading.Lock()
+
+    def _cargar(self):
+        if self._tabla is None:
+            try:
+                with open(self.ruta, encoding='utf-8') as f:
+                    self._tabla = json.load(f)
+            except (OSError, ValueError):
+                self._tabla = {}
+        return self._tabla
+
+    def _guardar(self):
+        os.makedirs(os.path.dirname(self.ruta) or '.', exist_ok=True)
+        temporal = self.ruta + '.tmp'
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump(self._tabla, f, indent=1)
+        os.replace(temporal, self.ruta)
+
+    def consultar(self, ticker):
+        """(conocido, simbolo): simbolo es la variante que funciona, o None si se sabe que no hay datos."""
+        with self._cerrojo:
+            entrada = self._cargar().get(ticker)
+            if entrada is None or time.time() >= entrada['caduca']:
+                return False, None
+            return True, entrada['simbolo']
+
+    def registrar(self, ticker, simbolo):
+        """Anota la variante que funcionó para 'ticker' (None si ninguna tenía datos)."""
+        ttl = TTL_RESOLUCION_VALIDA if simbolo is not None else TTL_RESOLUCION_SIN_DATOS
+        with self._cerrojo:
+            tabla = self._cargar()
+            if tabla.get(ticker, {}).get('simbolo', False) == simbolo:
+                # Misma resolución: solo se renueva en disco cuando le queda menos de la mitad
+                if tabla[ticker]['caduca'] - time.time() > ttl / 2:
+                    return
+            tabla[ticker] = {'simbolo': simbolo, 'caduca': time.time() + ttl}
+            try:
+                self._guardar()
+            except OSError as e:
+                log.warning("No se pudo guardar la resolución de tickers: %s", e)
+
+
+resoluciones = ResolucionTickers(os.path.join(DIRECTORIO_PRECIOS, 'resoluciones_tickers.json'))
+
+equivalencias_yf = {
+    'PHAG': 'PHAG.AS',       # WisdomTree Physical Silver - Amsterdam (EUR)
+    'IGLN': 'IGLN.L',        # iShares Physical Gold ETC - Amsterdam (EUR)
+    'BTC': 'BTC-EUR',        # Bitcoin en EUR
+    'ETH': 'ETH-EUR',        # Ethereum en EUR
+    'SOL': 'SOL-EUR',        # Solana en EUR
+    'ADA': 'ADA-EUR',        # Cardano en EUR
+    'XRP': 'XRP-EUR',        # Ripple en EUR
+    'DOT': 'DOT-EUR',        # Polkadot en EUR
+    'VET': 'VET-EUR',        # VeChain en EUR
+    'LINK': 'LINK-EUR',      # Chainlink en EUR
+    'SHIB': 'SHIB-EUR',      # Shiba Inu en EUR
+    'COTI': 'COTI-EUR',      # COTI en EUR
+    'BNB': 'BNB-EUR',        # Binance Coin en EUR
+    'LTC': 'LTC-EUR',        # Litecoin en EUR
+}
+
+
+proveedor_precios = crear_proveedor()
+
+
+def proveedor_actual():
+    """Proveedor de cotizaciones en uso."""
+    return proveedor_precios
+
+
+def usar_proveedor(proveedor):
+    """Cambia el proveedor de cotizaciones (p. ej. a uno de fichero en pruebas) y vacía la caché."""
+    global proveedor_precios
+    proveedor_precios = proveedor
+    cache_cotizaciones.vaciar()
+
+
+def ticker_yf(activo):
+    """Ticker de Yahoo Finance de un activo (el propio nombre si no está en equivalencias_yf)."""
+    return equivalencias_yf.get(str(activo).upper(), activo)
+
+
+def _consultar_precio(ticker, timeout=TIMEOUT_PRECIO):
+    """
+    Último cierre de 'ticker', o de 'ticker-USD' si el primero no tiene datos; None si no hay.
+    Si la tabla de resoluciones ya sabe qué variante funciona se pide solo esa, y un ticker
+    que se sabe sin datos no se pide.
+    """
+    conocido, simbolo_conocido = resoluciones.consultar(ticker)
+    if conocido and simbolo_conocido is None:
+        return None
+    # Intentar directo y, si no hay datos, con sufijo USD (para cripto)
+    candidatos = [ticker, ticker + '-USD']
+    if conocido:
+        candidatos.remove(simbolo_conocido)
+        candidatos.insert(0, simbolo_conocido)
+    for simbolo in candidatos:
+        precio = proveedor_precios.ultimo_cierre(simbolo, timeout=timeout)
+        if precio is not None:
+            resoluciones.registrar(ticker, simbolo)
+            return precio
+    resoluciones.registrar(ticker, None)
+    return None
+
+
+def obtener_precio_actual(ticker):
+    """Como _consultar_precio, pero servido desde la caché si está vigente; un error se registra y devuelve None."""
+    precio = cache_cotizaciones.obtener(ticker)
+    if precio is not None:
+        return precio
+    try:
+        precio = _consultar_precio(ticker)
+    except Exception as e:
+        log.warning("Error obteniendo precio para %s: %s", ticker, e)
+        return None
+    if precio is not None:
+        cache_cotizaciones.guardar(ticker, precio)
+    return precio
+
+
+def _consultar_con_reintentos(ticker, timeout, reintentos, espera):
+    """_consultar_precio repitiendo tras un error, con espera exponencial entre intentos."""
+    for intento in range(reintentos + 1):
+        try:
+            return _consultar_precio(ticker, timeout)
+        except Exception as e:
+            if intento == reintentos:
+                raise
+            log.info("Reintentando %s tras error: %s", ticker, e)
+            time.sleep(espera * 2 ** intento)
+
+
+def buscar_precios(tickers, al_recibir=None, max_hilos=MAX_HILOS_PRECIOS, timeout=TIMEOUT_PRECIO,
+                   reintentos=REINTENTOS_PRECIO, plazo=PLAZO_PRECIOS):
+    """
+    Búsqueda individual de varios tickers en un pool de hasta 'max_hilos' hilos.
+    al_recibir(ticker, precio, motivo) se llama desde el hilo que invoca en cuanto llega cada
+    resultado, para poder publicar precios parciales. Lo que no ha terminado tras 'plazo'
+    segundos queda como fallido y no se espera.
+    Retorna (precios {ticker: precio}, fallos {ticker: motivo}).
+    """
+    precios, fallos = {}, {}
+
+    def anotar(ticker, precio, motivo):
+        if precio is not None:
+            precios[ticker] = precio
+            cache_cotizaciones.guardar(ticker, precio)
+        else:
+            fallos[ticker] = motivo
+        if al_recibir is not None:
+            al_recibir(ticker, precio, motivo)
+
+    pendientes = []
+    for ticker in tickers:
+        precio = cache_cotizaciones.obtener(ticker)
+        if precio is not None:
+            anotar(ticker, precio, None)
+        else:
+            pendientes.append(ticker)
+    if not pendientes:
+        return precios, fallos
+    tickers = pendientes
+
+    pool = ThreadPoolExecutor(max_workers=min(max_hilos, len(tickers)))
+    futuros = {
+        pool.submit(_consultar_con_reintentos, ticker, timeout, reintentos, ESPERA_REINTENTO): ticker
+        for ticker in tickers
+    }
+    try:
+        for futuro in as_completed(futuros, timeout=plazo):
+            ticker = futuros[futuro]
+            try:
+                precio = futuro.result()
+                anotar(ticker, precio, None if precio is not None else 'sin datos')
+            except Exception as e:
+                log.warning("Error obteniendo precio para %s: %s", ticker, e)
+                anotar(ticker, None, 'error')
+    except TimeoutError:
+        for futuro, ticker in futuros.items():
+            if not futuro.done():
+                anotar(ticker, None, 'tiempo agotado')
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    return precios, fallos
+
+
+def _ultimos_cierres(cierres):
+    """{ticker: último cierre} de un DataFrame de cierres por ticker; omite los tickers sin datos."""
+    if cierres.empty:
+        return {}
+    # Cripto cotiza en fin de semana y las bolsas no: último valor no vacío de cada columna
+    ultimos = cierres.ffill().iloc[-1].dropna()
+    return {ticker: float(precio) for ticker, precio in ultimos.items()}
+
+
+def descargar_cierres(tickers, tamano_lote=TAMANO_LOTE_TICKERS):
+    """Último cierre de cada ticker con una petición multi-ticker por bloque de 'tamano_lote'."""
+    cierres = {}
+    for inicio in range(0, len(tickers), tamano_lote):
+        lote = tickers[inicio:inicio + tamano_lote]
+        try:
+            cierres.update(_ultimos_cierres(proveedor_precios.cierres(lote, periodo="5d")))
+        except Exception as e:
+            log.warning("Error en la descarga conjunta de %s: %s", lote, e)
+    return cierres
+
+
+def obtener_precios(activos, al_recibir=None, tamano_lote=TAMANO_LOTE_TICKERS):
+    """
+    Precio actual de cada activo. Los tickers se descargan por bloques y solo los que la descarga
+    conjunta no devuelve se buscan uno a uno con buscar_precios (que prueba también la variante -USD).
+    al_recibir(activo, precio, motivo) se llama con cada resultado en cuanto está disponible.
+    Retorna (precios {activo: precio}, fallos {activo: motivo}).
+    """
+    activos_por_ticker = {}
+    for activo in activos:
+        activos_por_ticker.setdefault(ticker_yf(activo), []).append(activo)
+    precios, fallos = {}, {}
+
+    def anotar(ticker, precio, motivo):
+        for activo in activos_por_ticker[ticker]:
+            if precio is not None:
+                precios[activo] = precio
+            else:
+                fallos[activo] = motivo
+            if al_recibir is not None:
+                al_recibir(activo, precio, motivo)
+
+    # Lo vigente en caché no se vuelve a pedir; los tickers que se sabe que no tienen datos
+    # tampoco, y los demás se piden con la variante que ya funcionó
+    cierres = {}
+    simbolos = {}
+    for ticker in activos_por_ticker:
+        precio = cache_cotizaciones.obtener(ticker)
+        conocido, simbolo = resoluciones.consultar(ticker)
+        if precio is not None:
+            cierres[ticker] = precio
+        elif conocido and simbolo is None:
+            anotar(ticker, None, 'sin datos')
+        else:
+            simbolos[simbolo if conocido else ticker] = ticker
+
+    for simbolo, precio in descargar_cierres(list(simbolos), tamano_lote).items():
+        ticker = simbolos[simbolo]
+        resoluciones.registrar(ticker, simbolo)
+        cache_cotizaciones.guardar(ticker, precio)
+        cierres[ticker] = precio
+    for ticker, precio in cierres.items():
+        anotar(ticker, precio, None)
+    buscar_precios([t for t in simbolos.values() if t not in cierres], al_recibir=anotar)
+    return precios, fallos
+
+
+class RefrescoPrecios:
+    """
+    Hilo en segundo plano que refresca con obtener_precios los activos seguidos cada
+    'intervalo' segundos (o en cuanto se sigue un activo nuevo) y publica una instantánea
+    compartida por todas las sesiones. Un activo que falla conserva su último precio conocido.
+    Las funciones registradas con al_refrescar se llaman en el mismo hilo tras cada refresco, y
+    la de sembrar_con da un precio de partida sin red (el último cierre guardado) a los activos
+    que se empiezan a seguir.
+    """
+
+    def __init__(self, intervalo=INTERVALO_REFRESCO):
+        self.intervalo = intervalo
+        self._activos = set()
+        self._precios = {}
+        self._fallos = {}
+        self._actualizado = None
+        self._cerrojo = threading.Lock()
+        self._despertar = threading.Event()
+        self._hilo = None
+        self._tareas = []
+        self._semilla = None
+
+    def seguir(self, activos):
+        """Añade activos a refrescar; si hay alguno nuevo se refresca sin esperar al intervalo."""
+        with self._cerrojo:
+            nuevos = set(activos) - self._activos
+            self._activos |= nuevos
+        if nuevos and self._semilla is not None:
+            try:
+                semilla = self._semilla(nuevos)
+            except Exception as e:
+                log.warning("No se pudieron leer los precios de partida: %s", e)
+                semilla = {}
+            with self._cerrojo:
+                for activo, precio in semilla.items():
+                    self._precios.setdefault(activo, precio)
+        with self._cerrojo:
+            if self._hilo is None or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._bucle, name='refresco_precios', daemon=True)
+                self._hilo.start()
+        if nuevos:
+            self._despertar.set()
+
+    def sembrar_con(self, semilla):
+        """Registra semilla(activos) -> {activo: precio} para dar precio a los activos nuevos."""
+        self._semilla = semilla
+
+    def al_refrescar(self, tarea):
+        """Registra tarea(activos) para ejecutarla en segundo plano tras cada refresco."""
+        self._tareas.append(tarea)
+
+    def refrescar_ahora(self):
+        """Pide un refresco inmediato sin esperar a que termine."""
+        self._despertar.set()
+
+    def instantanea(self):
+        """(precios {activo: precio}, fallos {activo: motivo}, hora del último refresco completo o None)."""
+        with self._cerrojo:
+            return dict(self._precios), dict(self._fallos), self._actualizado
+
+    def _anotar(self, activo, precio, motivo):
+        with self._cerrojo:
+            if precio is not None:
+                self._precios[activo] = precio
+                self._fallos.pop(activo, None)
+            elif activo not in self._precios:
+                self._fallos[activo] = motivo
+
+    def _bucle(self):
+        while True:
+            self._despertar.clear()
+            with self._cerrojo:
+                activos = sorted(self._activos, key=str)
+            try:
+                obtener_precios(activos, al_recibir=self._anotar)
+                with self._cerrojo:
+                    self._actualizado = datetime.now()
+                for tarea in self._tareas:
+                    tarea(activos)
+            except Exception as e:
+                log.warning("Error refrescando precios: %s", e)
+            self._despertar.wait(self.intervalo)
+
+
+refresco_precios = RefrescoPrecios()
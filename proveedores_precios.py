@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Proveedores de cotizaciones.
+
+precios.py e historico_precios.py no hablan con yfinance directamente sino con un proveedor:
+ProveedorYFinance para datos reales o ProveedorFichero, que reproduce cotizaciones grabadas
+en un JSON y permite probar y medir las ventanas de precios sin red. El proveedor se elige
+con la variable de entorno PRECIOS_PROVEEDOR ('yfinance' o 'fichero', con el fichero en
+PRECIOS_FIXTURE).
+
+Grabar un fichero con cotizaciones reales:
+    python proveedores_precios.py fixture.json BTC-EUR IWDA.AS ... [--desde 2024-01-01]
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+
+def _cierres_por_fecha(cierres):
+    """Normaliza un DataFrame de cierres: índice de fechas sin zona horaria ni hora."""
+    if cierres.index.tz is not None:
+        cierres.index = cierres.index.tz_localize(None)
+    cierres.index = cierres.index.normalize()
+    cierres.index.name = 'fecha'
+    return cierres
+
+
+class ProveedorYFinance:
+    """Cotizaciones de Yahoo Finance."""
+
+    nombre = 'yfinance'
+
+    def ultimo_cierre(self, simbolo, timeout=None):
+        """Último cierre de un símbolo, o None si no hay datos."""
+        import yfinance as yf
+        hist = yf.Ticker(simbolo).history(period="1d", timeout=timeout)
+        if hist.empty:
+            return None
+        return float(hist['Close'].iloc[-1])
+
+    def divisa(self, simbolo):
+        """Divisa en la que cotiza un símbolo ('EUR', 'USD', 'GBp'...), o None si no se conoce."""
+        import yfinance as yf
+        return yf.Ticker(simbolo).fast_info.get('currency')
+
+    def cierres(self, simbolos, periodo=None, inicio=None, fin=None):
+        """
+        Cierres diarios de varios símbolos en una sola petición, por periodo ('5d') o entre
+        'inicio' y 'fin' (este excluido). DataFrame con una columna por símbolo con datos.
+        """
+        import yfinance as yf
+        simbolos = list(simbolos)
+        rango = {'period': periodo} if periodo is not None else {'start': inicio, 'end': fin}
+        datos = yf.download(
+            simbolos, **rango, group_by='column', auto_adjust=True, progress=False, threads=True
+        )
+        if datos is None or datos.empty or 'Close' not in datos.columns.get_level_values(0):
+            return pd.DataFrame()
+        cierres = datos['Close']
+        if isinstance(cierres, pd.Series):
+            cierres = cierres.to_frame(simbolos[0])
+        return _cierres_por_fecha(cierres.dropna(axis=1, how='all'))
+
+
+class ProveedorFichero:
+    """
+    Cotizaciones grabadas en un JSON {"cierres": {simbolo: {"AAAA-MM-DD": cierre}}, "divisas":
+    {simbolo: divisa}} (las divisas son opcionales). La cotización
+    actual de un símbolo es su último cierre grabado y un periodo ('5d') cuenta hacia atrás desde
+    la última fecha del fichero, no desde hoy, para que las respuestas no cambien con el tiempo.
+    'latencia' añade una espera por petición para simular la red en pruebas de carga.
+    """
+
+    nombre = 'fichero'
+
+    def __init__(self, ruta, latencia=0.0):
+        self.ruta = ruta
+        self.latencia = latencia
+        with open(ruta, encoding='utf-8') as f:
+            datos = json.load(f)
+        self._cierres = {
+            simbolo: pd.Series(serie, dtype=float).rename(lambda fecha: pd.Timestamp(fecha)).sort_index()
+            for simbolo, serie in datos.get('cierres', {}).items()
+        }
+        self._divisas = datos.get('divisas', {})
+
+    def _esperar(self):
+        if self.latencia:
+            time.sleep(self.latencia)
+
+    def ultimo_cierre(self, simbolo, timeout=None):
+        self._esperar()
+        serie = self._cierres.get(simbolo)
+        if serie is None or serie.empty:
+            return None
+        return float(serie.iloc[-1])
+
+    def divisa(self, simbolo):
+        return self._divisas.get(simbolo)
+
+    def cierres(self, simbolos, periodo=None, inicio=None, fin=None):
+        self._esperar()
+        columnas = {s: self._cierres[s] for s in simbolos if s in self._cierres}
+        if not columnas:
+            return pd.DataFrame()
+        cierres = _cierres_por_fecha(pd.DataFrame(columnas))
+        if periodo is not None:
+            cierres = cierres[cierres.index >= cierres.index.max() - pd.Timedelta(periodo) + pd.Timedelta(days=1)]
+        if inicio is not None:
+            cierres = cierres[cierres.index >= pd.Timestamp(inicio)]
+        if fin is not None:
+            cierres = cierres[cierres.index < pd.Timestamp(fin)]
+        return cierres.dropna(axis=1, how='all')
+
+
+class ProveedorCronometrado:
+    """
+    Envuelve otro proveedor y registra en el log la duración de cada petición; las mediciones
+    quedan en 'llamadas' como (método, símbolos, segundos) para localizar símbolos lentos.
+    """
+
+    def __init__(self, proveedor):
+        self.proveedor = proveedor
+        self.nombre = proveedor.nombre
+        self.llamadas = []
+
+    def _medir(self, metodo, simbolos, *args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return getattr(self.proveedor, metodo)(*args, **kwargs)
+        finally:
+            segundos = time.perf_counter() - inicio
+            self.llamadas.append((metodo, simbolos, segundos))
+            log.info("%s.%s(%s): %.2f s", self.nombre, metodo, ', '.join(simbolos), segundos)
+
+    def ultimo_cierre(self, simbolo, timeout=None):
+        return self._medir('ultimo_cierre', [simbolo], simbolo, timeout=timeout)
+
+    def divisa(self, simbolo):
+        return self._medir('divisa', [simbolo], simbolo)
+
+    def cierres(self, simbolos, periodo=None, inicio=None, fin=None):
+        simbolos = list(simbolos)
+        return self._medir('cierres', simbolos, simbolos, periodo=periodo, inicio=inicio, fin=fin)
+
+
+def crear_proveedor(nombre=None, ruta=None):
+    """Proveedor indicado (o el de PRECIOS_PROVEEDOR; yfinance por defecto)."""
+    nombre = nombre or os.environ.get('PRECIOS_PROVEEDOR', 'yfinance')
+    if nombre == 'yfinance':
+        return ProveedorYFinance()
+    if nombre == 'fichero':
+        ruta = ruta or os.environ.get('PRECIOS_FIXTURE')
+        if not ruta:
+            raise ValueError("El proveedor 'fichero' necesita la ruta en PRECIOS_FIXTURE")
+        return ProveedorFichero(ruta, float(os.environ.get('PRECIOS_FIXTURE_LATENCIA', 0)))
+    raise ValueError(f"Proveedor de precios desconocido: {nombre}")
+
+
+def grabar_fixture(ruta, simbolos, desde, proveedor=None):
+    """Guarda en 'ruta' los cierres diarios y la divisa de 'simbolos' desde 'desde' para ProveedorFichero."""
+    proveedor = proveedor or ProveedorYFinance()
+    cierres = proveedor.cierres(simbolos, inicio=desde)
+    datos = {
+        'cierres': {
+            simbolo: {fecha.strftime('%Y-%m-%d'): float(cierre) for fecha, cierre in cierres[simbolo].dropna().items()}
+            for simbolo in cierres.columns
+        },
+        'divisas': {simbolo: proveedor.divisa(simbolo) for simbolo in cierres.columns},
+    }
+    with open(ruta, 'w', encoding='utf-8') as f:
+        json.dump(datos, f, indent=1)
+    return list(cierres.columns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Graba cotizaciones de yfinance para ProveedorFichero")
+    parser.add_argument('ruta')
+    parser.add_argument('simbolos', nargs='+')
+    parser.add_argument('--desde', default='2024-01-01')
+    args = parser.parse_args()
+    grabados = grabar_fixture(args.ruta, args.simbolos, args.desde)
+    print(f"{len(grabados)} símbolos grabados en {args.ruta}; sin datos: {sorted(set(args.simbolos) - set(grabados))}")
+
+
+if __name__ == '__main__':
+    main()
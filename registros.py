@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+"""
+Portafolios guardados en registros_guardados.
+
+Cada registro se guarda en Parquet (columnar, comprimido con zstd y con tipos fijos por columna),
+de modo que cargarlo es leer columnas ya tipadas sin pasar por el parser de Excel. Excel queda
+solo para importar y exportar: un registro .xlsx antiguo se convierte a Parquet la primera vez
+que se carga.
+
+Las altas y bajas posteriores al último guardado completo van a un diario de solo-añadir
+(DiarioRegistro), que se compacta en el Parquet cuando crece y se vuelve a aplicar al cargar.
+
+Para leer registros en bloque sin pasar por pandas, mapear_registro() abre el registro como una
+tabla Arrow mapeada en memoria desde '<nombre>.arrow', que los procesos comparten a través de la
+caché de páginas del sistema. La usan la instantánea nocturna de precios y la carga de un
+registro en la app: el estado FIFO de la sesión se calcula sobre la tabla mapeada y solo las
+vistas editables reciben un DataFrame (tabla_a_libro).
+"""
+import io
+import json
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl  # bloqueo del diario entre sesiones (POSIX)
+except ImportError:
+    fcntl = None
+    import msvcrt  # Windows
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+DIRECTORIO_REGISTROS = 'registros_guardados'
+
+# Operaciones del diario que se acumulan antes de compactarlo en el Parquet del registro
+UMBRAL_COMPACTACION = 500
+
+# Clave de los metadatos del Parquet con la última operación del diario que ya incluye
+CLAVE_DIARIO = b'diario_hasta'
+
+# Clave de los metadatos del libro mapeado con la versión del registro de la que sale
+CLAVE_ORIGEN = b'origen'
+
+# Columnas de texto que el libro mapeado guarda codificadas con diccionario
+COLUMNAS_DICCIONARIO = ('activo', 'tipo', 'tipo_activo', 'divisa_pago', 'divisa_comision')
+
+# Tipo de cada columna conocida del libro de transacciones
+ESQUEMA = {
+    'fecha': pa.timestamp('ns'),
+    'activo': pa.string(),
+    'tipo_activo': pa.string(),
+    'divisa_pago': pa.string(),
+    'tipo': pa.string(),
+    'precio_unitario': pa.float64(),
+    'cantidad': pa.float64(),
+    'comision': pa.float64(),
+    'divisa_comision': pa.string(),
+}
+
+
+def ruta_registro(nombre, extension='.parquet', directorio=DIRECTORIO_REGISTROS):
+    return os.path.join(directorio, f"{nombre}{extension}")
+
+
+def listar_registros(directorio=DIRECTORIO_REGISTROS):
+    """Nombres (sin extensión) de los registros guardados, en Parquet o aún en .xlsx."""
+    if not os.path.exists(directorio):
+        return []
+    return sorted({
+        os.path.splitext(f)[0] for f in os.listdir(directorio) if f.endswith(('.parquet', '.xlsx'))
+    })
+
+
+def normalizar(df):
+    """Copia con las columnas conocidas en su tipo: fechas, números en float64 y textos sin tocar los vacíos."""
+    df = df.copy()
+    for col, tipo in ESQUEMA.items():
+        if col not in df.columns:
+            continue
+        if pa.types.is_timestamp(tipo):
+            df[col] = pd.to_datetime(df[col], errors='coerce').astype('datetime64[ns]')
+        elif pa.types.is_floating(tipo):
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype('float64')
+        else:
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str)).astype(object)
+    return df
+
+
+def _esquema(df):
+    campos = []
+    for col in df.columns:
+        if col in ESQUEMA:
+            campos.append(pa.field(col, ESQUEMA[col]))
+        else:
+            try:
+                campos.append(pa.field(col, pa.Array.from_pandas(df[col]).type))
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+                campos.append(pa.field(col, pa.string()))
+    return pa.schema(campos)
+
+
+def _diario_hasta(ruta):
+    """Última operación del diario incluida en el Parquet de 'ruta' (0 si ninguna o no existe)."""
+    if not os.path.exists(ruta):
+        return 0
+    metadatos = pq.read_schema(ruta).metadata or {}
+    return int(metadatos.get(CLAVE_DIARIO, 0))
+
+
+def guardar_registro(df, nombre, directorio=DIRECTORIO_REGISTROS):
+    """
+    Guarda el libro completo como '<nombre>.parquet' (vía fichero temporal) y vacía su diario,
+    cuyas operaciones quedan incluidas. Retorna la ruta.
+    """
+    os.makedirs(directorio, exist_ok=True)
+    diario = DiarioRegistro(nombre, directorio)
+    with diario.bloqueo():
+        return diario._volcar(df)
+
+
+def cargar_registro(nombre, directorio=DIRECTORIO_REGISTROS):
+    """
+    Libro de un registro guardado con las operaciones pendientes de su diario aplicadas; si
+    solo existe en .xlsx se convierte antes a Parquet.
+    """
+    ruta = ruta_registro(nombre, directorio=directorio)
+    if not os.path.exists(ruta):
+        guardar_registro(pd.read_excel(ruta_registro(nombre, '.xlsx', directorio)), nombre, directorio)
+    df = pq.read_table(ruta).to_pandas()
+    # Las posiciones del diario se refieren al libro de la sesión, que nunca tiene filas sin fecha
+    if 'fecha' in df.columns:
+        df = df.dropna(subset=['fecha'])
+    return DiarioRegistro(nombre, directorio).aplicar(df, _diario_hasta(ruta))
+
+
+def eliminar_registro(nombre, directorio=DIRECTORIO_REGISTROS):
+    """Borra un registro en todos sus formatos, diario incluido."""
+    for extension in ('.parquet', '.xlsx', '.diario.jsonl', '.diario.lock', '.arrow'):
+        ruta = ruta_registro(nombre, extension, directorio)
+        if os.path.exists(ruta):
+            os.remove(ruta)
+
+
+def _origen(nombre, directorio):
+    """Versión del registro (Parquet más diario) que refleja su libro mapeado."""
+    ruta = ruta_registro(nombre, directorio=directorio)
+    secuencia = DiarioRegistro(nombre, directorio).ultima_secuencia()
+    return f"{os.stat(ruta).st_mtime_ns}:{secuencia}".encode()
+
+
+def _escribir_libro_mapeado(df, ruta, origen):
+    """
+    Escribe el libro en Arrow IPC sin comprimir y en un solo bloque, ordenado por (activo, fecha)
+    con las filas sin activo al final y la posición de cada fila en 'id_fila', tal como lo lee
+    LibroParticionado.desde_tabla(). Se guardan todas las filas para poder rehacer el libro.
+    """
+    df = normalizar(df).reset_index(drop=True)
+    df['id_fila'] = df.index.to_numpy()
+    df = df.sort_values(['activo', 'fecha'], kind='stable', na_position='last')
+    tabla = pa.Table.from_pandas(df, schema=_esquema(df), preserve_index=False)
+    for col in COLUMNAS_DICCIONARIO:
+        if col in tabla.column_names:
+            tabla = tabla.set_column(
+                tabla.schema.get_field_index(col), col, pc.dictionary_encode(tabla.column(col))
+            )
+    tabla = tabla.combine_chunks().replace_schema_metadata({CLAVE_ORIGEN: origen})
+
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    with pa.OSFile(temporal, 'wb') as destino, pa.ipc.new_file(destino, tabla.schema) as escritor:
+        escritor.write_table(tabla)
+    os.replace(temporal, ruta)
+
+
+def mapear_registro(nombre, directorio=DIRECTORIO_REGISTROS):
+    """
+    Libro del registro como tabla Arrow mapeada en memoria (sin copiar a la memoria del proceso).
+    El fichero '<nombre>.arrow' se rehace desde el Parquet y el diario solo cuando alguno de los
+    dos ha cambiado; sustituirlo no afecta a los procesos que tienen mapeado el anterior.
+    """
+    df = None
+    if not os.path.exists(ruta_registro(nombre, directorio=directorio)):
+        df = cargar_registro(nombre, directorio)  # convierte el .xlsx a Parquet
+    ruta = ruta_registro(nombre, '.arrow', directorio)
+    origen = _origen(nombre, directorio)
+    if os.path.exists(ruta):
+        tabla = _leer_mapeado(ruta)
+        if (tabla.schema.metadata or {}).get(CLAVE_ORIGEN) == origen:
+            return tabla
+    _escribir_libro_mapeado(df if df is not None else cargar_registro(nombre, directorio), ruta, origen)
+    return _leer_mapeado(ruta)
+
+
+def _leer_mapeado(ruta):
+    with pa.memory_map(ruta) as fuente:
+        return pa.ipc.open_file(fuente).read_all()
+
+
+def tabla_a_libro(tabla):
+    """
+    DataFrame del libro a partir de su tabla mapeada: filas en su orden de registro (el de
+    'id_fila', que se quita) y los textos codificados de vuelta a cadenas.
+    """
+    tabla = tabla.take(pc.sort_indices(tabla['id_fila'])).drop_columns(['id_fila'])
+    for col in COLUMNAS_DICCIONARIO:
+        if col in tabla.column_names and pa.types.is_dictionary(tabla.schema.field(col).type):
+            tabla = tabla.set_column(
+                tabla.schema.get_field_index(col), col, tabla.column(col).cast(pa.string())
+            )
+    return tabla.to_pandas()
+
+
+def exportar_excel(df):
+    """Libro en un .xlsx en memoria, para descargarlo."""
+    salida = io.BytesIO()
+    with pd.ExcelWriter(salida, engine='xlsxwriter') as writer:
+        df.to_excel(writer, index=False, sheet_name='Transacciones')
+    return salida.getvalue()
+
+
+class DiarioRegistro:
+    """
+    Diario de solo-añadir '<nombre>.diario.jsonl' con las altas y bajas de un registro desde su
+    último guardado completo, una operación por línea con número de secuencia creciente. Las
+    bajas son por posición en el libro del momento y al aplicarlas se renumera como con
+    reset_index, así que repetir el diario da siempre el mismo libro. Una última línea cortada
+    por una caída se ignora.
+
+    Varias sesiones pueden tener abierto el mismo registro: cada anotación se hace con el diario
+    bloqueado y releyendo antes su última secuencia. Si otra sesión ha cambiado el registro desde
+    que esta lo cargó, sus posiciones ya no coinciden con las del diario: las bajas se rechazan
+    con ValueError y no se compacta (se perderían las filas de la otra sesión) hasta recargarlo.
+    Un guardado completo también cuenta como cambio: numera el Parquet con la siguiente secuencia.
+    """
+
+    def __init__(self, nombre, directorio=DIRECTORIO_REGISTROS):
+        self.nombre = nombre
+        self.directorio = directorio
+        self.ruta = ruta_registro(nombre, '.diario.jsonl', directorio)
+        self._secuencia = None
+        self._pendientes = None
+        # Última operación que refleja el libro de esta sesión (el registro al crear el diario)
+        self._vista = self.ultima_secuencia()
+        self._ajenas = False
+
+    def entradas(self):
+        if not os.path.exists(self.ruta):
+            return []
+        entradas = []
+        with open(self.ruta, encoding='utf-8') as f:
+            for linea in f:
+                try:
+                    entradas.append(json.loads(linea))
+                except ValueError:
+                    break
+        return entradas
+
+    def _cargar(self):
+        if self._secuencia is None:
+            self._releer()
+
+    def _releer(self):
+        """Relee el diario; anota si tiene operaciones de otra sesión posteriores a la vista de esta."""
+        entradas = self.entradas()
+        hasta = _diario_hasta(ruta_registro(self.nombre, directorio=self.directorio))
+        secuencia = max([hasta] + [e['secuencia'] for e in entradas])
+        if self._secuencia is not None and secuencia != self._secuencia:
+            self._ajenas = True
+        self._secuencia = secuencia
+        self._pendientes = sum(e['secuencia'] > hasta for e in entradas)
+
+    @contextmanager
+    def bloqueo(self):
+        """Bloqueo exclusivo del diario entre procesos, en '<nombre>.diario.lock'."""
+        os.makedirs(self.directorio, exist_ok=True)
+        with open(ruta_registro(self.nombre, '.diario.lock', self.directorio), 'a+') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def ultima_secuencia(self):
+        self._cargar()
+        return self._secuencia
+
+    def __len__(self):
+        """Operaciones anotadas que aún no están en el Parquet."""
+        self._cargar()
+        return self._pendientes
+
+    def _anotar(self, entrada):
+        with self.bloqueo():
+            self._releer()
+            if entrada['op'] == 'baja' and self._ajenas:
+                raise ValueError(
+                    f"Otra sesión ha modificado el registro {self.nombre} desde que se cargó; "
+                    "vuelve a cargarlo antes de eliminar transacciones."
+                )
+            entrada = {'secuencia': self._secuencia + 1, **entrada}
+            with open(self.ruta, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entrada, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._secuencia += 1
+            self._pendientes += 1
+            if not self._ajenas:
+                self._vista = self._secuencia
+
+    def anotar_altas(self, filas):
+        """Anota filas añadidas al final del libro."""
+        self._anotar({'op': 'alta', 'filas': json.loads(
+            normalizar(filas).to_json(orient='records', date_format='iso', date_unit='ns')
+        )})
+
+    def anotar_bajas(self, ids):
+        """Anota filas eliminadas por su posición en el libro."""
+        self._anotar({'op': 'baja', 'ids': sorted(int(i) for i in ids)})
+
+    def aplicar(self, df, desde_secuencia=0):
+        """Libro tras aplicar a 'df' las operaciones posteriores a 'desde_secuencia'."""
+        df = df.reset_index(drop=True)
+        for entrada in self.entradas():
+            if entrada['secuencia'] <= desde_secuencia:
+                continue
+            if entrada['op'] == 'alta':
+                altas = normalizar(pd.DataFrame(entrada['filas']))
+                df = normalizar(pd.concat([df, altas], ignore_index=True))
+            elif entrada['op'] == 'baja':
+                df = df.drop(index=entrada['ids']).reset_index(drop=True)
+        return df
+
+    def compactar_si_toca(self, df, umbral=UMBRAL_COMPACTACION):
+        """
+        Vuelca el libro completo al Parquet cuando el diario acumula 'umbral' operaciones, salvo
+        que otra sesión haya cambiado el registro (su libro no es entonces el de esta sesión).
+        """
+        if len(self) < umbral:
+            return False
+        with self.bloqueo():
+            self._releer()
+            if self._ajenas:
+                return False
+            self._volcar(df)
+            self._vista = self._secuencia
+        return True
+
+    def _volcar(self, df):
+        """
+        Escribe el libro completo en el Parquet con las operaciones del diario como incluidas y lo
+        vacía. El volcado toma su propio número de secuencia, así que las demás sesiones ven que el
+        registro ha cambiado aunque el diario estuviera vacío.
+        """
+        self._releer()
+        self._secuencia += 1
+        df = normalizar(df).reset_index(drop=True)
+        tabla = pa.Table.from_pandas(df, schema=_esquema(df), preserve_index=False)
+        tabla = tabla.replace_schema_metadata({
+            **(tabla.schema.metadata or {}), CLAVE_DIARIO: str(self._secuencia).encode()
+        })
+        ruta = ruta_registro(self.nombre, directorio=self.directorio)
+        pq.write_table(tabla, ruta + '.tmp', compression='zstd')
+        os.replace(ruta + '.tmp', ruta)
+        # Si se corta aquí el diario sigue lleno, pero sus operaciones ya constan como incluidas
+        self.vaciar()
+        return ruta
+
+    def vaciar(self):
+        """Borra el diario cuando sus operaciones ya están en el Parquet (la secuencia sigue desde ahí)."""
+        if os.path.exists(self.ruta):
+            os.remove(self.ruta)
+        self._pendientes = 0
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Instantánea nocturna de precios.
+
+Recorre todos los portafolios de registros_guardados y, con las descargas multi-ticker de
+precios.py, guarda en el almacén local (historico_precios.py) los cierres que faltan de cada
+activo y de los tipos de cambio que usan. Al día siguiente las ventanas de valoración arrancan
+con el último cierre sin ir a la red y el refresco del día solo pide lo nuevo. Cada petición al
+proveedor queda en el log con su duración, y al final se listan las más lentas.
+
+Uso (por ejemplo desde cron, cada noche a las 23:30):
+    30 23 * * * cd /ruta/Portfolio && python snapshot_precios.py >> datos_precios/snapshot.log 2>&1
+"""
+import argparse
+import logging
+import time
+
+import pandas as pd
+
+from divisas import DIVISA_BASE, par_yf, pares_necesarios
+from historico_precios import FECHA_INICIO_HISTORICO, almacen_precios
+from precios import obtener_precios, proveedor_actual, ticker_yf, usar_proveedor
+from proveedores_precios import ProveedorCronometrado
+from registros import DIRECTORIO_REGISTROS, listar_registros, mapear_registro
+
+log = logging.getLogger('snapshot_precios')
+
+
+def leer_portafolios(directorio):
+    """
+    Activos y divisas de todos los portafolios guardados en 'directorio', con la primera fecha de
+    cada combinación, en un solo DataFrame. Se agrega sobre los libros mapeados en memoria, sin
+    cargar las transacciones.
+    """
+    libros = []
+    for nombre in listar_registros(directorio):
+        try:
+            tabla = mapear_registro(nombre, directorio)
+            claves = [c for c in ('activo', 'divisa_pago', 'divisa_comision') if c in tabla.column_names]
+            libros.append(
+                tabla.group_by(claves).aggregate([('fecha', 'min')]).to_pandas()
+                .rename(columns={'fecha_min': 'fecha'})
+            )
+        except Exception as e:
+            log.warning("No se pudo leer %s: %s", nombre, e)
+    log.info("%d portafolios leídos de %s", len(libros), directorio)
+    return pd.concat(libros, ignore_index=True) if libros else pd.DataFrame(columns=['activo', 'fecha'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--directorio', default=DIRECTORIO_REGISTROS)
+    parser.add_argument('--lentas', type=int, default=10, help="Peticiones más lentas a listar al final")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    proveedor = ProveedorCronometrado(proveedor_actual())
+    usar_proveedor(proveedor)
+    inicio = time.perf_counter()
+
+    transacciones = leer_portafolios(args.directorio)
+    activos = sorted(transacciones['activo'].dropna().astype(str).unique())
+    fechas = pd.to_datetime(transacciones['fecha'], errors='coerce')
+    desde = fechas.min() if fechas.notna().any() else pd.Timestamp(FECHA_INICIO_HISTORICO)
+
+    # Precio actual primero: aprende qué variante de ticker funciona para los activos nuevos
+    precios, fallos = obtener_precios(activos)
+    log.info("%d activos con precio, %d sin precio: %s", len(precios), len(fallos), fallos)
+
+    # Tipos de cambio de las cotizaciones y de las divisas en que se pagaron las operaciones
+    divisas = set()
+    for columna in ('divisa_pago', 'divisa_comision'):
+        if columna in transacciones.columns:
+            divisas |= set(transacciones[columna].dropna().astype(str).str.strip().str.upper())
+    pares = pares_necesarios(activos) | {par_yf(d) for d in divisas - {DIVISA_BASE, ''} if d not in activos}
+
+    tickers = sorted({ticker_yf(activo) for activo in activos} | pares)
+    guardadas = almacen_precios.actualizar(tickers, desde=desde)
+    log.info("%d cierres guardados de %d tickers (%d tipos de cambio) en %s",
+             sum(guardadas.values()), len(guardadas), len(pares), almacen_precios.ruta)
+
+    lentas = sorted(proveedor.llamadas, key=lambda llamada: llamada[2], reverse=True)[:args.lentas]
+    for metodo, simbolos, segundos in lentas:
+        log.info("Lenta: %s(%s) %.2f s", metodo, ', '.join(simbolos), segundos)
+    log.info("Instantánea completada en %.1f s con %d peticiones a %s",
+             time.perf_counter() - inicio, len(proveedor.llamadas), proveedor.nombre)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+Configuración común de las pruebas.
+
+Los módulos de la app están en la raíz del repositorio. Antes de importar precios.py se apunta
+el proveedor de cotizaciones a un fichero de pruebas y los datos de precios a un directorio
+temporal, así que ninguna prueba va a la red ni toca datos_precios.
+"""
+import json
+import os
+import sys
+import tempfile
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DIRECTORIO_PRECIOS = tempfile.mkdtemp(prefix='precios_pruebas_')
+FIXTURE_PRECIOS = os.path.join(DIRECTORIO_PRECIOS, 'cotizaciones.json')
+
+# Tipo euros por dólar en los días laborables de enero de 2024 (sin fines de semana)
+DIAS_USDEUR = pd.bdate_range('2024-01-02', '2024-01-31')
+TIPOS_USDEUR = {dia.strftime('%Y-%m-%d'): round(0.90 + i / 1000, 4) for i, dia in enumerate(DIAS_USDEUR)}
+
+with open(FIXTURE_PRECIOS, 'w', encoding='utf-8') as f:
+    json.dump({
+        'cierres': {'USDEUR=X': TIPOS_USDEUR, 'SPY': {'2024-01-31': 480.0}},
+        'divisas': {'SPY': 'USD'},
+    }, f)
+
+os.environ.update({
+    'PRECIOS_PROVEEDOR': 'fichero',
+    'PRECIOS_FIXTURE': FIXTURE_PRECIOS,
+    'PRECIOS_DIRECTORIO': DIRECTORIO_PRECIOS,
+    'DIVISA_BASE': 'EUR',
+})
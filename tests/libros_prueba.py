@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Libros de transacciones de prueba y comparación de resultados FIFO."""
+import numpy as np
+import pandas as pd
+
+
+def libro(*filas):
+    """Libro a partir de tuplas (tipo, cantidad, precio, activo[, comision, divisa_comision]), un día por fila."""
+    filas = [f + (0.0, 'EUR') if len(f) == 4 else f for f in filas]
+    return pd.DataFrame({
+        'tipo': [f[0] for f in filas],
+        'cantidad': [float(f[1]) for f in filas],
+        'precio_unitario': [float(f[2]) for f in filas],
+        'fecha': pd.Timestamp('2023-01-01') + pd.to_timedelta(np.arange(len(filas)), unit='D'),
+        'tipo_activo': 'Cripto',
+        'activo': [f[3] for f in filas],
+        'comision': [float(f[4]) for f in filas],
+        'divisa_comision': [f[5] for f in filas],
+    })
+
+
+def libro_aleatorio(filas, activos, semilla=0):
+    """Compras y ventas intercaladas de tamaño aleatorio: casi cada venta consume varios lotes a medias."""
+    rng = np.random.default_rng(semilla)
+    tipos = np.where(rng.random(filas) < 0.55, 'compra', 'venta')
+    return pd.DataFrame({
+        'tipo': tipos,
+        'cantidad': np.round(rng.random(filas) * np.where(tipos == 'compra', 1.0, 1.5) + 1e-8, 8),
+        'precio_unitario': np.round(rng.random(filas) * 100 + 1, 2),
+        'fecha': pd.Timestamp('2018-01-01') + pd.to_timedelta(np.arange(filas) * 37, unit='h'),
+        'tipo_activo': rng.choice(['ETF', 'Cripto', 'Acción'], filas),
+        'activo': rng.choice([f'ACT{i}' for i in range(activos)], filas),
+    })
+
+
+def libro_degenerado():
+    """
+    Activos sin ninguna venta emparejada: solo compras, solo ventas y venta antes de la primera
+    compra, junto a uno normal. El libro aleatorio nunca los genera.
+    """
+    return libro(
+        ('compra', 1.5, 10, 'SOLO_COMPRAS'), ('compra', 2, 11, 'SOLO_COMPRAS'),
+        ('venta', 1, 12, 'SOLO_VENTAS'),
+        ('venta', 1, 9, 'VENTA_ANTES'), ('compra', 3, 8, 'VENTA_ANTES'),
+        ('compra', 2, 5, 'NORMAL'), ('venta', 0.5, 7, 'NORMAL'),
+    )
+
+
+def fifo_referencia(df):
+    """
+    (tramos, posición por activo) con el bucle lote a lote que tenían las ventanas de la app antes
+    del motor compartido.
+    """
+    tramos = []
+    posiciones = {}
+    for activo in df['activo'].unique():
+        grupo = df[df['activo'] == activo].sort_values('fecha', kind='mergesort')
+        lotes = []
+        for fila in grupo.itertuples(index=False):
+            if fila.tipo == 'compra':
+                lotes.append([fila.cantidad, fila.precio_unitario])
+            elif fila.tipo == 'venta':
+                cantidad_a_vender = fila.cantidad
+                while cantidad_a_vender > 0 and lotes:
+                    lote = lotes[0]
+                    cantidad_vendida = min(lote[0], cantidad_a_vender)
+                    lote[0] -= cantidad_vendida
+                    cantidad_a_vender -= cantidad_vendida
+                    if lote[0] == 0:
+                        lotes.pop(0)
+                    tramos.append((activo, fila.fecha, cantidad_vendida, lote[1], fila.precio_unitario,
+                                   cantidad_vendida * (fila.precio_unitario - lote[1])))
+        posiciones[activo] = sum(l[0] for l in lotes)
+    return pd.DataFrame(tramos, columns=[
+        'activo', 'fecha_venta', 'cantidad', 'precio_compra', 'precio_venta', 'ganancia'
+    ]), pd.Series(posiciones, dtype=float)
+
+
+def ordenar(resultado):
+    """(tramos, lotes, resumen) en un orden fijo para comparar resultados de caminos distintos."""
+    tramos = resultado.tramos.sort_values(['activo', 'id_venta', 'precio_compra'], kind='stable')
+    lotes = resultado.lotes.drop(columns='id_compra', errors='ignore')
+    lotes = lotes.sort_values(['activo', 'fecha_compra', 'precio'], kind='stable')
+    resumen = resultado.resumen.sort_values('activo', kind='stable')
+    return [df.reset_index(drop=True) for df in (tramos, lotes, resumen)]
+
+
+def comprobar_iguales(obtenido, esperado):
+    for a, b in zip(ordenar(obtenido), ordenar(esperado)):
+        pd.testing.assert_frame_equal(a, b, check_dtype=False, check_exact=False, rtol=1e-9, atol=1e-9)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Tipos de cambio leídos del almacén con el proveedor de fichero de conftest.py."""
+import numpy as np
+import pandas as pd
+import pytest
+
+import divisas
+from conftest import TIPOS_USDEUR
+from historico_precios import almacen_precios
+
+
+@pytest.fixture(scope='module')
+def matriz():
+    almacen_precios.actualizar(['USDEUR=X'], desde='2024-01-01')
+    return divisas.matriz_tipos(['USD'], '2024-01-01')
+
+
+def test_tipo_del_dia_y_del_ultimo_cierre(matriz):
+    fechas = pd.to_datetime(['2024-01-02', '2024-01-06', '2024-01-07', '2024-01-08'])
+    tipos = divisas.tipos_en_fecha(fechas, ['USD'] * 4, matriz)
+    # Sábado y domingo toman el cierre del viernes 5
+    esperados = [TIPOS_USDEUR['2024-01-02'], TIPOS_USDEUR['2024-01-05'], TIPOS_USDEUR['2024-01-05'],
+                 TIPOS_USDEUR['2024-01-08']]
+    np.testing.assert_allclose(tipos, esperados)
+
+
+def test_antes_del_historico_no_hay_tipo(matriz):
+    fechas = pd.to_datetime(['2023-12-29', None, '2023-12-29'])
+    tipos = divisas.tipos_en_fecha(fechas, ['USD', 'USD', 'EUR'], matriz)
+    assert np.isnan(tipos[0]) and np.isnan(tipos[1])
+    assert tipos[2] == 1.0
+
+
+def test_subunidades_y_divisas_desconocidas(matriz):
+    fechas = pd.to_datetime(['2024-01-02', '2024-01-02'])
+    tipos = divisas.tipos_en_fecha(fechas, ['GBp', 'JPY'], matriz)
+    assert np.isnan(tipos).all()
+    assert divisas.tipos_en_fecha(fechas[:1], ['EUR'], matriz)[0] == 1.0
+
+
+def test_libro_en_base_marca_las_filas_sin_tipo(matriz):
+    df = pd.DataFrame({
+        'fecha': pd.to_datetime(['2023-12-20', '2024-01-03', '2024-01-03']),
+        'activo': ['SPY', 'SPY', 'BTC'], 'tipo': ['compra', 'venta', 'compra'],
+        'cantidad': [1.0, 1.0, 0.1], 'precio_unitario': [100.0, 110.0, 30000.0],
+        'divisa_pago': ['USD', 'USD', 'EUR'],
+        'comision': [1.0, 1.0, 0.001], 'divisa_comision': ['USD', 'USD', 'BTC'],
+    })
+    base = divisas.libro_en_base(df)
+    tipo = TIPOS_USDEUR['2024-01-03']
+
+    assert np.isnan(base['precio_unitario'].iloc[0]) and base['divisa_pago'].iloc[0] == 'USD'
+    assert base['precio_unitario'].iloc[1] == pytest.approx(110.0 * tipo)
+    assert base['comision'].iloc[1] == pytest.approx(tipo)
+    assert base['divisa_comision'].iloc[2] == 'BTC'
+    assert base['comision'].iloc[2] == 0.001
+    assert divisas.filas_sin_tipo(base).tolist() == [True, False, False]
+
+
+def test_una_matriz_por_conjunto_de_divisas(matriz):
+    # Cada 'desde' posterior vale con la matriz guardada en vez de añadir otra a la caché
+    for dia in pd.date_range('2024-01-02', '2024-01-20', freq='D'):
+        divisas.matriz_tipos(['USD'], dia)
+    assert list(divisas._matrices) == [('USD',)]
+
+    # Una fecha anterior la amplía hacia atrás y las posteriores no la recortan
+    divisas.matriz_tipos(['USD'], '2023-12-01')
+    divisas.matriz_tipos(['USD'], '2024-01-10')
+    assert list(divisas._matrices) == [('USD',)]
+    assert divisas._matrices[('USD',)][1] == pd.Timestamp('2023-12-01')
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""Almacén de cierres diarios con el proveedor de fichero de conftest.py."""
+import pandas as pd
+
+from conftest import TIPOS_USDEUR
+from historico_precios import AlmacenPrecios
+
+
+def test_almacen_rellena_hacia_atras(tmp_path):
+    almacen = AlmacenPrecios(str(tmp_path / 'historico.sqlite'))
+    almacen.actualizar(['USDEUR=X'], desde='2024-01-20')
+    assert almacen.rangos_guardados(['USDEUR=X'])['USDEUR=X'][0] == pd.Timestamp('2024-01-22')
+
+    version = almacen.version
+    almacen.actualizar(['USDEUR=X'], desde='2024-01-01')
+    primera, ultima = almacen.rangos_guardados(['USDEUR=X'])['USDEUR=X']
+    assert primera == pd.Timestamp('2024-01-02') and ultima == pd.Timestamp('2024-01-31')
+    assert almacen.version > version
+    assert almacen.actualizar(['USDEUR=X'], desde='2024-01-01') == {}
+
+
+def test_sin_actualizar_lee_lo_guardado_y_encarga_el_resto(tmp_path):
+    almacen = AlmacenPrecios(str(tmp_path / 'historico.sqlite'))
+    almacen.actualizar(['USDEUR=X'], desde='2024-01-20')
+
+    cierres = almacen.cierres_activos(['USDEUR=X'], desde='2024-01-01', actualizar=False)
+    assert cierres.index.min() == pd.Timestamp('2024-01-22')
+    assert almacen._encargos == {'USDEUR=X': pd.Timestamp('2024-01-01')}
+
+    almacen.completar_encargos()
+    cierres = almacen.cierres_activos(['USDEUR=X'], desde='2024-01-01', actualizar=False)
+    assert cierres.index.min() == pd.Timestamp('2024-01-02')
+    assert cierres.loc['2024-01-02', 'USDEUR=X'] == TIPOS_USDEUR['2024-01-02']
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Importación por bloques de los ficheros de los brókers."""
+import pandas as pd
+import pytest
+
+from importacion import importar_por_bloques
+from libros_prueba import libro_aleatorio
+
+NECESARIAS = ['activo', 'tipo', 'cantidad', 'precio_unitario', 'fecha', 'tipo_activo']
+
+
+def exportacion(filas=25):
+    """Libro con los nombres de columna de un bróker: otro orden, mayúsculas y en inglés."""
+    df = libro_aleatorio(filas, 3, semilla=5)
+    df['tipo'] = df['tipo'].map({'compra': 'BUY', 'venta': 'Sell'})
+    return df.rename(columns={
+        'activo': 'Activo', 'cantidad': 'Cantidad', 'precio_unitario': 'Precio_Unitario',
+        'fecha': 'Fecha operación', 'tipo_activo': 'Tipo_Activo', 'tipo': 'Tipo',
+    })[['Fecha operación', 'Tipo', 'Activo', 'Tipo_Activo', 'Cantidad', 'Precio_Unitario']]
+
+
+@pytest.mark.parametrize('extension', ['.csv', '.xlsx'])
+def test_bloques_iguales_a_lectura_completa(tmp_path, extension):
+    ruta = str(tmp_path / f'exportacion{extension}')
+    origen = exportacion()
+    if extension == '.csv':
+        origen.to_csv(ruta, index=False)
+    else:
+        origen.to_excel(ruta, index=False)
+
+    bloques = list(importar_por_bloques(ruta, NECESARIAS, filas_bloque=10))
+    assert [len(b) for b, _ in bloques] == [10, 10, 5]
+    assert bloques[-1][1] == 1.0
+
+    importado = pd.concat([b for b, _ in bloques], ignore_index=True)
+    esperado = libro_aleatorio(25, 3, semilla=5)
+    assert importado.columns.tolist() == ['fecha', 'tipo', 'activo', 'tipo_activo', 'cantidad', 'precio_unitario']
+    pd.testing.assert_frame_equal(importado[esperado.columns], esperado, check_dtype=False)
+
+
+def test_xlsx_avanza_por_filas_leidas(tmp_path):
+    ruta = str(tmp_path / 'exportacion.xlsx')
+    exportacion(40).to_excel(ruta, index=False)
+    leido = [fraccion for _, fraccion in importar_por_bloques(ruta, NECESARIAS, filas_bloque=10)]
+    assert leido == [0.25, 0.5, 0.75, 1.0]
+
+
+def test_faltan_columnas(tmp_path):
+    ruta = str(tmp_path / 'exportacion.xlsx')
+    exportacion().drop(columns='Precio_Unitario').to_excel(ruta, index=False)
+    with pytest.raises(ValueError, match='precio_unitario'):
+        next(importar_por_bloques(ruta, NECESARIAS))
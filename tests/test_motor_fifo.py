@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""Motor FIFO compartido: mismo resultado que el bucle lote a lote de las ventanas."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from libros_prueba import comprobar_iguales, fifo_referencia, libro, libro_aleatorio, libro_degenerado
+from motor_fifo import ESCALA_CANTIDAD, DesbordePuntoFijo, EstadoFIFO, IndicePosiciones, calcular_fifo
+
+MODOS = ['cola', 'vectorizado', 'nucleo']
+ESCALAS = [None, ESCALA_CANTIDAD]
+
+LIBROS_LIMITE = {
+    'vacio': libro(),
+    'degenerado': libro_degenerado(),
+    'venta_mayor_que_posicion': libro(('compra', 1, 10, 'A'), ('venta', 3, 12, 'A')),
+    'cantidades_vacias': libro(
+        ('compra', 3, 10, 'A'), ('compra', np.nan, 11, 'A'), ('venta', np.nan, 12, 'A'),
+        ('compra', 2, 9, 'B'), ('venta', 1, 12, 'B'),
+    ),
+    'comisiones': libro(
+        ('compra', 1, 100, 'BTC', 0.01, 'BTC'), ('compra', 1, 110, 'BTC', 2.0, 'EUR'),
+        ('venta', 0.5, 200, 'BTC', 0.01, 'BTC'), ('venta', 1.0, 210, 'BTC', 1.5, 'EUR'),
+    ),
+    'aleatorio': libro_aleatorio(3000, 7, semilla=5),
+}
+
+
+def test_tramos_iguales_al_bucle_de_las_ventanas():
+    df = libro_aleatorio(2000, 5, semilla=1)
+    tramos = calcular_fifo(df).tramos
+    referencia, _ = fifo_referencia(df)
+
+    tramos = tramos.set_index('activo').loc[referencia['activo'].unique()].reset_index()
+    assert len(tramos) == len(referencia)
+    assert (tramos['fecha_venta'].to_numpy() == referencia['fecha_venta'].to_numpy()).all()
+    for col in ['cantidad', 'precio_compra', 'precio_venta', 'ganancia']:
+        np.testing.assert_allclose(tramos[col], referencia[col], rtol=1e-9, atol=1e-9)
+
+
+def test_posicion_y_precio_medio_por_activo():
+    df = libro_aleatorio(2000, 5, semilla=2)
+    resumen = calcular_fifo(df).resumen.set_index('activo')
+    _, posiciones = fifo_referencia(df)
+    np.testing.assert_allclose(resumen['posicion'], posiciones.reindex(resumen.index), atol=1e-9)
+
+    df = libro(('compra', 2, 10, 'A'), ('compra', 2, 20, 'A'), ('venta', 3, 30, 'A'))
+    resumen = calcular_fifo(df).resumen.iloc[0]
+    assert resumen['posicion'] == pytest.approx(1)
+    assert resumen['precio_medio'] == pytest.approx(20)
+    assert resumen['ganancia_realizada'] == pytest.approx(2 * 20 + 1 * 10)
+
+
+@pytest.mark.parametrize('escala', ESCALAS)
+@pytest.mark.parametrize('modo', MODOS[1:])
+@pytest.mark.parametrize('nombre', LIBROS_LIMITE)
+def test_modos_iguales_a_cola(nombre, modo, escala):
+    df = LIBROS_LIMITE[nombre]
+    comprobar_iguales(calcular_fifo(df, modo, escala=escala), calcular_fifo(df, 'cola', escala=escala))
+
+
+@pytest.mark.parametrize('modo', MODOS)
+def test_activos_sin_ventas_emparejadas(modo):
+    resultado = calcular_fifo(libro_degenerado(), modo)
+    resumen = resultado.resumen.set_index('activo')
+    assert set(resultado.tramos['activo']) == {'NORMAL'}
+    assert resumen.loc['SOLO_COMPRAS', 'posicion'] == pytest.approx(3.5)
+    assert resumen.loc['SOLO_VENTAS', 'posicion'] == 0
+    assert resumen.loc['VENTA_ANTES', 'posicion'] == pytest.approx(3.0)
+
+
+@pytest.mark.parametrize('modo', MODOS)
+def test_cantidades_vacias_no_mueven_la_cola(modo):
+    resumen = calcular_fifo(LIBROS_LIMITE['cantidades_vacias'], modo).resumen.set_index('activo')
+    assert resumen.loc['A', 'posicion'] == pytest.approx(3.0)
+    assert resumen.loc['B', 'posicion'] == pytest.approx(1.0)
+
+
+@pytest.mark.parametrize('escala', ESCALAS)
+def test_estado_incremental_igual_a_pasada_completa(escala):
+    df = libro_aleatorio(1500, 6, semilla=2)
+    df.loc[::7, 'comision'] = 0.5
+    df['divisa_comision'] = 'EUR'
+    estado = EstadoFIFO(escala=escala)
+    for inicio in range(0, len(df), 200):
+        estado.añadir_libro(df.iloc[inicio:inicio + 200])
+        estado.sincronizar(df.iloc[:inicio + 200])
+    comprobar_iguales(estado.resultado(), calcular_fifo(df, escala=escala))
+
+
+def test_estado_rehace_filas_retrasadas_y_eliminadas():
+    df = libro_aleatorio(800, 4, semilla=3)
+    estado = EstadoFIFO.desde_libro(df, escala=ESCALA_CANTIDAD)
+
+    # Una compra anterior a la última fecha de su activo deja el activo pendiente de rehacer
+    retrasada = df.iloc[[10]].assign(tipo='compra', fecha=df['fecha'].iloc[10] - pd.Timedelta(days=1))
+    retrasada.index = [len(df)]
+    estado.añadir_libro(retrasada)
+    df = pd.concat([df, retrasada])
+    assert retrasada['activo'].iloc[0] in estado.pendientes
+    estado.sincronizar(df)
+    comprobar_iguales(estado.resultado(), calcular_fifo(df, escala=ESCALA_CANTIDAD))
+
+    ids = [3, 50, 400]
+    estado.eliminar(ids, df.loc[ids, 'activo'].unique())
+    df = df.drop(index=ids).reset_index(drop=True)
+    estado.sincronizar(df)
+    comprobar_iguales(estado.resultado(), calcular_fifo(df, escala=ESCALA_CANTIDAD))
+
+
+def test_rehacer_toma_los_importes_nuevos():
+    # Mismo número de filas con otros importes (p. ej. convertidos con tipos recién descargados)
+    df = libro(('compra', 1, 10, 'A'), ('venta', 1, 12, 'A'), ('compra', 1, 5, 'B'))
+    estado = EstadoFIFO.desde_libro(df)
+    corregido = df.assign(precio_unitario=[11.0, 12.0, 5.0])
+    estado.rehacer(['A'])
+    estado.sincronizar(corregido)
+    comprobar_iguales(estado.resultado(), calcular_fifo(corregido))
+
+@pytest.mark.parametrize('modo', MODOS)
+def test_punto_fijo_agota_los_lotes_exactamente(modo):
+    # En coma flotante 0.1 + 0.2 - 0.3 deja un resto de ~1e-17 abierto; en punto fijo no
+    df = libro(('compra', 0.1, 10, 'A'), ('compra', 0.2, 11, 'A'), ('venta', 0.3, 12, 'A'))
+    resultado = calcular_fifo(df, modo, escala=ESCALA_CANTIDAD)
+    assert resultado.lotes.empty
+    assert resultado.resumen['posicion'].iloc[0] == 0
+    assert resultado.tramos['cantidad'].sum() == pytest.approx(0.3)
+
+
+@pytest.mark.parametrize('modo', MODOS)
+def test_punto_fijo_por_activo(modo):
+    # 3e10 unidades a 10**8 caben en int64 aunque el libro entero sume más que otro activo grande
+    df = libro(('compra', 3e10, 1e-5, 'SHIB'), ('venta', 1e10, 2e-5, 'SHIB'), ('compra', 1.5, 30000, 'BTC'))
+    resumen = calcular_fifo(df, modo, escala=ESCALA_CANTIDAD).resumen.set_index('activo')
+    assert resumen.loc['SHIB', 'posicion'] == pytest.approx(2e10)
+
+    grande = libro(('compra', 6e10, 1e-5, 'SHIB'), ('compra', 1.5, 30000, 'BTC'))
+    with pytest.raises(DesbordePuntoFijo, match='SHIB'):
+        calcular_fifo(grande, modo, escala=ESCALA_CANTIDAD)
+    resumen = calcular_fifo(grande, modo, escala={'SHIB': 100}).resumen.set_index('activo')
+    assert resumen.loc['SHIB', 'posicion'] == pytest.approx(6e10)
+
+
+def test_estado_reduce_la_escala_del_activo_que_no_cabe():
+    grande = libro(('compra', 6e10, 1e-5, 'SHIB'), ('venta', 1e10, 2e-5, 'SHIB'), ('compra', 1.5, 30000, 'BTC'))
+    estado = EstadoFIFO.desde_libro(grande, escala=ESCALA_CANTIDAD)
+    assert estado.escalas['BTC'] == ESCALA_CANTIDAD
+    assert estado.escalas['SHIB'] < ESCALA_CANTIDAD
+    comprobar_iguales(estado.resultado(), calcular_fifo(grande, escala=estado.escalas))
+
+
+def test_alta_que_no_cabe_rehace_el_activo():
+    df = libro(('compra', 3e10, 1e-5, 'SHIB'), ('compra', 1.5, 30000, 'BTC'))
+    estado = EstadoFIFO.desde_libro(df, escala=ESCALA_CANTIDAD)
+    alta = libro(('compra', 5e10, 1e-5, 'SHIB')).assign(fecha=pd.Timestamp('2023-02-01'))
+    alta.index = [len(df)]
+    estado.añadir_libro(alta)
+    assert estado.pendientes == {'SHIB'}
+
+    df = pd.concat([df, alta])
+    estado.sincronizar(df)
+    resumen = estado.resultado().resumen.set_index('activo')
+    assert resumen.loc['SHIB', 'posicion'] == pytest.approx(8e10)
+    assert resumen.loc['BTC', 'posicion'] == pytest.approx(1.5)
+
+
+@pytest.mark.parametrize('escala', ESCALAS)
+def test_posiciones_en_fecha_iguales_al_libro_hasta_esa_fecha(escala):
+    df = libro_aleatorio(2000, 5, semilla=7)
+    df.loc[::50, 'cantidad'] = np.nan
+    df.loc[3, 'fecha'] = pd.NaT
+    indice = IndicePosiciones(df, escala=escala)
+    for fecha in pd.to_datetime(['2017-12-31', '2018-03-05', '2019-06-30', '2030-01-01']):
+        # En coma flotante el modo vectorizado no deja restos de redondeo abiertos, como el índice
+        esperado = calcular_fifo(df[df['fecha'] < fecha + pd.Timedelta(days=1)], 'vectorizado', escala=escala)
+        abiertos = esperado.resumen[esperado.resumen['posicion'] > 0].sort_values('activo', ignore_index=True)
+        posiciones = indice.posiciones_en(fecha).sort_values('activo', ignore_index=True)
+        assert posiciones['activo'].tolist() == abiertos['activo'].tolist()
+        for col in ['posicion', 'precio_medio', 'coste_abierto']:
+            np.testing.assert_allclose(posiciones[col], abiertos[col], rtol=1e-9)
+        for activo in abiertos['activo']:
+            pd.testing.assert_frame_equal(
+                indice.lotes_en(activo, fecha), esperado.lotes_activo(activo).reset_index(drop=True),
+                check_exact=False, rtol=1e-9
+            )
+
+
+def test_posicion_incluye_el_dia_y_se_rehace_con_el_libro():
+    df = libro(('compra', 2, 10, 'A'), ('venta', 0.5, 12, 'A'), ('compra', 1, 13, 'A'))
+    estado = EstadoFIFO.desde_libro(df, escala=ESCALA_CANTIDAD)
+    indice = estado.indice_posiciones(df)
+    assert indice.posicion_en('A', '2022-12-31') == (0, 0, 0.0)
+    assert indice.posicion_en('A', '2023-01-02')[0] == pytest.approx(1.5)
+    assert indice.posicion_en('A', '2023-01-03')[2] == pytest.approx(1.5 * 10 + 13)
+    assert indice.posicion_en('B', '2023-01-03') == (0, 0, 0.0)
+    assert estado.indice_posiciones(df) is indice
+
+    alta = libro(('venta', 2, 14, 'A')).assign(fecha=pd.Timestamp('2023-01-04'))
+    alta.index = [len(df)]
+    estado.añadir_libro(alta)
+    df = pd.concat([df, alta])
+    assert estado.indice_posiciones(df).posicion_en('A', '2023-01-04')[0] == pytest.approx(0.5)
+
+
+@pytest.mark.parametrize('modo', MODOS)
+def test_comision_en_efectivo_va_al_precio(modo):
+    df = libro(('compra', 2, 100, 'SPY', 4.0, 'EUR'), ('venta', 1, 150, 'SPY', 3.0, 'EUR'))
+    resultado = calcular_fifo(df, modo)
+    tramo = resultado.tramos.iloc[0]
+    assert tramo['precio_compra'] == pytest.approx(102)
+    assert tramo['precio_venta'] == pytest.approx(147)
+    assert resultado.resumen['ganancia_realizada'].iloc[0] == pytest.approx(45)
+
+
+@pytest.mark.parametrize('modo', MODOS)
+def test_comision_en_especie_en_venta_reduce_la_cantidad_entregada(modo):
+    df = libro(('compra', 1, 100, 'BTC'), ('venta', 0.5, 200, 'BTC', 0.01, 'BTC'))
+    resumen = calcular_fifo(df, modo, escala=ESCALA_CANTIDAD).resumen.iloc[0]
+    assert resumen['posicion'] == pytest.approx(0.51)
+    assert resumen['ganancia_realizada'] == pytest.approx(0.49 * 100)
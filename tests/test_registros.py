@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""Registros guardados: Parquet, diario de altas y bajas y libro mapeado."""
+import json
+import os
+
+import pandas as pd
+import pytest
+
+from libros_prueba import comprobar_iguales, libro_aleatorio
+from motor_fifo import ESCALA_CANTIDAD, EstadoFIFO, calcular_fifo
+from registros import (
+    DiarioRegistro, cargar_registro, eliminar_registro, guardar_registro, listar_registros, mapear_registro,
+    tabla_a_libro
+)
+
+
+def libro(filas=5):
+    df = libro_aleatorio(filas, 3, semilla=4)
+    df['divisa_pago'] = 'EUR'
+    df['comision'] = 0.5
+    df['divisa_comision'] = ['EUR', 'ACT0'] * (filas // 2) + ['EUR'] * (filas % 2)
+    return df
+
+
+def alta(cantidad=1.0):
+    return pd.DataFrame([{
+        'tipo': 'compra', 'cantidad': cantidad, 'precio_unitario': 9.5, 'fecha': pd.Timestamp('2021-05-05'),
+        'tipo_activo': 'ETF', 'activo': 'NUEVO', 'divisa_pago': 'EUR', 'comision': 0.0, 'divisa_comision': 'EUR',
+    }])
+
+
+def test_guardar_y_cargar(tmp_path):
+    df = libro()
+    guardar_registro(df, 'r', tmp_path)
+    assert listar_registros(tmp_path) == ['r']
+    pd.testing.assert_frame_equal(cargar_registro('r', tmp_path), df, check_dtype=False)
+
+
+def test_cargar_convierte_excel(tmp_path):
+    df = libro(20)
+    df.to_excel(os.path.join(tmp_path, 'viejo.xlsx'), index=False)
+    assert listar_registros(tmp_path) == ['viejo']
+    pd.testing.assert_frame_equal(cargar_registro('viejo', tmp_path), df, check_dtype=False)
+    assert os.path.exists(os.path.join(tmp_path, 'viejo.parquet'))
+
+
+def test_diario_se_aplica_al_cargar(tmp_path):
+    sesion = libro()
+    guardar_registro(sesion, 'r', tmp_path)
+    diario = DiarioRegistro('r', tmp_path)
+
+    sesion = pd.concat([sesion, alta()], ignore_index=True)
+    diario.anotar_altas(sesion.iloc[-1:])
+    diario.anotar_bajas([4, 0])
+    sesion = sesion.drop(index=[4, 0]).reset_index(drop=True)
+
+    assert len(diario) == 2
+    pd.testing.assert_frame_equal(cargar_registro('r', tmp_path), sesion, check_dtype=False)
+
+
+def test_linea_cortada_se_ignora(tmp_path):
+    guardar_registro(libro(), 'r', tmp_path)
+    diario = DiarioRegistro('r', tmp_path)
+    diario.anotar_altas(alta())
+    with open(diario.ruta, 'a', encoding='utf-8') as f:
+        f.write('{"secuencia": 3, "op"')
+    assert len(cargar_registro('r', tmp_path)) == 6
+
+
+def test_compactar_vuelca_el_diario(tmp_path):
+    sesion = libro()
+    guardar_registro(sesion, 'r', tmp_path)
+    diario = DiarioRegistro('r', tmp_path)
+    assert diario.ultima_secuencia() == 1
+    sesion = pd.concat([sesion, alta()], ignore_index=True)
+    diario.anotar_altas(sesion.iloc[-1:])
+
+    assert diario.compactar_si_toca(sesion, umbral=1)
+    assert not os.path.exists(diario.ruta)
+    assert DiarioRegistro('r', tmp_path).ultima_secuencia() == 3
+    pd.testing.assert_frame_equal(cargar_registro('r', tmp_path), sesion, check_dtype=False)
+
+    # La numeración sigue tras la compactación y la sesión que compacta puede seguir dando bajas
+    diario.anotar_bajas([0])
+    with open(diario.ruta, encoding='utf-8') as f:
+        assert [json.loads(linea)['secuencia'] for linea in f] == [4]
+
+
+def test_dos_sesiones_sobre_el_mismo_registro(tmp_path):
+    guardar_registro(libro(), 'r', tmp_path)
+    una, otra = DiarioRegistro('r', tmp_path), DiarioRegistro('r', tmp_path)
+
+    una.anotar_altas(alta(1.0))
+    otra.anotar_altas(alta(2.0))
+    assert [e['secuencia'] for e in una.entradas()] == [2, 3]
+    assert len(cargar_registro('r', tmp_path)) == 7
+
+    # Las posiciones de 'una' ya no son las del diario: la baja se rechaza y no se compacta
+    with pytest.raises(ValueError):
+        una.anotar_bajas([0])
+    assert not una.compactar_si_toca(libro(), umbral=1)
+    assert len(cargar_registro('r', tmp_path)) == 7
+
+
+def test_guardado_completo_de_otra_sesion(tmp_path):
+    guardar_registro(libro(), 'r', tmp_path)
+    una = DiarioRegistro('r', tmp_path)
+
+    # Otra sesión sobrescribe el registro con otro libro sin pasar por el diario
+    guardar_registro(libro(9), 'r', tmp_path)
+    assert not os.path.exists(una.ruta)
+    with pytest.raises(ValueError):
+        una.anotar_bajas([0])
+    assert len(cargar_registro('r', tmp_path)) == 9
+
+
+def test_libro_mapeado(tmp_path):
+    df = libro(400)
+    guardar_registro(df, 'r', tmp_path)
+    tabla = mapear_registro('r', tmp_path)
+    assert tabla.num_rows == len(df)
+    comprobar_iguales(calcular_fifo(tabla), calcular_fifo(df))
+
+    # Un cambio en el diario rehace el libro mapeado
+    DiarioRegistro('r', tmp_path).anotar_altas(alta())
+    assert mapear_registro('r', tmp_path).num_rows == len(df) + 1
+
+
+def test_tabla_a_libro_conserva_orden_y_filas_sin_activo(tmp_path):
+    df = libro(50)
+    df.loc[[7, 30], 'activo'] = None
+    guardar_registro(df, 'r', tmp_path)
+    tabla = mapear_registro('r', tmp_path)
+    assert tabla.num_rows == len(df)
+    pd.testing.assert_frame_equal(tabla_a_libro(tabla), cargar_registro('r', tmp_path))
+
+
+def test_estado_desde_la_tabla_mapeada(tmp_path):
+    sesion = libro(400)
+    sesion.loc[12, 'activo'] = None
+    guardar_registro(sesion, 'r', tmp_path)
+
+    # Como al cargar un registro en la app: FIFO sobre la tabla y altas sobre el DataFrame
+    tabla = mapear_registro('r', tmp_path)
+    estado = EstadoFIFO.desde_libro(tabla, escala=ESCALA_CANTIDAD)
+    sesion = tabla_a_libro(tabla)
+    nueva = alta().set_axis([len(sesion)])
+    estado.añadir_libro(nueva)
+    sesion = pd.concat([sesion, nueva])
+    estado.sincronizar(sesion)
+    assert estado.num_filas == len(sesion) and not estado.pendientes
+    comprobar_iguales(estado.resultado(), calcular_fifo(sesion, escala=ESCALA_CANTIDAD))
+
+
+def test_mapear_convierte_excel(tmp_path):
+    df = libro(20)
+    df.to_excel(os.path.join(tmp_path, 'viejo.xlsx'), index=False)
+    tabla = mapear_registro('viejo', tmp_path)
+    assert tabla.num_rows == 20
+    assert os.path.exists(os.path.join(tmp_path, 'viejo.parquet'))
+
+
+def test_eliminar_registro(tmp_path):
+    guardar_registro(libro(), 'r', tmp_path)
+    DiarioRegistro('r', tmp_path).anotar_altas(alta())
+    mapear_registro('r', tmp_path)
+    eliminar_registro('r', tmp_path)
+    assert os.listdir(tmp_path) == []